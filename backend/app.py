@@ -1,59 +1,46 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Request, request, jsonify, Response, g
 from flask_cors import CORS
 from config import Config
-from services.pdf_extractor import PDFTextExtractor
-from services.ai_processor import AIProcessor
+from services.analysis_pipeline import AnalysisPipeline
+from services.ai_processor import RATE_LIMITED_ERROR
+from services.admission import admission_controller, AdmissionRejected
 from services.key_manager import key_manager
-from utils.helpers import save_uploaded_file, format_response_data
+from services.gemini_pool import gemini_pool
+from services.result_cache import result_cache
+from services.near_duplicate import near_duplicate_index
+from services.batch_processor import batch_processor
+from services.template_index import template_index
+from services.ai_batcher import ai_batcher
+from services.ocr_engine import ocr_page_cache
+from services.prompt_builder import token_counter
+from services.response_schema import rc_response_schema
+from services.startup_checks import startup_checker
+from services.service_status import health_status, keys_status
+from services.load_history import load_history
+from services.geo_distance import geo_distance
+from services.metrics import (
+    metrics, timed, start_trace, end_trace, http_requests_in_flight, http_request_seconds
+)
+from utils.helpers import save_uploaded_file, read_uploaded_file, is_zip_upload, extract_zip_uploads
 import os
+import json
+import time
+import tempfile
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Додайте цю функцію для перевірки доступних моделей
-def check_available_models():
-    """Check which models are available"""
-    try:
-        import google.generativeai as genai
-        from google.api_core import exceptions
-        
-        api_key = os.environ.get('GOOGLE_AI_KEY_1') or os.environ.get('GOOGLE_AI_KEY')
-        if not api_key:
-            print("No Google AI API key found")
-            return
-        
-        genai.configure(api_key=api_key)
-        models = genai.list_models()
-        
-        print("=" * 50)
-        print("AVAILABLE GOOGLE AI MODELS:")
-        print("=" * 50)
-        
-        for model in models:
-            supported_methods = []
-            if hasattr(model, 'supported_generation_methods'):
-                if 'generateContent' in model.supported_generation_methods:
-                    supported_methods.append('generateContent')
-                if 'embedContent' in model.supported_generation_methods:
-                    supported_methods.append('embedContent')
-            
-            print(f"- {model.name}")
-            if supported_methods:
-                print(f"  Supports: {', '.join(supported_methods)}")
-            print()
-            
-    except exceptions.PermissionDenied as e:
-        print(f"Permission denied: {e}")
-        print("Check your API key and permissions")
-    except ImportError as e:
-        print(f"Google generativeai not installed: {e}")
-    except Exception as e:
-        print(f"Error checking models: {e}")
+class SpooledUploadRequest(Request):
+    """
+    Keep multipart file parts in memory up to UPLOAD_SPILL_THRESHOLD
+    (werkzeug writes anything over 500 KB to a temp file by default)
+    """
 
-# Викликайте функцію перевірки при запуску
-check_available_models()
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=Config.UPLOAD_SPILL_THRESHOLD, mode='rb+')
 
 app = Flask(__name__)
+app.request_class = SpooledUploadRequest
 app.config.from_object(Config)
 CORS(app, origins=[
     "http://localhost:8000",
@@ -65,6 +52,45 @@ CORS(app, origins=[
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+# Register the keys once per worker; clients are built on first use
+gemini_pool.initialize(Config.GOOGLE_AI_KEYS)
+
+@app.before_request
+def start_request_metrics():
+    # Model/key checks run in the background of each worker instead of on import
+    startup_checker.start()
+    g.request_started = time.perf_counter()
+    start_trace()
+    http_requests_in_flight.inc()
+
+@app.after_request
+def record_request_metrics(response):
+    trace = end_trace()
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    http_request_seconds.observe(
+        time.perf_counter() - g.request_started,
+        endpoint=endpoint, method=request.method, status=response.status_code
+    )
+    wants_timing = request.headers.get('X-Request-Timing', '').lower() == 'true'
+    if trace is not None and (Config.TIMING_HEADER_ENABLED or wants_timing):
+        response.headers['Server-Timing'] = trace.server_timing()
+    return response
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    http_requests_in_flight.dec()
+
+def retry_later(message, status, retry_after):
+    """429/503 error response telling the client when to come back"""
+    response = jsonify({'error': message, 'retry_after': retry_after})
+    response.status_code = status
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def rate_limited_response():
+    """429 for an AI call that ran out of key capacity after it was admitted"""
+    return retry_later(RATE_LIMITED_ERROR, 429, admission_controller.key_retry_after())
+
 @app.route('/api/analyze', methods=['POST'])
 def analyze_rate_confirmation():
     """
@@ -79,71 +105,391 @@ def analyze_rate_confirmation():
         if file.filename == '':
             return jsonify({'error': 'No file selected'}), 400
         
-        # Get deadhead distance (optional)
+        # Get deadhead distance, or the truck's ZIP / "City, ST" to estimate it (optional)
         deadhead = request.form.get('deadhead', 0, type=float)
+        truck_location = request.form.get('truck_location', '').strip() or None
         
-        # Save uploaded file
-        file_path = save_uploaded_file(file, app.config['UPLOAD_FOLDER'])
-        if not file_path:
+        # Read the upload in memory (spilling to a temp file only for large documents)
+        with timed('upload_read'):
+            document = read_uploaded_file(file, Config.UPLOAD_SPILL_THRESHOLD)
+        if document is None:
             return jsonify({'error': 'Invalid file type'}), 400
         
-        # Extract text from PDF
-        pdf_extractor = PDFTextExtractor()
-        extracted_text = pdf_extractor.extract_text_from_pdf(file_path)
+        # Run the analysis pipeline (cache -> PDF text -> template/fast path or AI -> formatting)
+        with document:
+            try:
+                pipeline = AnalysisPipeline()
+                response_data = pipeline.analyze_file(
+                    document.source, deadhead, file_hash=document.file_hash, truck_location=truck_location
+                )
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 500
+        
+        # Check for AI errors
+        if 'error' in response_data:
+            if response_data['error'] == RATE_LIMITED_ERROR:
+                return rate_limited_response()
+            return jsonify({'error': response_data['error']}), 500
         
-        print(f"Extracted text length: {len(extracted_text)} characters")
+        return jsonify(response_data)
         
-        # Use AI to process the text
+    except AdmissionRejected as e:
+        return retry_later(str(e), e.status, e.retry_after)
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+def format_sse(event, data):
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/api/analyze/stream', methods=['POST'])
+def analyze_rate_confirmation_stream():
+    """
+    Streaming variant of /api/analyze. Sends Server-Sent Events as the
+    analysis progresses: received, extracted, fields (fast path and AI
+    fields as they arrive), and a final result event with the same
+    payload /api/analyze returns (or an error event). When the AI is
+    needed but can't take the document in time, the error event carries
+    the 429/503 status and retry_after.
+    """
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file uploaded'}), 400
+
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': 'No file selected'}), 400
+
+    deadhead = request.form.get('deadhead', 0, type=float)
+    truck_location = request.form.get('truck_location', '').strip() or None
+
+    with timed('upload_read'):
+        document = read_uploaded_file(file, Config.UPLOAD_SPILL_THRESHOLD)
+    if document is None:
+        return jsonify({'error': 'Invalid file type'}), 400
+
+    def generate():
         try:
-            ai_processor = AIProcessor()
-            processed_data = ai_processor.process_with_gemini(extracted_text, deadhead)
-        except ValueError as e:
-            return jsonify({'error': str(e)}), 500
+            yield format_sse('received', {'filename': document.filename, 'size': document.size})
+            for event, data in AnalysisPipeline().analyze_stream(
+                document.source, deadhead, file_hash=document.file_hash, truck_location=truck_location
+            ):
+                yield format_sse(event, data)
+        except Exception as e:
+            print(f"Streaming error: {str(e)}")
+            yield format_sse('error', {'error': f'Server error: {str(e)}'})
+
+    response = Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Stop reverse proxies from buffering the event stream
+        'X-Accel-Buffering': 'no'
+    })
+    # Runs when the server closes the response, even if the client went away or the stream never started
+    response.call_on_close(document.cleanup)
+    return response
+
+@app.route('/api/batch', methods=['POST'])
+def submit_batch():
+    """
+    Submit many RC files (or zip archives of them) for background analysis
+    """
+    try:
+        uploads = request.files.getlist('files') + request.files.getlist('file')
+        uploads = [file for file in uploads if file.filename]
+        if not uploads:
+            return jsonify({'error': 'No files uploaded'}), 400
         
-        # Check for AI errors
-        if 'error' in processed_data:
-            return jsonify({'error': processed_data['error']}), 500
+        deadhead = request.form.get('deadhead', 0, type=float)
+        truck_location = request.form.get('truck_location', '').strip() or None
         
-        # Format response
-        response_data = format_response_data(processed_data)
+        saved_files = []
+        with timed('upload_save'):
+            for file in uploads:
+                remaining = Config.BATCH_MAX_FILES - len(saved_files)
+                if remaining <= 0:
+                    break
+                if is_zip_upload(file):
+                    saved_files.extend(extract_zip_uploads(
+                        file, app.config['UPLOAD_FOLDER'], max_files=remaining
+                    ))
+                else:
+                    file_path = save_uploaded_file(file, app.config['UPLOAD_FOLDER'])
+                    if file_path:
+                        saved_files.append((file.filename, file_path))
         
-        # Clean up uploaded file
-        try:
-            os.remove(file_path)
-        except:
-            pass
+        if not saved_files:
+            return jsonify({'error': 'No valid files found'}), 400
         
-        return jsonify(response_data)
+        job = batch_processor.submit(saved_files, deadhead, truck_location)
+        return jsonify({
+            'job_id': job.job_id,
+            'total': len(job.items),
+            'status_url': f'/api/batch/{job.job_id}',
+            'results_url': f'/api/batch/{job.job_id}/results'
+        }), 202
         
     except Exception as e:
-        print(f"Error: {str(e)}")
+        print(f"Batch error: {str(e)}")
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
+@app.route('/api/batch/<job_id>', methods=['GET'])
+def get_batch_status(job_id):
+    """
+    Endpoint to check progress of a batch job
+    """
+    job = batch_processor.get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.get_status())
+
+@app.route('/api/batch/<job_id>/results', methods=['GET'])
+def get_batch_results(job_id):
+    """
+    Endpoint to fetch batch results. With ?stream=true results are sent as
+    newline-delimited JSON as soon as each document finishes.
+    """
+    job = batch_processor.get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    if request.args.get('stream', 'false').lower() == 'true':
+        timeout = request.args.get('timeout', 600, type=float)
+        
+        def generate():
+            for item in job.iter_results(timeout=timeout):
+                yield json.dumps(item) + '\n'
+        
+        return Response(generate(), mimetype='application/x-ndjson')
+    
+    status = job.get_status()
+    return jsonify({
+        'job_id': job.job_id,
+        'status': status['status'],
+        'total': status['total'],
+        'results': job.get_results()
+    })
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """
     Health check endpoint
     """
-    has_google_key = bool(os.environ.get('GOOGLE_AI_KEY_1') or os.environ.get('GOOGLE_AI_KEY'))
-    return jsonify({
-        'status': 'healthy',
-        'message': 'SMART RC API is running',
-        'ai_service': 'google_gemini',
-        'google_ai_configured': has_google_key,
-        'available_keys': len([k for k in Config.GOOGLE_AI_KEYS if k.strip()])
-    })
+    return jsonify(health_status())
 
 @app.route('/api/keys/status', methods=['GET'])
 def get_keys_status():
     """
     Endpoint to check status of all API keys
     """
+    return jsonify(keys_status())
+
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """
+    Endpoint to check result cache and near-duplicate index hit/miss/eviction counters
+    """
+    return jsonify({
+        'enabled': Config.CACHE_ENABLED,
+        'cache': result_cache.get_stats(),
+        'near_duplicates': dict(near_duplicate_index.get_stats(), enabled=Config.NEAR_DUP_ENABLED)
+    })
+
+@app.route('/api/templates/stats', methods=['GET'])
+def get_template_stats():
+    """
+    Endpoint to check learned layout template counters
+    """
+    return jsonify({
+        'enabled': Config.TEMPLATES_ENABLED,
+        'templates': template_index.get_stats()
+    })
+
+def parse_list_arg(name, default, cast=str):
+    """Comma-separated query argument as a list"""
+    value = request.args.get(name)
+    if value is None:
+        return list(default)
+    return [cast(item.strip()) for item in value.split(',') if item.strip()]
+
+def history_query_args():
+    """Grouping, filter and percentile arguments shared by the history endpoints"""
+    return {
+        'group_by': parse_list_arg('group_by', ['lane']),
+        'percentiles': parse_list_arg('percentiles', [25, 50, 75, 90], float),
+        'filters': {
+            column: request.args.get(column)
+            for column in ('origin', 'destination', 'broker', 'equipment')
+        },
+        'min_count': request.args.get('min_count', 1, type=int),
+        'limit': request.args.get('limit', 50, type=int)
+    }
+
+@app.route('/api/history/ingest', methods=['POST'])
+def ingest_history():
+    """
+    Bulk-add analyzed RCs to the load history: {"loads": [...], "deadhead": 0}
+    """
+    payload = request.get_json(silent=True) or {}
+    loads = payload.get('loads')
+    if not isinstance(loads, list):
+        return jsonify({'error': 'Expected a JSON body with a "loads" list'}), 400
+    try:
+        ingested = load_history.ingest(loads, default_deadhead=float(payload.get('deadhead', 0)))
+    except Exception as e:
+        print(f"History ingest error: {str(e)}")
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+    return jsonify({'ingested': ingested, 'skipped': len(loads) - ingested})
+
+@app.route('/api/history/rates', methods=['GET'])
+def get_history_rates():
+    """
+    Rate-per-mile (or rate/distance) percentiles by lane, broker or equipment.
+    ?deadhead= recalculates every load as if it had that deadhead.
+    """
+    try:
+        args = history_query_args()
+        return jsonify(load_history.rate_percentiles(
+            metric=request.args.get('metric', 'rate_per_mile'),
+            deadhead=request.args.get('deadhead', None, type=float),
+            **args
+        ))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/history/deadhead', methods=['GET'])
+def get_history_deadhead():
+    """
+    What-if: rate per mile with the recorded deadheads and with each
+    ?deadheads=0,50,100 applied to every load
+    """
+    try:
+        args = history_query_args()
+        args['group_by'] = parse_list_arg('group_by', [])
+        args['percentiles'] = parse_list_arg('percentiles', [50], float)
+        return jsonify(load_history.deadhead_what_if(
+            parse_list_arg('deadheads', [0, 50, 100, 200], float), **args
+        ))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/history/stats', methods=['GET'])
+def get_history_stats():
+    """
+    Load history size and counters
+    """
     return jsonify({
-        'keys_status': key_manager.get_status(),
-        'total_keys': len(Config.GOOGLE_AI_KEYS),
-        'active_keys': sum(1 for key in Config.GOOGLE_AI_KEYS if key.strip())
+        'enabled': Config.LOAD_HISTORY_ENABLED,
+        'history': load_history.get_stats()
     })
 
+@app.route('/api/distance', methods=['GET'])
+def get_distance():
+    """
+    Offline road-mile estimate between two ZIPs or "City, ST" addresses:
+    ?origin=75201&destination=Atlanta, GA
+    """
+    origin = request.args.get('origin', '').strip()
+    destination = request.args.get('destination', '').strip()
+    if not origin or not destination:
+        return jsonify({'error': 'Both origin and destination are required'}), 400
+    if not geo_distance.available:
+        return jsonify({'error': 'Geo tables are not available'}), 503
+    result = geo_distance.describe_lane(origin, destination)
+    if result['miles'] is None:
+        return jsonify(dict(result, error='Could not resolve origin or destination')), 404
+    return jsonify(result)
+
+@app.route('/api/distance/stats', methods=['GET'])
+def get_distance_stats():
+    """
+    Geo table status and lane memoization counters
+    """
+    return jsonify(geo_distance.get_stats())
+
+def collect_service_metrics():
+    """Key states, cache counters and token usage read at scrape time"""
+    key_states = key_manager.get_key_states()
+    statuses = ('active', 'rate_limited', 'error')
+    families = [
+        ('smartrc_key_status', 'gauge', 'Current status of each API key (1 = in this status)', [
+            ({'key': key_manager.key_label(key), 'status': status}, int(state['status'] == status))
+            for key, state in key_states.items() for status in statuses
+        ]),
+        ('smartrc_key_requests_available', 'gauge', 'Requests left in each key bucket', [
+            ({'key': key_manager.key_label(key)}, round(max(0.0, state['requests_available']), 2))
+            for key, state in key_states.items()
+        ]),
+        ('smartrc_key_tokens_available', 'gauge', 'Tokens left in each key bucket', [
+            ({'key': key_manager.key_label(key)}, int(max(0.0, state['tokens_available'])))
+            for key, state in key_states.items()
+        ]),
+        ('smartrc_key_tokens_used', 'counter', 'Tokens used per key (shared across workers)', [
+            ({'key': key_manager.key_label(key)}, state['tokens_used'])
+            for key, state in key_states.items()
+        ]),
+    ]
+
+    cache_stats = {
+        'results': result_cache.get_stats(),
+        'ocr_pages': ocr_page_cache.get_stats(),
+        'near_duplicates': near_duplicate_index.get_stats()
+    }
+    for counter in ('hits', 'misses', 'stores', 'evictions', 'expirations'):
+        families.append((f'smartrc_cache_{counter}_total', 'counter', f'Cache {counter}', [
+            ({'cache': cache_name}, stats[counter]) for cache_name, stats in cache_stats.items()
+        ]))
+    families.append(('smartrc_cache_hit_rate', 'gauge', 'Cache hit rate since start', [
+        ({'cache': cache_name}, stats['hit_rate']) for cache_name, stats in cache_stats.items()
+    ]))
+    families.append(('smartrc_cache_entries', 'gauge', 'Entries currently cached', [
+        ({'cache': cache_name}, stats['size']) for cache_name, stats in cache_stats.items()
+    ]))
+
+    batcher_stats = ai_batcher.get_stats()
+    families.append(('smartrc_ai_batcher_pending', 'gauge', 'Documents waiting for a batched AI request', [
+        ({}, batcher_stats['pending'])
+    ]))
+    response_stats = rc_response_schema.get_stats()
+    families.append(('smartrc_ai_responses_total', 'counter', 'Parsed AI answers by outcome', [
+        ({'outcome': outcome}, response_stats[outcome])
+        for outcome in ('parsed', 'repaired', 'incomplete', 'unparseable')
+    ]))
+    families.append(('smartrc_ai_followup_fields_total', 'counter', 'Fields re-requested after an incomplete answer', [
+        ({'outcome': 'requested'}, response_stats['followup_fields']),
+        ({'outcome': 'recovered'}, response_stats['followup_recovered'])
+    ]))
+    admission_stats = admission_controller.get_stats()
+    families.append(('smartrc_admission_queued', 'gauge', 'Requests waiting for an analysis slot', [
+        ({'priority': priority}, count) for priority, count in admission_stats['queued'].items()
+    ]))
+    families.append(('smartrc_admission_active', 'gauge', 'Documents holding an analysis slot', [
+        ({'priority': priority}, count) for priority, count in admission_stats['active'].items()
+    ]))
+    families.append(('smartrc_admission_estimated_wait_seconds', 'gauge', 'Estimated wait for a new request', [
+        ({'priority': priority}, wait) for priority, wait in admission_stats['estimated_wait'].items()
+        if wait is not None
+    ]))
+    families.append(('smartrc_revision_fields_total', 'counter', 'Fields re-extracted for revised RCs', [
+        ({'source': 'local'}, cache_stats['near_duplicates']['local_fields']),
+        ({'source': 'ai'}, cache_stats['near_duplicates']['ai_fields'])
+    ]))
+    families.append(('smartrc_prompt_chars_per_token', 'gauge', 'Calibrated characters per token', [
+        ({}, token_counter.get_stats()['chars_per_token'])
+    ]))
+    return families
+
+metrics.register_collector(collect_service_metrics)
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Prometheus scrape endpoint (stage latencies, Gemini attempts per key,
+    in-flight requests, key states, cache hit rates and token usage)
+    """
+    if not Config.METRICS_ENABLED:
+        return jsonify({'error': 'Metrics are disabled'}), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     debug = os.environ.get('DEBUG', 'False').lower() == 'true'
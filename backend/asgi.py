@@ -0,0 +1,153 @@
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from werkzeug.datastructures import FileStorage
+from config import Config
+from services.analysis_pipeline import AnalysisPipeline
+from services.ai_processor import RATE_LIMITED_ERROR
+from services.admission import admission_controller, AdmissionRejected
+from services.gemini_pool import gemini_pool
+from services.startup_checks import startup_checker
+from services.service_status import health_status, keys_status
+from services.metrics import timed, start_trace, end_trace, http_requests_in_flight, http_request_seconds
+from utils.helpers import read_uploaded_file
+import os
+import time
+import asyncio
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Async serving mode: the /api/analyze, /api/health and /api/keys/status
+# contracts of app.py, with every analysis awaiting Gemini on one event loop
+# (run with `uvicorn asgi:app` or `python asgi.py`)
+
+# Register the keys once per process; clients are built on first use
+gemini_pool.initialize(Config.GOOGLE_AI_KEYS)
+# Waiting analyses cost a coroutine here, not a thread, so many more are admitted
+admission_controller.configure(Config.ASYNC_MAX_ACTIVE)
+
+def retry_later(message, status, retry_after):
+    """429/503 error response telling the client when to come back"""
+    return JSONResponse(
+        {'error': message, 'retry_after': retry_after},
+        status_code=status, headers={'Retry-After': str(retry_after)}
+    )
+
+def form_float(form, name, default=0.0):
+    """A float form field; missing or invalid values give the default (as Flask's type=float does)"""
+    try:
+        return float(form.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+async def record_request_metrics(request, call_next):
+    # Model/key checks run in the background of each worker instead of on import
+    startup_checker.start()
+    started = time.perf_counter()
+    start_trace()
+    http_requests_in_flight.inc()
+    try:
+        response = await call_next(request)
+    finally:
+        http_requests_in_flight.dec()
+    trace = end_trace()
+    endpoint = request.url.path if 'endpoint' in request.scope else 'unmatched'
+    http_request_seconds.observe(
+        time.perf_counter() - started,
+        endpoint=endpoint, method=request.method, status=response.status_code
+    )
+    wants_timing = request.headers.get('X-Request-Timing', '').lower() == 'true'
+    if trace is not None and (Config.TIMING_HEADER_ENABLED or wants_timing):
+        response.headers['Server-Timing'] = trace.server_timing()
+    return response
+
+async def analyze_rate_confirmation(request):
+    """
+    Main endpoint for analyzing Rate Confirmation documents (same form
+    fields and responses as the Flask endpoint)
+    """
+    try:
+        if int(request.headers.get('content-length') or 0) > Config.MAX_CONTENT_LENGTH:
+            return JSONResponse({'error': 'File too large'}, status_code=413)
+        form = await request.form()
+
+        # Check if file was uploaded
+        upload = form.get('file')
+        if upload is None or isinstance(upload, str):
+            return JSONResponse({'error': 'No file uploaded'}, status_code=400)
+        if not upload.filename:
+            return JSONResponse({'error': 'No file selected'}, status_code=400)
+
+        # Get deadhead distance, or the truck's ZIP / "City, ST" to estimate it (optional)
+        deadhead = form_float(form, 'deadhead')
+        truck_location = (form.get('truck_location') or '').strip() or None
+
+        # Hash and sniff the upload off the event loop
+        with timed('upload_read'):
+            document = await asyncio.to_thread(
+                read_uploaded_file, FileStorage(upload.file, filename=upload.filename),
+                Config.UPLOAD_SPILL_THRESHOLD
+            )
+        if document is None:
+            return JSONResponse({'error': 'Invalid file type'}, status_code=400)
+
+        with document:
+            try:
+                response_data = await AnalysisPipeline().analyze_file_async(
+                    document.source, deadhead, file_hash=document.file_hash, truck_location=truck_location
+                )
+            except ValueError as e:
+                return JSONResponse({'error': str(e)}, status_code=500)
+
+        # Check for AI errors
+        if 'error' in response_data:
+            if response_data['error'] == RATE_LIMITED_ERROR:
+                return retry_later(RATE_LIMITED_ERROR, 429, admission_controller.key_retry_after())
+            return JSONResponse({'error': response_data['error']}, status_code=500)
+
+        return JSONResponse(response_data)
+
+    except AdmissionRejected as e:
+        return retry_later(str(e), e.status, e.retry_after)
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return JSONResponse({'error': f'Server error: {str(e)}'}, status_code=500)
+
+async def health_check(request):
+    """
+    Health check endpoint
+    """
+    return JSONResponse(health_status())
+
+async def get_keys_status(request):
+    """
+    Endpoint to check status of all API keys
+    """
+    return JSONResponse(keys_status())
+
+app = Starlette(
+    routes=[
+        Route('/api/analyze', analyze_rate_confirmation, methods=['POST']),
+        Route('/api/health', health_check, methods=['GET']),
+        Route('/api/keys/status', get_keys_status, methods=['GET'])
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=[
+            "http://localhost:8000",
+            "http://127.0.0.1:8000",
+            "https://smartratecon.github.io",
+            "https://smart-ratecon.onrender.com"
+        ], allow_methods=['*'], allow_headers=['*']),
+        Middleware(BaseHTTPMiddleware, dispatch=record_request_metrics)
+    ]
+)
+
+if __name__ == '__main__':
+    import uvicorn
+
+    port = int(os.environ.get('PORT', 5000))
+    uvicorn.run(app, host='0.0.0.0', port=port)
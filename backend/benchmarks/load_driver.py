@@ -0,0 +1,249 @@
+"""
+End-to-end load driver for /api/analyze against the mock Gemini server.
+For every key count and server worker count it starts the app with fake
+keys pointed at the mock, then replays synthetic RCs at each client
+concurrency and reports p50/p95/p99 latency and throughput.
+
+    python -m benchmarks.load_driver --keys 1,2,5 --concurrency 1,4,16 --requests 100
+
+Server workers > 1 need gunicorn on the PATH. They share key quotas
+through a local Redis stand-in (benchmarks.mock_redis), or through SQLite
+with --key-state sqlite.
+"""
+import os
+import sys
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from benchmarks.mock_gemini import start_in_background
+from benchmarks import mock_redis
+from benchmarks.synthetic_rc import generate_corpus
+from benchmarks.results import summarize, write_results
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_app(port, key_count, workers, mock_endpoint, state_dir, args, key_state='memory://'):
+    """Start the backend in a subprocess configured for the benchmark"""
+    env = dict(os.environ)
+    # Unused slots are set empty rather than removed, or load_dotenv() fills them from backend/.env
+    for index in range(1, 6):
+        env[f'GOOGLE_AI_KEY_{index}'] = f'bench-key-{index:02d}' if index <= key_count else ''
+    env.update({
+        'PORT': str(port),
+        'GEMINI_TRANSPORT': 'rest',
+        'GEMINI_API_ENDPOINT': mock_endpoint,
+        'CACHE_ENABLED': 'true' if args.cache else 'false',
+        'NEAR_DUP_ENABLED': 'true' if args.near_duplicates else 'false',
+        'NEAR_DUP_DB_PATH': os.path.join(state_dir, 'near_duplicates.db'),
+        'FAST_PATH_ENABLED': 'true' if args.fast_path else 'false',
+        'TEMPLATES_ENABLED': 'false',
+        'STARTUP_CHECKS_ENABLED': 'false',
+        'AI_BATCHING_ENABLED': 'true' if args.batching else 'false',
+        'HEDGING_ENABLED': 'true' if args.hedging else 'false',
+        'ADMISSION_ENABLED': 'false' if args.no_admission else 'true',
+        'CACHE_DB_PATH': os.path.join(state_dir, 'results.db'),
+        'OCR_CACHE_DB_PATH': os.path.join(state_dir, 'ocr_pages.db'),
+        'KEY_STATE_BACKEND': key_state
+    })
+
+    if args.asgi:
+        command = [sys.executable, '-m', 'uvicorn', '--workers', str(workers), '--port', str(port), 'asgi:app']
+    elif workers > 1:
+        command = ['gunicorn', '-w', str(workers), '--threads', '8', '-b', f'127.0.0.1:{port}', 'app:app']
+    else:
+        command = [sys.executable, 'app.py']
+    log = open(os.path.join(state_dir, f'app_{port}.log'), 'w')
+    process = subprocess.Popen(command, cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + args.startup_timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"App exited during startup, see {log.name}")
+        try:
+            if requests.get(f'{url}/api/health', timeout=1).ok:
+                return process, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"App did not become healthy within {args.startup_timeout}s, see {log.name}")
+
+def stop_app(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+def run_load(url, endpoint, documents, total_requests, concurrency, timeout):
+    """Send total_requests uploads with concurrency clients; returns the summary"""
+    payloads = []
+    for document in documents:
+        with open(document['path'], 'rb') as f:
+            payloads.append((os.path.basename(document['path']), f.read()))
+
+    def send(index):
+        filename, data = payloads[index % len(payloads)]
+        started = time.perf_counter()
+        try:
+            response = requests.post(
+                f'{url}{endpoint}',
+                files={'file': (filename, data, 'application/pdf')},
+                data={'deadhead': '50'},
+                timeout=timeout
+            )
+            # Consume streamed bodies fully so the latency covers the final event
+            body = response.content
+            status = response.status_code
+            if status == 200 and endpoint.endswith('/stream') and b'event: result' not in body:
+                status = 'stream_error'
+        except requests.RequestException as e:
+            status = type(e).__name__
+        return status, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(send, range(total_requests)))
+    wall_seconds = time.perf_counter() - started
+
+    statuses = {}
+    for status, _ in outcomes:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    ok_latencies = [seconds for status, seconds in outcomes if status == 200]
+    return dict(
+        summarize(ok_latencies),
+        requests=total_requests,
+        ok=len(ok_latencies),
+        statuses=statuses,
+        wall_seconds=round(wall_seconds, 3),
+        throughput_rps=round(len(ok_latencies) / wall_seconds, 3) if wall_seconds else None
+    )
+
+def _parse_list(value):
+    return [int(item) for item in value.split(',') if item.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test /api/analyze against a mock Gemini API')
+    parser.add_argument('--keys', default='1,2,5', help='API key counts to test')
+    parser.add_argument('--workers', default='1', help='server worker process counts (gunicorn for > 1)')
+    parser.add_argument('--concurrency', default='1,4,16', help='client concurrency levels')
+    parser.add_argument('--requests', type=int, default=60, help='requests per concurrency level')
+    parser.add_argument('--documents', type=int, default=24, help='synthetic RCs to cycle through')
+    parser.add_argument('--endpoint', default='/api/analyze')
+    parser.add_argument('--latency-ms', type=float, default=800)
+    parser.add_argument('--jitter-ms', type=float, default=200)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rpm-per-key', type=int, default=60)
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='fraction of mock calls that stall')
+    parser.add_argument('--slow-ms', type=float, default=10000)
+    parser.add_argument('--defect-rate', type=float, default=0.0, help='fraction of mock answers that are malformed')
+    parser.add_argument('--fast-path', action='store_true', help='allow the local fast path to skip the AI')
+    parser.add_argument('--cache', action='store_true', help='enable the result cache')
+    parser.add_argument('--near-duplicates', action='store_true',
+                        help='re-extract only changed fields of documents seen before (a repeated corpus is all near duplicates)')
+    parser.add_argument('--batching', action='store_true', help='batch AI requests for /api/analyze')
+    parser.add_argument('--hedging', action='store_true', help='hedge slow Gemini calls on another key')
+    parser.add_argument('--asgi', action='store_true', help='serve the async app (asgi.py) with uvicorn')
+    parser.add_argument('--no-admission', action='store_true', help='send every request straight to the AI')
+    parser.add_argument('--key-state', choices=('redis', 'sqlite'), default='redis',
+                        help='how workers > 1 share key quotas: the mock Redis server or a SQLite file')
+    parser.add_argument('--request-timeout', type=float, default=120)
+    parser.add_argument('--startup-timeout', type=float, default=90)
+    parser.add_argument('--url', help='benchmark an already running server instead (keys/workers are ignored)')
+    parser.add_argument('--out', default='benchmarks/results')
+    args = parser.parse_args()
+
+    worker_counts = _parse_list(args.workers)
+    if any(workers > 1 for workers in worker_counts) and not shutil.which('gunicorn') and not args.url and not args.asgi:
+        parser.error('gunicorn is required for --workers > 1')
+
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        documents = generate_corpus(os.path.join(folder, 'docs'), args.documents)
+
+        if args.url:
+            cells = [(None, None)]
+        else:
+            cells = [(keys, workers) for keys in _parse_list(args.keys) for workers in worker_counts]
+
+        for keys, workers in cells:
+            mock, mock_endpoint = start_in_background(
+                latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                error_rate=args.error_rate, rpm_per_key=args.rpm_per_key, seed=1,
+                slow_rate=args.slow_rate, slow_ms=args.slow_ms, defect_rate=args.defect_rate
+            )
+            state_dir = tempfile.mkdtemp(dir=folder)
+            process = None
+            redis = None
+            # Workers must share key quotas to behave like production
+            key_state = 'memory://'
+            if workers and workers > 1:
+                if args.key_state == 'redis':
+                    redis, key_state = mock_redis.start_in_background()
+                else:
+                    key_state = f"sqlite:///{os.path.join(state_dir, 'key_state.db')}"
+            try:
+                if args.url:
+                    url = args.url
+                else:
+                    process, url = start_app(
+                        _free_port(), keys, workers, mock_endpoint, state_dir, args, key_state=key_state
+                    )
+
+                for concurrency in _parse_list(args.concurrency):
+                    before = mock.state.get_stats()
+                    summary = run_load(url, args.endpoint, documents, args.requests, concurrency, args.request_timeout)
+                    after = mock.state.get_stats()
+                    summary.update({
+                        'keys': keys,
+                        'server_workers': workers,
+                        'key_state': key_state.split(':', 1)[0],
+                        'concurrency': concurrency,
+                        'gemini_requests': after['requests'] - before['requests'],
+                        'gemini_followups': after['followups'] - before['followups'],
+                        'gemini_requests_per_model': {
+                            model: count - before['per_model'].get(model, 0)
+                            for model, count in after['per_model'].items()
+                        },
+                        'gemini_429s': (
+                            after['rate_limited'] + after['injected_errors']
+                            - before['rate_limited'] - before['injected_errors']
+                        )
+                    })
+                    if redis is not None:
+                        # Transactions retried because another worker updated the same key first
+                        summary['key_state_conflicts'] = redis.state.get_stats()['conflicts']
+                    results.append(summary)
+                    print(
+                        f"keys={keys} workers={workers} concurrency={concurrency}: "
+                        f"ok {summary['ok']}/{summary['requests']}, "
+                        f"p50 {summary.get('p50_ms')} ms, p95 {summary.get('p95_ms')} ms, "
+                        f"p99 {summary.get('p99_ms')} ms, {summary['throughput_rps']} req/s, "
+                        f"{summary['statuses'].get('429', 0) + summary['statuses'].get('503', 0)} turned away, "
+                        f"{summary['gemini_429s']} mock 429s"
+                    )
+            finally:
+                if process is not None:
+                    stop_app(process)
+                mock.shutdown()
+                mock.server_close()
+                if redis is not None:
+                    redis.shutdown()
+                    redis.server_close()
+
+    parameters = {key: value for key, value in vars(args).items() if key != 'out'}
+    write_results('load', results, args.out, parameters=parameters)
+
+if __name__ == '__main__':
+    main()
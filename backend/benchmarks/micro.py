@@ -0,0 +1,172 @@
+"""
+Micro-benchmarks for the local (non-network) stages: PDFTextExtractor by
+document size, RateCalculator, FallbackProcessor, PromptBuilder and the
+load history analytics.
+
+    python -m benchmarks.micro --repeat 20
+"""
+import os
+import time
+import random
+import argparse
+import tempfile
+from benchmarks.synthetic_rc import generate_rc, random_fields, SIZES, LAYOUTS
+from benchmarks.results import summarize, write_results
+
+def measure(function, repeat, warmup=1):
+    """Run function repeat times after warmup; returns the latency summary"""
+    for _ in range(warmup):
+        function()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - started)
+    summary = summarize(samples)
+    summary['ops_per_second'] = round(len(samples) / sum(samples), 2) if sum(samples) else None
+    return summary
+
+def bench_pdf_extractor(documents, repeat):
+    from services.pdf_extractor import PDFTextExtractor
+    from config import Config
+
+    results = {}
+    for size, path in documents.items():
+        with open(path, 'rb') as f:
+            data = f.read()
+        for mode, parallel in (('sequential', False), ('parallel', True)):
+            extractor = PDFTextExtractor(max_chars=Config.PDF_TEXT_CHAR_BUDGET, parallel=parallel)
+            extraction = extractor.extract(data)
+            results[f'{size}/{mode}'] = dict(
+                measure(lambda: extractor.extract(data), repeat),
+                pages=extraction['page_count'],
+                pages_extracted=extraction['pages_extracted'],
+                used_parallel=extraction['parallel']
+            )
+    return results
+
+def bench_rate_calculator(fields_list, repeat):
+    from services.rate_calculator import RateCalculator
+    from utils.helpers import add_calculated_fields
+
+    calculator = RateCalculator()
+
+    def run_calculator():
+        for fields in fields_list:
+            calculator.calculate_rates(fields, deadhead=75)
+
+    def run_helper():
+        for fields in fields_list:
+            add_calculated_fields(fields, deadhead=75)
+
+    return {
+        f'calculate_rates x{len(fields_list)}': measure(run_calculator, repeat),
+        f'add_calculated_fields x{len(fields_list)}': measure(run_helper, repeat)
+    }
+
+def bench_fallback_processor(texts, repeat):
+    from services.fallback_processor import FallbackProcessor
+
+    processor = FallbackProcessor()
+    fast_path_hits = sum(1 for text in texts.values() if processor.try_fast_path(text) is not None)
+    results = {
+        f'extract_fields/{layout}': measure(lambda text=text: processor.extract_fields(text), repeat)
+        for layout, text in texts.items()
+    }
+    results['fast_path_hit_rate'] = round(fast_path_hits / len(texts), 3)
+    return results
+
+def bench_prompt_builder(texts, repeat):
+    from services.prompt_builder import PromptBuilder
+
+    builder = PromptBuilder()
+    return {
+        f'build/{name}': dict(
+            measure(lambda text=text: builder.build(text), repeat),
+            prompt_tokens=builder.build(text)[1]['estimated_tokens']
+        )
+        for name, text in texts.items()
+    }
+
+def bench_load_history(load_count, repeat, folder):
+    from services.load_history import LoadHistoryStore
+
+    rng = random.Random(7)
+    loads = []
+    for index in range(load_count):
+        fields = random_fields(rng)
+        # The AI returns the broker name without its phone number
+        fields['broker_name'] = fields['broker_name'].split(',')[0]
+        fields['deadhead'] = rng.choice([0, 25, 50, 100])
+        fields['file_hash'] = f'{index:016x}'
+        loads.append(fields)
+
+    counter = iter(range(repeat + 1))
+    def run_ingest():
+        LoadHistoryStore(os.path.join(folder, f'ingest_{next(counter)}')).ingest(loads)
+
+    results = {f'ingest x{load_count}': measure(run_ingest, repeat=min(repeat, 3), warmup=0)}
+    store = LoadHistoryStore(os.path.join(folder, 'history'))
+    store.ingest(loads)
+    results.update({
+        'rates by lane': measure(lambda: store.rate_percentiles(('lane',)), repeat),
+        'rates by broker+equipment': measure(lambda: store.rate_percentiles(('broker', 'equipment')), repeat),
+        'rates by lane, filtered': measure(lambda: store.rate_percentiles(('lane',), filters={'origin': 'TX'}), repeat),
+        'deadhead what-if x4 by lane': measure(
+            lambda: store.deadhead_what_if([0, 50, 100, 200], group_by=('lane',)), repeat
+        )
+    })
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for local analysis stages')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--out', default='benchmarks/results')
+    parser.add_argument('--only', help='comma separated subset: pdf,rate,fallback,prompt,history')
+    parser.add_argument('--history-loads', type=int, default=100000, help='loads in the history benchmark')
+    args = parser.parse_args()
+    selected = set(args.only.split(',')) if args.only else {'pdf', 'rate', 'fallback', 'prompt', 'history'}
+
+    from services.pdf_extractor import PDFTextExtractor
+
+    with tempfile.TemporaryDirectory() as folder:
+        documents = {}
+        for size in SIZES:
+            documents[size] = os.path.join(folder, f'{size}.pdf')
+            generate_rc(documents[size], size, 'labelled', seed=len(documents))
+
+        layout_texts = {}
+        fields_list = []
+        for index, layout in enumerate(LAYOUTS):
+            path = os.path.join(folder, f'{layout}.pdf')
+            fields_list.append(generate_rc(path, 'small', layout, seed=100 + index))
+            layout_texts[layout] = PDFTextExtractor(parallel=False).extract_text_from_pdf(path)
+        size_texts = {
+            size: PDFTextExtractor(parallel=False).extract_text_from_pdf(path)
+            for size, path in documents.items()
+        }
+
+        results = {}
+        if 'pdf' in selected:
+            results['pdf_extractor'] = bench_pdf_extractor(documents, args.repeat)
+        if 'rate' in selected:
+            results['rate_calculator'] = bench_rate_calculator(fields_list * 100, args.repeat)
+        if 'fallback' in selected:
+            results['fallback_processor'] = bench_fallback_processor(layout_texts, args.repeat)
+        if 'prompt' in selected:
+            results['prompt_builder'] = bench_prompt_builder(size_texts, args.repeat)
+        if 'history' in selected:
+            results['load_history'] = bench_load_history(args.history_loads, args.repeat, folder)
+
+    for group, entries in results.items():
+        print(f"\n{group}")
+        for name, summary in entries.items():
+            if isinstance(summary, dict):
+                print(f"  {name:40s} p50 {summary['p50_ms']:>9.3f} ms   p95 {summary['p95_ms']:>9.3f} ms")
+            else:
+                print(f"  {name:40s} {summary}")
+
+    write_results('micro', results, args.out, parameters={'repeat': args.repeat, 'history_loads': args.history_loads})
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+"""
+Local stand-in for the Gemini REST API (generateContent,
+streamGenerateContent and countTokens) with configurable latency, 429 injection, canned
+JSON answers and occasionally malformed answers. Point the app at it with:
+
+    GEMINI_TRANSPORT=rest GEMINI_API_ENDPOINT=http://127.0.0.1:8765
+
+Run standalone:  python -m benchmarks.mock_gemini --port 8765 --latency-ms 800
+"""
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+DEFAULT_FIELDS = {
+    'broker_name': 'Benchmark Logistics LLC, (555) 010-2000, dispatch@benchmark.test',
+    'carrier_name': 'Mock Carrier Inc, MC 123456',
+    'load_number': 'BM-100200',
+    'pickup_number': 'PU-5521',
+    'rate': '2450.00',
+    'distance': '812',
+    'pickup_address': '1200 Industrial Pkwy, Dallas, TX 75201',
+    'pickup_time': '03/14/2025 08:00 Appointment',
+    'delivery_address': '455 Commerce Dr, Atlanta, GA 30301',
+    'delivery_time': '03/15/2025 14:00 FCFS',
+    'commodity': 'Packaged food',
+    'weight': '38000',
+    'equipment': "Reefer 53'",
+    'notes': 'Detention after 2 hours, lumper reimbursed with receipt'
+}
+
+MODEL_NAMES = (
+    'models/gemini-1.5-flash-8b-latest', 'models/gemini-1.5-flash-latest', 'models/gemini-1.5-pro-latest'
+)
+
+# Values the synthetic RC generator writes as "Label: value" lines
+LABELLED_FIELDS = {
+    'load_number': r'Load (?:Number|#)\s*:\s*(.+)',
+    'pickup_number': r'(?:Pickup|PU) (?:Number|#)\s*:\s*(.+)',
+    'rate': r'(?:Total Rate|Line Haul)\s*:\s*\$?([\d,\.]+)',
+    'distance': r'(?:Miles|Distance)\s*:\s*([\d,]+)',
+    'weight': r'Weight\s*:\s*([\d,]+)'
+}
+
+class MockGeminiState:
+    """Behaviour knobs and counters shared by all handler threads"""
+
+    def __init__(self, latency_ms=800, jitter_ms=200, error_rate=0.0, rpm_per_key=0,
+                 canned_fields=None, echo_fields=True, stream_chunks=6, seed=None,
+                 slow_rate=0.0, slow_ms=10000, defect_rate=0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+        self.error_rate = error_rate
+        self.defect_rate = defect_rate
+        self.rpm_per_key = rpm_per_key
+        self.canned_fields = canned_fields or DEFAULT_FIELDS
+        self.echo_fields = echo_fields
+        self.stream_chunks = stream_chunks
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.key_requests = {}  # api key -> deque of request timestamps (last minute)
+        self.stats = {'requests': 0, 'streamed': 0, 'rate_limited': 0, 'injected_errors': 0, 'slow': 0,
+                      'defective': 0, 'followups': 0, 'per_key': {}, 'per_model': {}}
+
+    def admit(self, api_key, model='unknown'):
+        """Return None to serve the request, or the reason to answer 429"""
+        now = time.time()
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['per_key'][api_key[-6:]] = self.stats['per_key'].get(api_key[-6:], 0) + 1
+            self.stats['per_model'][model] = self.stats['per_model'].get(model, 0) + 1
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.stats['injected_errors'] += 1
+                return 'injected'
+            if self.rpm_per_key:
+                window = self.key_requests.setdefault(api_key, deque())
+                while window and now - window[0] > 60:
+                    window.popleft()
+                if len(window) >= self.rpm_per_key:
+                    self.stats['rate_limited'] += 1
+                    return 'rpm'
+                window.append(now)
+        return None
+
+    def latency(self):
+        with self.lock:
+            # Occasional stalls make the tail that hedged requests are meant to cut
+            if self.slow_rate and self.random.random() < self.slow_rate:
+                self.stats['slow'] += 1
+                return self.slow_ms / 1000.0
+            jitter = self.random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0
+        return max(0.0, (self.latency_ms + jitter) / 1000.0)
+
+    def get_stats(self):
+        with self.lock:
+            return json.loads(json.dumps(self.stats))
+
+    def answer(self, prompt_text):
+        """Canned answer for an extraction, batch or OCR prompt"""
+        documents = re.findall(r'=== DOCUMENT (\S+) ===', prompt_text)
+        if documents:
+            sections = re.split(r'=== DOCUMENT \S+ ===', prompt_text)[1:]
+            return json.dumps([
+                dict(self._fields_for(section), document_id=document_id)
+                for document_id, section in zip(documents, sections)
+            ])
+        if 'Transcribe all text' in prompt_text:
+            return '\n'.join(f'{field}: {value}' for field, value in self.canned_fields.items())
+        fields = self._fields_for(prompt_text)
+        if 'Extract ONLY the following fields' in prompt_text:
+            # Follow-up for fields an earlier answer left out
+            with self.lock:
+                self.stats['followups'] += 1
+            requested = re.findall(r'^\s*- (\w+):', prompt_text.split('IMPORTANT')[0], re.M)
+            return json.dumps({field: fields.get(field, 'Not found') for field in requested})
+        return self.damage(json.dumps(fields))
+
+    def damage(self, answer):
+        """Now and then break a JSON answer the way models do (defect_rate)"""
+        with self.lock:
+            if not self.defect_rate or self.random.random() >= self.defect_rate:
+                return answer
+            self.stats['defective'] += 1
+            kind = self.random.choice(('fence', 'trailing_comma', 'truncated', 'missing_fields'))
+        if kind == 'fence':
+            return f'```json\n{answer}\n```'
+        if kind == 'trailing_comma':
+            return answer[:-1] + ',' + answer[-1:]
+        if kind == 'truncated':
+            return answer[:int(len(answer) * 0.7)]
+        data = json.loads(answer)
+        for field in list(data)[-3:]:
+            data.pop(field)
+        return json.dumps(data)
+
+    def _fields_for(self, text):
+        fields = dict(self.canned_fields)
+        if self.echo_fields:
+            # Echo labelled values so results differ per synthetic document
+            for field, pattern in LABELLED_FIELDS.items():
+                match = re.search(pattern, text)
+                if match:
+                    fields[field] = match.group(1).strip()
+        return fields
+
+def _prompt_text(body):
+    parts = []
+    for content in body.get('contents', []):
+        for part in content.get('parts', []):
+            if 'text' in part:
+                parts.append(part['text'])
+    return '\n'.join(parts)
+
+def _response_chunk(text, prompt_tokens, output_tokens, finished=True):
+    chunk = {
+        'candidates': [{
+            'content': {'parts': [{'text': text}], 'role': 'model'},
+            'index': 0
+        }],
+        'usageMetadata': {
+            'promptTokenCount': prompt_tokens,
+            'candidatesTokenCount': output_tokens,
+            'totalTokenCount': prompt_tokens + output_tokens
+        }
+    }
+    if finished:
+        chunk['candidates'][0]['finishReason'] = 'STOP'
+    return chunk
+
+class MockGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None  # set by create_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.startswith('/stats'):
+            self._send_json(200, self.state.get_stats())
+        elif re.match(r'^/v1(beta)?/models', self.path):
+            self._send_json(200, {'models': [
+                {'name': name, 'supportedGenerationMethods': ['generateContent', 'countTokens']}
+                for name in MODEL_NAMES
+            ]})
+        else:
+            self._send_json(404, {'error': {'code': 404, 'message': 'Not found', 'status': 'NOT_FOUND'}})
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        match = re.match(r'^/v1(?:beta)?/models/([^:]+):(generateContent|streamGenerateContent|countTokens)$', parsed.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        if not match:
+            self._send_json(404, {'error': {'code': 404, 'message': 'Not found', 'status': 'NOT_FOUND'}})
+            return
+
+        api_key = self.headers.get('x-goog-api-key') or parse_qs(parsed.query).get('key', [''])[0]
+        if not api_key:
+            self._send_json(403, {'error': {'code': 403, 'message': 'API key missing', 'status': 'PERMISSION_DENIED'}})
+            return
+
+        if match.group(2) == 'countTokens':
+            # Counting is free and not rate limited, as with the real API
+            request = body.get('generateContentRequest') or body
+            self._send_json(200, {'totalTokens': max(1, len(_prompt_text(request)) // 4)})
+            return
+
+        rejection = self.state.admit(api_key, match.group(1))
+        if rejection:
+            time.sleep(0.02)
+            self._send_json(429, {'error': {
+                'code': 429,
+                'message': f'Resource has been exhausted ({rejection})',
+                'status': 'RESOURCE_EXHAUSTED'
+            }})
+            return
+
+        prompt_text = _prompt_text(body)
+        answer = self.state.answer(prompt_text)
+        prompt_tokens = max(1, len(prompt_text) // 4)
+        output_tokens = max(1, len(answer) // 4)
+        delay = self.state.latency()
+
+        if match.group(2) == 'generateContent':
+            time.sleep(delay)
+            self._send_json(200, _response_chunk(answer, prompt_tokens, output_tokens))
+            return
+
+        # Streaming answers arrive as a JSON array, one element per chunk
+        with self.state.lock:
+            self.state.stats['streamed'] += 1
+        chunk_count = max(1, self.state.stream_chunks)
+        size = -(-len(answer) // chunk_count)
+        pieces = [answer[index:index + size] for index in range(0, len(answer), size)] or ['']
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        # Time to first token is about a third of the full latency
+        time.sleep(delay / 3)
+        for index, piece in enumerate(pieces):
+            last = index == len(pieces) - 1
+            element = json.dumps(_response_chunk(piece, prompt_tokens, output_tokens if last else 0, finished=last))
+            data = ('[' if index == 0 else ',') + element + (']' if last else '')
+            self._write_chunk(data.encode())
+            if not last:
+                time.sleep(delay * 2 / 3 / len(pieces))
+        self._write_chunk(b'')
+
+    def _write_chunk(self, data):
+        self.wfile.write(f'{len(data):X}\r\n'.encode() + data + b'\r\n')
+        self.wfile.flush()
+
+def create_server(host='127.0.0.1', port=8765, **options):
+    """Build a threaded mock server; options are MockGeminiState arguments"""
+    state = MockGeminiState(**options)
+    handler = type('BoundMockGeminiHandler', (MockGeminiHandler,), {'state': state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.state = state
+    return server
+
+def start_in_background(host='127.0.0.1', port=0, **options):
+    """Start the mock server on a daemon thread; returns (server, endpoint URL)"""
+    server = create_server(host, port, **options)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f'http://{host}:{server.server_address[1]}'
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock Gemini API for offline benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=800)
+    parser.add_argument('--jitter-ms', type=float, default=200)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 429')
+    parser.add_argument('--rpm-per-key', type=int, default=0, help='429 once a key exceeds this many requests per minute')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='fraction of requests that stall for --slow-ms')
+    parser.add_argument('--slow-ms', type=float, default=10000)
+    parser.add_argument('--defect-rate', type=float, default=0.0,
+                        help='fraction of extraction answers that are fenced, truncated or missing fields')
+    parser.add_argument('--response-file', help='JSON object with the canned field values')
+    parser.add_argument('--no-echo', action='store_true', help='always answer the canned values')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    canned_fields = None
+    if args.response_file:
+        with open(args.response_file, 'r', encoding='utf-8') as f:
+            canned_fields = json.load(f)
+
+    server = create_server(
+        args.host, args.port,
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+        rpm_per_key=args.rpm_per_key, canned_fields=canned_fields,
+        echo_fields=not args.no_echo, seed=args.seed,
+        slow_rate=args.slow_rate, slow_ms=args.slow_ms, defect_rate=args.defect_rate
+    )
+    print(f"Mock Gemini API listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
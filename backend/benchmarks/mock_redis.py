@@ -0,0 +1,223 @@
+"""
+Local stand-in for Redis, speaking enough of the protocol (RESP2) for the
+key state backend: GET, MGET, SET, DEL, WATCH/MULTI/EXEC and a few
+connection commands. Optimistic transactions behave like Redis: EXEC
+returns nil when a watched key changed after WATCH. Point the app at it
+with:
+
+    KEY_STATE_BACKEND=redis://127.0.0.1:6390/0
+
+Run standalone:  python -m benchmarks.mock_redis --port 6390
+"""
+import argparse
+import threading
+import socketserver
+
+class MockRedisState:
+    """The keyspace and counters shared by all connections"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.versions = {}  # key -> number of writes, for WATCH
+        self.commands = 0
+        self.transactions = 0
+        self.conflicts = 0
+
+    def write(self, key, value):
+        """Set (or delete, for None) a key; the caller holds the lock"""
+        if value is None:
+            existed = self.values.pop(key, None) is not None
+        else:
+            self.values[key] = value
+            existed = True
+        self.versions[key] = self.versions.get(key, 0) + 1
+        return existed
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'keys': len(self.values),
+                'commands': self.commands,
+                'transactions': self.transactions,
+                'conflicts': self.conflicts
+            }
+
+class _Status(str):
+    """A simple string reply (+OK) rather than a bulk string"""
+
+class _Error(Exception):
+    """An error reply (-ERR ...)"""
+
+def _encode(reply):
+    if isinstance(reply, _Error):
+        return f'-ERR {reply}\r\n'.encode()
+    if isinstance(reply, _Status):
+        return f'+{reply}\r\n'.encode()
+    if reply is None:
+        return b'$-1\r\n'
+    if isinstance(reply, int):
+        return f':{reply}\r\n'.encode()
+    if isinstance(reply, bytes):
+        return f'${len(reply)}\r\n'.encode() + reply + b'\r\n'
+    if isinstance(reply, list):
+        return f'*{len(reply)}\r\n'.encode() + b''.join(_encode(item) for item in reply)
+    raise TypeError(f"Cannot encode {reply!r}")
+
+class MockRedisHandler(socketserver.StreamRequestHandler):
+    """One client connection: reads commands and keeps its WATCH/MULTI state"""
+
+    state = None  # set on the bound subclass
+
+    def handle(self):
+        self.watched = {}  # key -> version seen at WATCH
+        self.queued = None  # commands after MULTI, None outside a transaction
+        while True:
+            try:
+                args = self._read_command()
+            except (ConnectionError, ValueError):
+                return
+            if args is None:
+                return
+            try:
+                reply = self._dispatch(args)
+            except _Error as e:
+                reply = e
+            try:
+                self.wfile.write(_encode(reply))
+                self.wfile.flush()
+            except OSError:
+                return
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            # Inline command (e.g. typed into telnet)
+            return line.split()
+        args = []
+        for _ in range(int(line[1:-2])):
+            header = self.rfile.readline()
+            if not header.startswith(b'$'):
+                raise ValueError("Expected a bulk string")
+            data = self.rfile.read(int(header[1:-2]) + 2)
+            args.append(data[:-2])
+        return args
+
+    def _dispatch(self, args):
+        if not args:
+            raise _Error("empty command")
+        name = args[0].upper().decode()
+        state = self.state
+        with state.lock:
+            state.commands += 1
+
+        if self.queued is not None and name not in ('EXEC', 'DISCARD', 'MULTI', 'WATCH'):
+            self.queued.append((name, args[1:]))
+            return _Status('QUEUED')
+        if name == 'MULTI':
+            if self.queued is not None:
+                raise _Error("MULTI calls can not be nested")
+            self.queued = []
+            return _Status('OK')
+        if name == 'DISCARD':
+            if self.queued is None:
+                raise _Error("DISCARD without MULTI")
+            self.queued = None
+            self.watched = {}
+            return _Status('OK')
+        if name == 'EXEC':
+            return self._exec()
+        if name == 'WATCH':
+            if self.queued is not None:
+                raise _Error("WATCH inside MULTI is not allowed")
+            with state.lock:
+                for key in args[1:]:
+                    self.watched.setdefault(key, state.versions.get(key, 0))
+            return _Status('OK')
+        if name == 'UNWATCH':
+            self.watched = {}
+            return _Status('OK')
+        with state.lock:
+            return self._run(name, args[1:])
+
+    def _exec(self):
+        if self.queued is None:
+            raise _Error("EXEC without MULTI")
+        queued, watched = self.queued, self.watched
+        self.queued, self.watched = None, {}
+        state = self.state
+        with state.lock:
+            state.transactions += 1
+            if any(state.versions.get(key, 0) != version for key, version in watched.items()):
+                state.conflicts += 1
+                return None
+            replies = []
+            for name, args in queued:
+                try:
+                    replies.append(self._run(name, args))
+                except _Error as e:
+                    replies.append(e)
+            return replies
+
+    def _run(self, name, args):
+        """Execute a data or connection command (state lock held)"""
+        state = self.state
+        if name == 'PING':
+            return args[0] if args else _Status('PONG')
+        if name in ('AUTH', 'SELECT'):
+            return _Status('OK')
+        if name == 'GET':
+            return state.values.get(args[0])
+        if name == 'MGET':
+            return [state.values.get(key) for key in args]
+        if name == 'SET':
+            if len(args) != 2:
+                raise _Error("only SET key value is supported")
+            state.write(args[0], args[1])
+            return _Status('OK')
+        if name == 'DEL':
+            return sum(state.write(key, None) for key in args)
+        if name == 'FLUSHDB':
+            for key in list(state.values):
+                state.write(key, None)
+            return _Status('OK')
+        if name == 'DBSIZE':
+            return len(state.values)
+        raise _Error(f"unknown command '{name}'")
+
+class MockRedisServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+def create_server(host='127.0.0.1', port=6390):
+    """Build a threaded mock server with its own empty keyspace"""
+    state = MockRedisState()
+    handler = type('BoundMockRedisHandler', (MockRedisHandler,), {'state': state})
+    server = MockRedisServer((host, port), handler)
+    server.state = state
+    return server
+
+def start_in_background(host='127.0.0.1', port=0):
+    """Start the mock server on a daemon thread; returns (server, redis:// URL)"""
+    server = create_server(host, port)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f'redis://{host}:{server.server_address[1]}/0'
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock Redis for the shared key state backend')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6390)
+    args = parser.parse_args()
+
+    server = create_server(args.host, args.port)
+    print(f"Mock Redis listening on redis://{args.host}:{args.port}/0")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
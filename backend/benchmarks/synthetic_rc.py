@@ -0,0 +1,188 @@
+"""
+Synthetic Rate Confirmation PDFs in several sizes and layouts, written
+with a minimal PDF writer (no extra dependencies). Every document comes
+with its ground-truth field values.
+
+    python -m benchmarks.synthetic_rc --out benchmarks/data --count 20
+"""
+import os
+import json
+import random
+import argparse
+
+LAYOUTS = ('labelled', 'table', 'two_column')
+
+# Page counts for the size classes used by the benchmarks
+SIZES = {'small': 1, 'medium': 4, 'large': 12, 'xlarge': 40}
+
+BROKERS = ['Summit Freight Brokerage', 'Blue Lane Logistics', 'Northstar Transport Group', 'Keystone Carriers Exchange']
+CARRIERS = ['Rolling Thunder Trucking', 'Prairie Wind Express', 'Coastal Haulers LLC', 'Iron Horse Freight']
+CITIES = [
+    ('Dallas', 'TX', '75201'), ('Atlanta', 'GA', '30301'), ('Chicago', 'IL', '60601'),
+    ('Denver', 'CO', '80202'), ('Memphis', 'TN', '38103'), ('Columbus', 'OH', '43215'),
+    ('Phoenix', 'AZ', '85004'), ('Laredo', 'TX', '78040')
+]
+STREETS = ['Industrial Pkwy', 'Commerce Dr', 'Distribution Way', 'Logistics Blvd', 'Warehouse Rd']
+COMMODITIES = ['Packaged food', 'Auto parts', 'Paper products', 'Beverages', 'Building materials']
+EQUIPMENT = ["Dry Van 53'", "Reefer 53'", "Flatbed 48'"]
+
+TERMS = [
+    'Carrier agrees to the terms of the broker-carrier agreement on file.',
+    'Detention is paid after 2 hours at 50.00 per hour with signed in/out times.',
+    'Lumper fees are reimbursed only with an original receipt.',
+    'Driver must check call every 4 hours and on arrival at each stop.',
+    'Late delivery may result in a rate reduction as agreed by the shipper.',
+    'No double brokering. Violations result in forfeiture of payment.',
+    'Seal numbers must be recorded on the bill of lading.',
+    'Temperature must be maintained continuously for reefer loads.'
+]
+
+def random_fields(rng):
+    """Ground-truth values for one synthetic RC"""
+    pickup_city, delivery_city = rng.sample(CITIES, 2)
+    month, day = rng.randint(1, 12), rng.randint(1, 27)
+    return {
+        'broker_name': f"{rng.choice(BROKERS)}, ({rng.randint(200, 999)}) 555-{rng.randint(1000, 9999)}",
+        'carrier_name': f"{rng.choice(CARRIERS)}, MC {rng.randint(100000, 999999)}",
+        'load_number': f"LD{rng.randint(1000000, 9999999)}",
+        'pickup_number': f"PU{rng.randint(10000, 99999)}",
+        'rate': f"{rng.randint(800, 6000)}.00",
+        'distance': str(rng.randint(150, 2200)),
+        'pickup_address': f"{rng.randint(100, 9999)} {rng.choice(STREETS)}, {pickup_city[0]}, {pickup_city[1]} {pickup_city[2]}",
+        'pickup_time': f"{month:02d}/{day:02d}/2025 {rng.randint(6, 11):02d}:00 Appointment",
+        'delivery_address': f"{rng.randint(100, 9999)} {rng.choice(STREETS)}, {delivery_city[0]}, {delivery_city[1]} {delivery_city[2]}",
+        'delivery_time': f"{month:02d}/{day + 1:02d}/2025 {rng.randint(12, 18):02d}:00 FCFS",
+        'commodity': rng.choice(COMMODITIES),
+        'weight': str(rng.randint(8000, 44000)),
+        'equipment': rng.choice(EQUIPMENT),
+        'notes': rng.choice(TERMS[1:4])
+    }
+
+def _first_page_lines(fields, layout):
+    """(x, y, size, text) drawing commands for the page with the load details"""
+    lines = [(50, 750, 16, 'RATE CONFIRMATION'), (50, 730, 10, f"Broker: {fields['broker_name']}")]
+    if layout == 'labelled':
+        rows = [
+            ('Carrier', fields['carrier_name']), ('Load Number', fields['load_number']),
+            ('Pickup Number', fields['pickup_number']), ('Total Rate', f"${fields['rate']}"),
+            ('Miles', fields['distance']), ('Shipper', fields['pickup_address']),
+            ('Pickup Date', fields['pickup_time']), ('Consignee', fields['delivery_address']),
+            ('Delivery Date', fields['delivery_time']), ('Commodity', fields['commodity']),
+            ('Weight', f"{fields['weight']} lbs"), ('Equipment', fields['equipment']),
+            ('Notes', fields['notes'])
+        ]
+        lines += [(50, 700 - index * 18, 10, f'{label}: {value}') for index, (label, value) in enumerate(rows)]
+    elif layout == 'table':
+        lines += [
+            (50, 700, 10, f"Carrier: {fields['carrier_name']}"),
+            (50, 680, 10, 'Load #        PU #        Rate        Miles        Weight        Equipment'),
+            (50, 665, 10, f"{fields['load_number']}    {fields['pickup_number']}    ${fields['rate']}    "
+                          f"{fields['distance']}    {fields['weight']}    {fields['equipment']}"),
+            (50, 635, 10, 'STOP 1 - PICKUP'), (50, 620, 10, fields['pickup_address']), (50, 605, 10, fields['pickup_time']),
+            (50, 580, 10, 'STOP 2 - DELIVERY'), (50, 565, 10, fields['delivery_address']), (50, 550, 10, fields['delivery_time']),
+            (50, 525, 10, f"Commodity: {fields['commodity']}"), (50, 505, 10, f"Special instructions: {fields['notes']}")
+        ]
+    else:
+        left = [
+            ('Load #', fields['load_number']), ('PU #', fields['pickup_number']),
+            ('Line Haul', f"${fields['rate']}"), ('Distance', f"{fields['distance']} mi"),
+            ('Weight', fields['weight'])
+        ]
+        right = [
+            ('Origin', fields['pickup_address']), ('Ready', fields['pickup_time']),
+            ('Destination', fields['delivery_address']), ('Due', fields['delivery_time']),
+            ('Trailer', fields['equipment'])
+        ]
+        lines.append((50, 705, 10, f"Carrier: {fields['carrier_name']}"))
+        lines += [(50, 680 - index * 18, 10, f'{label}: {value}') for index, (label, value) in enumerate(left)]
+        lines += [(300, 680 - index * 18, 9, f'{label}: {value}') for index, (label, value) in enumerate(right)]
+        lines += [(50, 570, 10, f"Commodity: {fields['commodity']}"), (50, 550, 10, f"Notes: {fields['notes']}")]
+    return lines
+
+def _terms_page_lines(rng, page_number, page_count):
+    lines = [(50, 750, 12, 'TERMS AND CONDITIONS')]
+    y = 725
+    while y > 80:
+        lines.append((50, y, 9, f'{rng.randint(1, 40)}. {rng.choice(TERMS)}'))
+        y -= 14
+    lines.append((280, 40, 8, f'Page {page_number} of {page_count}'))
+    return lines
+
+def _escape(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+def write_pdf(path, pages):
+    """Write a PDF whose pages are lists of (x, y, size, text) commands"""
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>', None, '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    page_ids = []
+    for lines in pages:
+        stream = '\n'.join(
+            f'BT /F1 {size} Tf {x} {y} Td ({_escape(text)}) Tj ET' for x, y, size, text in lines
+        )
+        objects.append(f'<< /Length {len(stream.encode("latin-1"))} >>\nstream\n{stream}\nendstream')
+        content_id = len(objects)
+        objects.append(
+            f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+            f'/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>'
+        )
+        page_ids.append(len(objects))
+    objects[1] = f'<< /Type /Pages /Kids [{" ".join(f"{page_id} 0 R" for page_id in page_ids)}] /Count {len(page_ids)} >>'
+
+    output = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += f'{number} 0 obj\n{body}\nendobj\n'.encode('latin-1')
+    xref_offset = len(output)
+    output += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode()
+    output += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets).encode()
+    output += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n'.encode()
+
+    with open(path, 'wb') as f:
+        f.write(output)
+
+def generate_rc(path, size='small', layout='labelled', seed=None):
+    """Write one synthetic RC; returns its ground-truth fields"""
+    rng = random.Random(seed)
+    fields = random_fields(rng)
+    page_count = SIZES[size]
+    pages = [_first_page_lines(fields, layout)]
+    pages += [_terms_page_lines(rng, number, page_count) for number in range(2, page_count + 1)]
+    write_pdf(path, pages)
+    return fields
+
+def generate_corpus(out_dir, count=20, sizes=None, layouts=LAYOUTS, seed=1):
+    """
+    Write count documents cycling through sizes and layouts.
+    Returns a list of {path, size, layout, fields} and writes manifest.json.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    sizes = sizes or list(SIZES)
+    documents = []
+    for index in range(count):
+        size = sizes[index % len(sizes)]
+        layout = layouts[(index // len(sizes)) % len(layouts)]
+        path = os.path.join(out_dir, f'rc_{index:04d}_{size}_{layout}.pdf')
+        fields = generate_rc(path, size, layout, seed=seed * 100003 + index)
+        documents.append({'path': path, 'size': size, 'layout': layout, 'fields': fields})
+
+    with open(os.path.join(out_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(documents, f, indent=2)
+    return documents
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic RC PDFs')
+    parser.add_argument('--out', default='benchmarks/data')
+    parser.add_argument('--count', type=int, default=20)
+    parser.add_argument('--sizes', default=','.join(SIZES), help=f'comma separated, from {", ".join(SIZES)}')
+    parser.add_argument('--layouts', default=','.join(LAYOUTS))
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    documents = generate_corpus(
+        args.out, args.count, args.sizes.split(','), tuple(args.layouts.split(',')), args.seed
+    )
+    print(f"Wrote {len(documents)} documents to {args.out}")
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,8 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY', 'dev-secret-key')
     UPLOAD_FOLDER = 'uploads'
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024
+    # Single-document uploads are processed in memory; larger ones spill to a temp file
+    UPLOAD_SPILL_THRESHOLD = int(os.environ.get('UPLOAD_SPILL_THRESHOLD', 4 * 1024 * 1024))
     
     # Multiple API keys
     GOOGLE_AI_KEYS = [
@@ -22,6 +24,174 @@ class Config:
     # Rate limiting settings
     RATE_LIMIT_REQUESTS = 60  # requests per minute per key
     RATE_LIMIT_TOKENS = 1000000  # tokens per minute per key
+    # Where per-key quota state lives: memory:// (one process),
+    # sqlite:///cache/key_state.db (workers on one host) or redis://host:6379/0 (many hosts)
+    KEY_STATE_BACKEND = os.environ.get('KEY_STATE_BACKEND', 'memory://')
+    KEY_WAIT_TIMEOUT = float(os.environ.get('KEY_WAIT_TIMEOUT', 10))  # seconds to wait for key capacity
+    KEY_ERROR_LIMIT = int(os.environ.get('KEY_ERROR_LIMIT', 5))  # consecutive errors before a key is disabled
+    KEY_ERROR_COOLDOWN = int(os.environ.get('KEY_ERROR_COOLDOWN', 300))  # seconds a disabled key rests
+    AI_EXPECTED_OUTPUT_TOKENS = 500  # reserved per call on top of the prompt
+    
+    # Gemini models. GEMINI_MODEL answers when routing is off (and OCR); its
+    # per-key budget is RATE_LIMIT_*. With routing, documents are scored by
+    # length, pages, OCR, tables and stops: easy ones start on the first
+    # (fastest) tier, the rest on the second, and answers that fail or look
+    # unreliable move up a tier. Tiers are "model|requests/min|tokens/min",
+    # limits defaulting to RATE_LIMIT_*.
+    GEMINI_MODEL = os.environ.get('GEMINI_MODEL', 'models/gemini-1.5-flash-latest')
+    MODEL_ROUTING_ENABLED = os.environ.get('MODEL_ROUTING_ENABLED', 'True').lower() == 'true'
+    GEMINI_MODEL_TIERS = os.environ.get(
+        'GEMINI_MODEL_TIERS',
+        'models/gemini-1.5-flash-8b-latest,models/gemini-1.5-flash-latest,models/gemini-1.5-pro-latest|2|32000'
+    )
+    MODEL_ROUTER_EASY_MAX_SCORE = float(os.environ.get('MODEL_ROUTER_EASY_MAX_SCORE', 1.0))  # below: first tier
+    MODEL_ROUTER_MIN_CONFIDENCE = float(os.environ.get('MODEL_ROUTER_MIN_CONFIDENCE', 0.6))  # below: next tier
+    MODEL_ROUTER_TIER_ATTEMPTS = int(os.environ.get('MODEL_ROUTER_TIER_ATTEMPTS', 2))  # before escalating on errors
+    
+    # Gemini call timeouts and hedging (a duplicate call on another key when one is slow)
+    GEMINI_ATTEMPT_TIMEOUT = float(os.environ.get('GEMINI_ATTEMPT_TIMEOUT', 30))  # seconds per call
+    AI_DEADLINE = float(os.environ.get('AI_DEADLINE', 60))  # seconds for all attempts of one request
+    HEDGING_ENABLED = os.environ.get('HEDGING_ENABLED', 'False').lower() == 'true'
+    HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', 0.95))  # hedge calls slower than this
+    HEDGE_DEFAULT_DELAY = float(os.environ.get('HEDGE_DEFAULT_DELAY', 3.0))  # seconds, until latencies are known
+    HEDGE_MIN_DELAY = float(os.environ.get('HEDGE_MIN_DELAY', 0.5))
+    HEDGE_MAX_EXTRA = int(os.environ.get('HEDGE_MAX_EXTRA', 1))  # duplicate calls per request
+    HEDGE_MIN_SPARE_REQUESTS = int(os.environ.get('HEDGE_MIN_SPARE_REQUESTS', 2))  # free key requests needed to hedge
+    HEDGE_WORKERS = int(os.environ.get('HEDGE_WORKERS', 32))
+    
+    # AI answer handling: Gemini JSON mode with a response schema, tolerant
+    # parsing, and a small follow-up prompt for fields an answer left out
+    AI_JSON_MODE = os.environ.get('AI_JSON_MODE', 'True').lower() == 'true'
+    AI_FOLLOWUP_ENABLED = os.environ.get('AI_FOLLOWUP_ENABLED', 'True').lower() == 'true'
+    AI_FOLLOWUP_TOKEN_BUDGET = int(os.environ.get('AI_FOLLOWUP_TOKEN_BUDGET', 1500))  # document tokens in a follow-up
+    
+    # Result cache (raw AI extraction keyed on file hash)
+    CACHE_ENABLED = os.environ.get('CACHE_ENABLED', 'True').lower() == 'true'
+    CACHE_DB_PATH = os.environ.get('CACHE_DB_PATH', 'cache/results.db')
+    CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 1000))
+    CACHE_TTL_SECONDS = int(os.environ.get('CACHE_TTL_SECONDS', 7 * 24 * 3600))
+
+    # Near-duplicate RCs (revised versions of an analyzed RC re-extract only changed fields)
+    NEAR_DUP_ENABLED = os.environ.get('NEAR_DUP_ENABLED', 'True').lower() == 'true'
+    NEAR_DUP_DB_PATH = os.environ.get('NEAR_DUP_DB_PATH', 'cache/near_duplicates.db')
+    NEAR_DUP_MAX_ENTRIES = int(os.environ.get('NEAR_DUP_MAX_ENTRIES', 5000))
+    NEAR_DUP_TTL_SECONDS = int(os.environ.get('NEAR_DUP_TTL_SECONDS', CACHE_TTL_SECONDS))
+    NEAR_DUP_MIN_SIMILARITY = float(os.environ.get('NEAR_DUP_MIN_SIMILARITY', 0.8))  # estimated Jaccard of shingles
+    NEAR_DUP_MAX_CHANGED_FIELDS = int(os.environ.get('NEAR_DUP_MAX_CHANGED_FIELDS', 5))  # more means a full extraction
+    NEAR_DUP_PERMUTATIONS = 128
+    NEAR_DUP_BANDS = 16  # 8 rows per band: pairs above ~0.7 similarity share a bucket
+    NEAR_DUP_SHINGLE_WORDS = 3
+
+    # PDF extraction
+    PDF_TEXT_CHAR_BUDGET = int(os.environ.get('PDF_TEXT_CHAR_BUDGET', 60000))  # prompt packing picks from this
+    PDF_PARALLEL_WORKERS = int(os.environ.get('PDF_PARALLEL_WORKERS', min(4, os.cpu_count() or 1)))
+    PDF_PARALLEL_MIN_PAGES = int(os.environ.get('PDF_PARALLEL_MIN_PAGES', 8))
+    PDF_PAGES_PER_CHUNK = int(os.environ.get('PDF_PAGES_PER_CHUNK', 4))
+    
+    # OCR for image uploads and scanned PDF pages without a text layer
+    OCR_ENABLED = os.environ.get('OCR_ENABLED', 'True').lower() == 'true'
+    OCR_ENGINE = os.environ.get('OCR_ENGINE', 'tesseract')  # 'tesseract' (local) or 'gemini' (inline image parts)
+    OCR_LANGUAGE = os.environ.get('OCR_LANGUAGE', 'eng')
+    OCR_DPI = int(os.environ.get('OCR_DPI', 300))  # rasterization resolution for scanned pages
+    OCR_MIN_PAGE_CHARS = int(os.environ.get('OCR_MIN_PAGE_CHARS', 20))  # less text than this = no text layer
+    OCR_MAX_PAGES = int(os.environ.get('OCR_MAX_PAGES', 5))  # RC details are on the first pages
+    OCR_MAX_IMAGE_SIDE = int(os.environ.get('OCR_MAX_IMAGE_SIDE', 3500))  # phone photos are downscaled to this
+    OCR_WORKERS = int(os.environ.get('OCR_WORKERS', min(4, os.cpu_count() or 1)))
+    OCR_CACHE_DB_PATH = os.environ.get('OCR_CACHE_DB_PATH', 'cache/ocr_pages.db')
+    GEMINI_IMAGE_TOKENS = 258  # what Gemini bills for one image part
+    
+    # Gemini client transport for the pooled per-key clients ('grpc' or 'rest')
+    GEMINI_TRANSPORT = os.environ.get('GEMINI_TRANSPORT', 'grpc')
+    # Override the API host, e.g. http://127.0.0.1:8765 for the benchmark mock server (with the 'rest' transport)
+    GEMINI_API_ENDPOINT = os.environ.get('GEMINI_API_ENDPOINT', '')
+    
+    # Model/key checks run on a background thread after the first request, never on import
+    STARTUP_CHECKS_ENABLED = os.environ.get('STARTUP_CHECKS_ENABLED', 'True').lower() == 'true'
+    STARTUP_CHECK_TIMEOUT = float(os.environ.get('STARTUP_CHECK_TIMEOUT', 10))  # seconds per key
+    
+    # Prompt compaction
+    PROMPT_TOKEN_BUDGET = int(os.environ.get('PROMPT_TOKEN_BUDGET', 4000))  # instructions + document text
+    # Budgets are checked against a chars-per-token estimate calibrated on the usage Gemini reports, so a
+    # packed prompt can run a little over. With exact counting on, prompts estimated within the margin of
+    # their budget are counted with Gemini's countTokens (one call per distinct prompt) and re-packed if over.
+    PROMPT_EXACT_TOKENS = os.environ.get('PROMPT_EXACT_TOKENS', 'False').lower() == 'true'
+    PROMPT_EXACT_TOKENS_MARGIN = float(os.environ.get('PROMPT_EXACT_TOKENS_MARGIN', 0.1))  # share of the budget
+    PROMPT_COUNT_TIMEOUT = float(os.environ.get('PROMPT_COUNT_TIMEOUT', 5))  # seconds per countTokens call
+    PROMPT_REPEATED_LINE_MIN = 3  # lines repeated this often are treated as headers/footers
+    
+    # Multi-document AI batching (several RCs per Gemini request)
+    AI_BATCHING_ENABLED = os.environ.get('AI_BATCHING_ENABLED', 'False').lower() == 'true'  # for /api/analyze
+    AI_BATCHING_FOR_JOBS = os.environ.get('AI_BATCHING_FOR_JOBS', 'True').lower() == 'true'  # for /api/batch
+    AI_BATCH_MAX_DOCUMENTS = int(os.environ.get('AI_BATCH_MAX_DOCUMENTS', 5))
+    AI_BATCH_MAX_WAIT_MS = int(os.environ.get('AI_BATCH_MAX_WAIT_MS', 250))
+    AI_BATCH_DOC_TOKEN_BUDGET = int(os.environ.get('AI_BATCH_DOC_TOKEN_BUDGET', 1500))
+    AI_BATCH_FLUSH_WORKERS = int(os.environ.get('AI_BATCH_FLUSH_WORKERS', 4))
+    AI_BATCH_RESULT_TIMEOUT = int(os.environ.get('AI_BATCH_RESULT_TIMEOUT', 300))
+    
+    # Local fast-path extraction (skips the AI when every field is confident)
+    FAST_PATH_ENABLED = os.environ.get('FAST_PATH_ENABLED', 'True').lower() == 'true'
+    FAST_PATH_MIN_CONFIDENCE = float(os.environ.get('FAST_PATH_MIN_CONFIDENCE', 0.85))
+    BROKER_TEMPLATES_PATH = os.environ.get('BROKER_TEMPLATES_PATH', 'broker_templates.json')
+    
+    # Layout templates learned from AI extractions
+    TEMPLATES_ENABLED = os.environ.get('TEMPLATES_ENABLED', 'True').lower() == 'true'
+    TEMPLATE_INDEX_PATH = os.environ.get('TEMPLATE_INDEX_PATH', 'cache/templates.db')  # SQLite, shared by workers
+    TEMPLATE_SYNC_SECONDS = float(os.environ.get('TEMPLATE_SYNC_SECONDS', 5))  # picks up other workers' templates
+    TEMPLATE_MAX_TEMPLATES = int(os.environ.get('TEMPLATE_MAX_TEMPLATES', 500))
+    TEMPLATE_MIN_SIMILARITY = float(os.environ.get('TEMPLATE_MIN_SIMILARITY', 0.7))
+    TEMPLATE_MIN_AGREEMENTS = int(os.environ.get('TEMPLATE_MIN_AGREEMENTS', 2))
+    TEMPLATE_HEADER_HEIGHT = 0.15  # top share of the first page used as header
+    TEMPLATE_BOX_TOLERANCE = 0.01  # in page-size units
+    TEMPLATE_COLUMN_GAP = 0.04  # a wider gap ends a text value read past its box
+    TEMPLATE_AUDIT_RATE = float(os.environ.get('TEMPLATE_AUDIT_RATE', 0.05))  # template answers re-checked by the AI
+    TEMPLATE_LAYOUT_PAGES = 1
+    
+    # Load history for lane analytics (columnar segments of analyzed RCs)
+    LOAD_HISTORY_ENABLED = os.environ.get('LOAD_HISTORY_ENABLED', 'True').lower() == 'true'
+    LOAD_HISTORY_DIR = os.environ.get('LOAD_HISTORY_DIR', 'cache/load_history')
+    LOAD_HISTORY_FLUSH_ROWS = int(os.environ.get('LOAD_HISTORY_FLUSH_ROWS', 100))
+    LOAD_HISTORY_FLUSH_SECONDS = int(os.environ.get('LOAD_HISTORY_FLUSH_SECONDS', 30))
+    LOAD_HISTORY_MAX_SEGMENTS = int(os.environ.get('LOAD_HISTORY_MAX_SEGMENTS', 32))  # merged beyond this
+    LOAD_HISTORY_MAX_ROWS = int(os.environ.get('LOAD_HISTORY_MAX_ROWS', 1000000))  # oldest loads dropped beyond this
+    
+    # Offline distance estimates from the bundled ZIP/city centroid tables
+    GEO_DATA_DIR = os.environ.get('GEO_DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+    GEO_ROAD_FACTOR = float(os.environ.get('GEO_ROAD_FACTOR', 1.2))  # road miles per great-circle mile
+    GEO_CACHE_SIZE = int(os.environ.get('GEO_CACHE_SIZE', 50000))  # memoized addresses and lanes
+    GEO_FILL_MISSING_DISTANCE = os.environ.get('GEO_FILL_MISSING_DISTANCE', 'True').lower() == 'true'
+    
+    # Batch analysis
+    BATCH_EXTRACT_WORKERS = int(os.environ.get('BATCH_EXTRACT_WORKERS', os.cpu_count() or 2))
+    BATCH_AI_WORKERS_PER_KEY = int(os.environ.get('BATCH_AI_WORKERS_PER_KEY', 2))
+    BATCH_MAX_FILES = int(os.environ.get('BATCH_MAX_FILES', 500))
+    BATCH_JOB_TTL_SECONDS = int(os.environ.get('BATCH_JOB_TTL_SECONDS', 3600))
+    BATCH_CAPACITY_WAIT_SECONDS = int(os.environ.get('BATCH_CAPACITY_WAIT_SECONDS', 120))
+    
+    # Admission control in front of document analysis: a bounded priority queue
+    # (interactive uploads ahead of batch jobs) that turns requests away
+    # with 429/503 and Retry-After when their deadline can't be met
+    ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', 'True').lower() == 'true'
+    ADMISSION_MAX_ACTIVE = int(os.environ.get('ADMISSION_MAX_ACTIVE', 16))  # documents with the AI at once
+    ADMISSION_MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE', 64))
+    ADMISSION_INTERACTIVE_SLOTS = int(os.environ.get('ADMISSION_INTERACTIVE_SLOTS', 4))  # never used by batch jobs
+    ADMISSION_INTERACTIVE_REQUESTS = int(os.environ.get('ADMISSION_INTERACTIVE_REQUESTS', 2))  # key requests batch jobs leave free
+    ADMISSION_INTERACTIVE_DEADLINE = float(os.environ.get('ADMISSION_INTERACTIVE_DEADLINE', 30))  # seconds
+    ADMISSION_BULK_DEADLINE = float(os.environ.get('ADMISSION_BULK_DEADLINE', BATCH_CAPACITY_WAIT_SECONDS))
+    ADMISSION_DEFAULT_SERVICE_SECONDS = float(os.environ.get('ADMISSION_DEFAULT_SERVICE_SECONDS', 3.0))  # until measured
+    ADMISSION_DEFAULT_RETRY_AFTER = int(os.environ.get('ADMISSION_DEFAULT_RETRY_AFTER', 30))  # when no key is usable
+    ADMISSION_POLL_SECONDS = 0.25
+    
+    # ASGI serving mode (asgi.py): analyses await Gemini on one event loop;
+    # text extraction runs in worker processes
+    ASYNC_EXTRACT_WORKERS = int(os.environ.get('ASYNC_EXTRACT_WORKERS', os.cpu_count() or 2))
+    ASYNC_REST_THREADS = int(os.environ.get('ASYNC_REST_THREADS', 64))  # REST transport only (no asyncio client)
+    ASYNC_MAX_ACTIVE = int(os.environ.get('ASYNC_MAX_ACTIVE', 256))  # admission slots, instead of ADMISSION_MAX_ACTIVE
+    
+    # Instrumentation
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'True').lower() == 'true'  # /api/metrics scrape endpoint
+    # Server-Timing header with per-stage durations on every response
+    # (clients can also ask for it per request with "X-Request-Timing: true")
+    TIMING_HEADER_ENABLED = os.environ.get('TIMING_HEADER_ENABLED', 'False').lower() == 'true'
     
     # Для CORS
     CORS_ORIGINS = [
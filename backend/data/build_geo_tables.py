@@ -0,0 +1,60 @@
+"""
+Rebuild the bundled ZIP and city centroid tables used by services/geo_distance.py.
+
+    pip install zipcodes   # build-time only
+    python data/build_geo_tables.py
+
+Writes one plain (uncompressed) .npy file per column next to this script,
+so the app can memory-map them and binary-search the sorted key columns
+in place:
+
+    zip_codes.npy    uint32, sorted     zip_points.npy   float32 (lat, lon)
+    zip_states.npy   'S2'
+    city_keys.npy    'S24' 'TX:DALLAS', sorted
+    city_points.npy  float32 (lat, lon)
+"""
+import os
+from collections import defaultdict
+import numpy as np
+import zipcodes
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def city_key(city, state):
+    """Lookup key for a city: 'TX:DALLAS' (truncated to the column width)"""
+    return f"{state.upper()}:{' '.join(city.upper().split())}"[:24].encode('ascii', 'ignore')
+
+def main():
+    zips = []
+    cities = defaultdict(list)
+    for record in zipcodes.list_all():
+        # Military ZIPs point at APO/FPO gateways, not at a place a truck can drive to
+        if record['zip_code_type'] == 'MILITARY' or not record.get('lat'):
+            continue
+        lat, lon = float(record['lat']), float(record['long'])
+        zips.append((int(record['zip_code']), lat, lon, record['state'].encode('ascii')))
+        # City centroids come from street-delivery ZIPs when the city has any
+        weight = 1 if record['zip_code_type'] == 'STANDARD' else 0
+        for city in [record['city']] + record.get('acceptable_cities', []):
+            cities[city_key(city, record['state'])].append((weight, lat, lon))
+
+    zips.sort()
+    columns = {
+        'zip_codes': np.array([row[0] for row in zips], dtype='<u4'),
+        'zip_points': np.array([(row[1], row[2]) for row in zips], dtype='<f4'),
+        'zip_states': np.array([row[3] for row in zips], dtype='S2')
+    }
+
+    city_rows = []
+    for key, points in sorted(cities.items()):
+        standard = [point for point in points if point[0]] or points
+        city_rows.append((key, np.mean([point[1] for point in standard]), np.mean([point[2] for point in standard])))
+    columns['city_keys'] = np.array([row[0] for row in city_rows], dtype='S24')
+    columns['city_points'] = np.array([(row[1], row[2]) for row in city_rows], dtype='<f4')
+
+    for name, array in columns.items():
+        np.save(os.path.join(DATA_DIR, f'{name}.npy'), array)
+    print(f"Wrote {len(zips)} ZIP and {len(city_rows)} city centroids to {DATA_DIR}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,351 @@
+import math
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from config import Config
+from services.key_manager import key_manager
+from services.model_router import model_router
+from services.hedging import LatencyTracker
+from services.metrics import admission_decisions_total, admission_wait_seconds
+
+# Priority classes, most urgent first: single uploads a dispatcher is
+# waiting on, then background batch jobs
+PRIORITIES = {'interactive': 0, 'bulk': 1}
+
+class AdmissionRejected(Exception):
+    """A request turned away before its analysis started; status is 429 or 503"""
+
+    def __init__(self, message, status=503, retry_after=1, reason='overloaded'):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+class _Ticket:
+    """One request waiting for (or holding) an analysis slot"""
+
+    def __init__(self, priority, deadline):
+        self.priority = priority
+        self.rank = PRIORITIES[priority]
+        self.deadline = deadline
+        self.enqueued_at = time.monotonic()
+        self.admitted_at = None
+        self.rejection = None
+
+class AdmissionController:
+    """
+    Bounded, prioritized entry to the AI calls of document analysis. At
+    most ADMISSION_MAX_ACTIVE documents are with the AI at once, and
+    bulk work may only use the slots and key requests interactive uploads
+    don't have reserved. Waiting requests are served by priority, then in
+    arrival order. A request whose estimated wait (from queue position,
+    recent service times and the key capacity APIKeyManager reports for
+    the models the router sends calls to) can't meet its class deadline is
+    turned away at once with a Retry-After, and a full queue sheds its
+    newest bulk waiter to make room for an upload. Key state is read
+    without the condition held, since its backend may be SQLite or Redis.
+    """
+
+    def __init__(self, max_active, max_queue, interactive_slots, interactive_requests):
+        self.max_active = max(1, max_active)
+        self.max_queue = max_queue
+        # Slots and key requests bulk work leaves free for interactive uploads
+        self.interactive_slots = min(interactive_slots, self.max_active - 1)
+        self.interactive_requests = interactive_requests
+        self.condition = threading.Condition()
+        self.queue = []  # heap of (rank, sequence, ticket)
+        self.sequence = itertools.count()
+        self.active = {priority: 0 for priority in PRIORITIES}
+        self.async_waiters = set()  # (event loop, asyncio.Event) of queued coroutines
+        self.service_times = LatencyTracker(min_samples=5)
+        self.counts = {
+            priority: {'admitted': 0, 'rejected_overloaded': 0, 'rejected_rate_limited': 0,
+                       'shed': 0, 'timed_out': 0}
+            for priority in PRIORITIES
+        }
+
+    def configure(self, max_active):
+        """Change the number of analysis slots (the ASGI app holds many more than a thread pool can)"""
+        with self.condition:
+            self.max_active = max(1, max_active)
+            self.interactive_slots = min(self.interactive_slots, self.max_active - 1)
+            self._notify()
+
+    def _deadline(self, priority):
+        return Config.ADMISSION_INTERACTIVE_DEADLINE if priority == 'interactive' else Config.ADMISSION_BULK_DEADLINE
+
+    def _slot_limit(self, priority):
+        return self.max_active if priority == 'interactive' else self.max_active - self.interactive_slots
+
+    def _service_time(self):
+        observed = self.service_times.percentile(0.5)
+        return observed if observed is not None else Config.ADMISSION_DEFAULT_SERVICE_SECONDS
+
+    def _ahead(self, rank):
+        """Queued requests that would be served before a new one of this rank"""
+        return sum(1 for queued_rank, _, _ in self.queue if queued_rank <= rank)
+
+    def _queued_ahead(self, priority):
+        with self.condition:
+            return self._ahead(PRIORITIES[priority])
+
+    def _key_wait(self, priority, ahead):
+        """
+        Seconds until the keys could serve a new request and those ahead of
+        it on every model the router sends calls to, each model getting its
+        share of them (see ModelRouter.demand). None when there are no keys.
+        Reads the key state backend: call it without the condition held.
+        """
+        reserve = self.interactive_requests if priority == 'bulk' else 0
+        requests = ahead + 1 + reserve
+        waits = [key_manager.estimate_wait(requests * share, model=model) for model, share in model_router.demand()]
+        return None if None in waits else max(waits)
+
+    def _keys_free(self, priority):
+        """
+        Whether bulk work may take key requests now: a few stay free on
+        every routed model so an upload never waits behind a bulk import.
+        Reads the key state backend: call it without the condition held.
+        """
+        if priority != 'bulk' or not self.interactive_requests:
+            return True
+        return all(
+            key_manager.get_available_capacity(model) > self.interactive_requests * share
+            for model, share in model_router.demand()
+        )
+
+    def _needs_key_check(self, priority):
+        return priority == 'bulk' and self.interactive_requests > 0
+
+    def _estimate(self, priority, ahead, key_wait):
+        """(seconds until a new request would start, whether key quota is the limit) given the key wait"""
+        limit = self._slot_limit(priority)
+        busy = sum(self.active.values())
+        slot_wait = 0.0
+        if ahead or busy >= limit:
+            # Every `limit` requests ahead take about one service time
+            slot_wait = math.ceil((ahead + 1 + max(0, busy - limit)) / limit) * self._service_time()
+        if key_wait is None:
+            return None, True
+        return max(slot_wait, key_wait), key_wait > slot_wait
+
+    def _reject(self, priority, wait, rate_limited):
+        if wait is None:
+            self._count(priority, 'rejected_overloaded')
+            return AdmissionRejected(
+                "No API keys are available. Please try again later.",
+                status=503, retry_after=Config.ADMISSION_DEFAULT_RETRY_AFTER, reason='no_keys'
+            )
+        retry_after = max(1, math.ceil(wait))
+        if rate_limited:
+            self._count(priority, 'rejected_rate_limited')
+            return AdmissionRejected(
+                f"All API keys are busy. Please try again in {retry_after}s.",
+                status=429, retry_after=retry_after, reason='rate_limited'
+            )
+        self._count(priority, 'rejected_overloaded')
+        return AdmissionRejected(
+            f"Server is busy. Please try again in {retry_after}s.",
+            status=503, retry_after=retry_after, reason='overloaded'
+        )
+
+    def _enqueue(self, priority, deadline, key_wait):
+        """Estimate, shed if needed and queue a ticket (condition held); raises AdmissionRejected"""
+        deadline = self._deadline(priority) if deadline is None else deadline
+        ticket = _Ticket(priority, time.monotonic() + deadline)
+        wait, rate_limited = self._estimate(priority, self._ahead(ticket.rank), key_wait)
+        if wait is None or wait + self._service_time() > deadline:
+            raise self._reject(priority, wait, rate_limited)
+        if len(self.queue) >= self.max_queue and not self._shed(ticket.rank):
+            raise self._reject(priority, max(wait, self._service_time()), False)
+        heapq.heappush(self.queue, (ticket.rank, next(self.sequence), ticket))
+        return ticket
+
+    def _try_start(self, ticket, keys_free=True):
+        """
+        Start a queued ticket if it is first in line, a slot is free and
+        keys_free (see _keys_free) allows it (condition held). Returns
+        seconds to wait before trying again, or None once started; raises
+        AdmissionRejected if it was shed or its deadline passed.
+        """
+        if ticket.rejection is not None:
+            raise ticket.rejection
+        if (self.queue[0][2] is ticket and keys_free
+                and sum(self.active.values()) < self._slot_limit(ticket.priority)):
+            heapq.heappop(self.queue)
+            ticket.admitted_at = time.monotonic()
+            self.active[ticket.priority] += 1
+            self._count(ticket.priority, 'admitted')
+            # The next waiter may be able to start too
+            self._notify()
+            return None
+        remaining = ticket.deadline - time.monotonic()
+        if remaining <= 0:
+            self._remove(ticket)
+            self._count(ticket.priority, 'timed_out')
+            self._notify()
+            raise AdmissionRejected(
+                "Server is busy. Please try again later.",
+                status=503, retry_after=max(1, math.ceil(self._service_time())), reason='timed_out'
+            )
+        # Bulk waiters also wait on key refills, which nothing signals
+        return min(remaining, Config.ADMISSION_POLL_SECONDS)
+
+    def acquire(self, priority='interactive', deadline=None):
+        """
+        Wait for an analysis slot; returns a ticket to release. Raises
+        AdmissionRejected when the deadline (seconds, the class default
+        if None) can't be met, the queue is full, or the ticket is shed.
+        """
+        key_wait = self._key_wait(priority, self._queued_ahead(priority))
+        with self.condition:
+            ticket = self._enqueue(priority, deadline, key_wait)
+        try:
+            while True:
+                keys_free = self._keys_free(priority)
+                with self.condition:
+                    wait = self._try_start(ticket, keys_free)
+                    if wait is None:
+                        break
+                    self.condition.wait(timeout=wait)
+        except BaseException:
+            self._abandon(ticket)
+            raise
+        admission_wait_seconds.observe(ticket.admitted_at - ticket.enqueued_at, priority=priority)
+        return ticket
+
+    async def acquire_async(self, priority='interactive', deadline=None):
+        """acquire for the event loop: queued requests wait without blocking a thread"""
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        waiter = (loop, wakeup)
+        key_wait = await asyncio.to_thread(self._key_wait, priority, self._queued_ahead(priority))
+        with self.condition:
+            ticket = self._enqueue(priority, deadline, key_wait)
+            self.async_waiters.add(waiter)
+        try:
+            while True:
+                keys_free = True
+                if self._needs_key_check(priority):
+                    keys_free = await asyncio.to_thread(self._keys_free, priority)
+                with self.condition:
+                    wakeup.clear()
+                    wait = self._try_start(ticket, keys_free)
+                if wait is None:
+                    break
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            # The client went away while queued
+            self._abandon(ticket)
+            raise
+        finally:
+            with self.condition:
+                self.async_waiters.discard(waiter)
+        admission_wait_seconds.observe(ticket.admitted_at - ticket.enqueued_at, priority=priority)
+        return ticket
+
+    def _notify(self):
+        """Wake queued waiters, threads and event loop tasks alike (condition held)"""
+        self.condition.notify_all()
+        for loop, wakeup in self.async_waiters:
+            loop.call_soon_threadsafe(wakeup.set)
+
+    def _abandon(self, ticket):
+        """Take a ticket that will not start off the queue"""
+        with self.condition:
+            if ticket.admitted_at is None and any(entry[2] is ticket for entry in self.queue):
+                self._remove(ticket)
+                self._notify()
+
+    def _shed(self, rank):
+        """Drop the newest waiter of a lower priority than rank; False if there is none"""
+        lower = [entry for entry in self.queue if entry[0] > rank]
+        if not lower:
+            return False
+        victim = max(lower, key=lambda queued: (queued[0], queued[1]))[2]
+        self._remove(victim)
+        self._count(victim.priority, 'shed')
+        victim.rejection = AdmissionRejected(
+            "Shed to make room for interactive requests. Please try again later.",
+            status=503, retry_after=max(1, math.ceil(self._service_time())), reason='shed'
+        )
+        self._notify()
+        return True
+
+    def _remove(self, ticket):
+        self.queue = [entry for entry in self.queue if entry[2] is not ticket]
+        heapq.heapify(self.queue)
+
+    def key_retry_after(self):
+        """Retry-After seconds for a request that ran out of key capacity after it was admitted"""
+        wait = self._key_wait('interactive', 0)
+        return Config.ADMISSION_DEFAULT_RETRY_AFTER if wait is None else max(1, math.ceil(wait))
+
+    def release(self, ticket):
+        with self.condition:
+            self.active[ticket.priority] -= 1
+            self._notify()
+        self.service_times.observe(time.monotonic() - ticket.admitted_at)
+
+    @contextmanager
+    def admit(self, priority='interactive', deadline=None):
+        """Hold an analysis slot for the block (a no-op when ADMISSION_ENABLED is off)"""
+        if not Config.ADMISSION_ENABLED:
+            yield
+            return
+        ticket = self.acquire(priority, deadline)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+    @asynccontextmanager
+    async def admit_async(self, priority='interactive', deadline=None):
+        """admit for coroutines"""
+        if not Config.ADMISSION_ENABLED:
+            yield
+            return
+        ticket = await self.acquire_async(priority, deadline)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+    def _count(self, priority, outcome):
+        # Called with the condition held
+        self.counts[priority][outcome] += 1
+        admission_decisions_total.inc(priority=priority, outcome=outcome)
+
+    def get_stats(self):
+        ahead = {priority: self._queued_ahead(priority) for priority in PRIORITIES}
+        key_waits = {priority: self._key_wait(priority, ahead[priority]) for priority in PRIORITIES}
+        with self.condition:
+            queued = {priority: 0 for priority in PRIORITIES}
+            for _, _, ticket in self.queue:
+                queued[ticket.priority] += 1
+            estimates = {}
+            for priority in PRIORITIES:
+                wait, _ = self._estimate(priority, ahead[priority], key_waits[priority])
+                estimates[priority] = round(wait, 2) if wait is not None else None
+            return {
+                'enabled': Config.ADMISSION_ENABLED,
+                'max_active': self.max_active,
+                'max_queue': self.max_queue,
+                'active': dict(self.active),
+                'queued': queued,
+                'estimated_wait': estimates,
+                'service_time': self.service_times.summary(),
+                'counts': {priority: dict(counts) for priority, counts in self.counts.items()}
+            }
+
+# Global instance
+admission_controller = AdmissionController(
+    Config.ADMISSION_MAX_ACTIVE, Config.ADMISSION_MAX_QUEUE,
+    Config.ADMISSION_INTERACTIVE_SLOTS, Config.ADMISSION_INTERACTIVE_REQUESTS
+)
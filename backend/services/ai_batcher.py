@@ -0,0 +1,190 @@
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from config import Config
+from services.ai_processor import AIProcessor, RATE_LIMITED_ERROR
+from services.prompt_builder import PromptBuilder
+from services.response_schema import rc_response_schema
+from services.model_router import model_router
+from services.metrics import timed
+from utils.helpers import EXTRACTED_FIELDS
+
+class AIRequestBatcher:
+    """
+    Packs several short RC texts into one Gemini request. Documents queue up
+    until AI_BATCH_MAX_DOCUMENTS are waiting or the oldest has waited
+    AI_BATCH_MAX_WAIT_MS, then one prompt asks for a JSON array keyed by
+    document id. Documents missing or invalid in the answer are retried
+    individually; the rest of the batch is not repeated. If the batch call
+    itself fails (timeout, server error, an answer that can't be split),
+    every document is extracted on its own.
+    """
+
+    def __init__(self, max_documents=5, max_wait_seconds=0.25, max_document_tokens=1500):
+        self.max_documents = max_documents
+        self.max_wait_seconds = max_wait_seconds
+        self.max_document_tokens = max_document_tokens
+        self.pending = []
+        self.condition = threading.Condition()
+        self.lock = threading.Lock()
+        self._thread = None
+        self._flush_pool = None
+        self._processor = None
+        self.stats = {
+            'batches': 0,
+            'batched_documents': 0,
+            'single_documents': 0,
+            'retried_documents': 0,
+            'failed_batches': 0,
+            'fallback_documents': 0
+        }
+
+    def _get_processor(self):
+        with self.lock:
+            if self._processor is None:
+                self._processor = AIProcessor()
+            return self._processor
+
+    def _ensure_worker(self):
+        with self.lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._flush_pool = self._flush_pool or ThreadPoolExecutor(
+                    max_workers=Config.AI_BATCH_FLUSH_WORKERS, thread_name_prefix='ai-batch'
+                )
+                self._thread = threading.Thread(target=self._run, name='ai-batcher', daemon=True)
+                self._thread.start()
+
+    def extract_fields(self, text, timeout=None):
+        """
+        Extract raw RC fields, batching the request with other documents.
+        Long documents are sent on their own.
+        """
+        if PromptBuilder().estimate_document_tokens(text) > self.max_document_tokens:
+            self._count('single_documents')
+            return self._get_processor().extract_fields(text)
+
+        future = self.submit(text)
+        try:
+            return future.result(timeout=timeout or Config.AI_BATCH_RESULT_TIMEOUT)
+        except Exception as e:
+            return {"error": f"AI processing error: {str(e)}"}
+
+    def submit(self, text):
+        """Queue a document and return a Future for its raw extraction"""
+        future = Future()
+        self._ensure_worker()
+        with self.condition:
+            self.pending.append((text, future, time.time()))
+            self.condition.notify()
+        return future
+
+    def _run(self):
+        """Collect documents and flush on size or age"""
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                while len(self.pending) < self.max_documents:
+                    remaining = self.pending[0][2] + self.max_wait_seconds - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(timeout=remaining)
+                batch = self.pending[:self.max_documents]
+                del self.pending[:self.max_documents]
+
+            self._flush_pool.submit(self._flush, batch)
+
+    def _flush(self, batch):
+        try:
+            if len(batch) == 1:
+                text, future, _ = batch[0]
+                self._count('single_documents')
+                future.set_result(self._get_processor().extract_fields(text))
+                return
+
+            documents = [(f"D{index + 1}", text) for index, (text, _, _) in enumerate(batch)]
+            with timed('prompt_build'):
+                prompt, prompt_stats = PromptBuilder().build_batch(documents)
+            print(f"AI batch: {len(batch)} documents, ~{prompt_stats['estimated_tokens']} tokens")
+
+            processor = self._get_processor()
+            tier = model_router.route_many([text for _, text in documents])
+            deadline = time.monotonic() + Config.AI_DEADLINE
+            response = processor.generate(
+                prompt, self._parse_batch_response,
+                generation_config=processor.json_generation_config(rc_response_schema.gemini_batch_schema()),
+                model_name=tier.model, deadline=deadline
+            )
+            if 'error' in response:
+                self._count('failed_batches')
+                model_router.record_outcome(tier, answered=False, documents=len(batch))
+                if response['error'] == RATE_LIMITED_ERROR:
+                    # Separate calls would only queue for the same exhausted keys
+                    for _, future, _ in batch:
+                        future.set_result({'error': response['error']})
+                    return
+                print(f"AI batch failed ({response['error']}); extracting {len(batch)} documents one by one")
+                for text, future, _ in batch:
+                    self._count('fallback_documents')
+                    self._flush_pool.submit(self._extract_alone, text, future)
+                return
+
+            with self.lock:
+                self.stats['batches'] += 1
+                self.stats['batched_documents'] += len(batch)
+
+            results = response['documents']
+            for (document_id, text), (_, future, _) in zip(documents, batch):
+                result = results.get(document_id)
+                if self._is_valid(result):
+                    # Fields this document's answer left out are asked for on their own
+                    model_router.record_outcome(tier, answered=True)
+                    future.set_result(processor.complete_fields(
+                        text, result, model_name=tier.model, deadline=deadline
+                    ))
+                else:
+                    # Only this document is asked again, on its own (routed and escalated as usual)
+                    self._count('retried_documents')
+                    self._flush_pool.submit(self._extract_alone, text, future)
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_result({'error': f"AI processing error: {str(e)}"})
+
+    def _extract_alone(self, text, future):
+        """Extract one document of a batch with its own request (routed and escalated as usual)"""
+        try:
+            future.set_result(self._get_processor().extract_fields(text))
+        except Exception as e:
+            future.set_result({'error': f"AI processing error: {str(e)}"})
+
+    def _parse_batch_response(self, response_text):
+        """Split a JSON array answer into {document_id: fields}"""
+        return {'documents': rc_response_schema.parse_batch(response_text)}
+
+    def _is_valid(self, result):
+        if not isinstance(result, dict):
+            return False
+        present = len(EXTRACTED_FIELDS) - len(result.get('_missing', []))
+        return (
+            present >= len(EXTRACTED_FIELDS) // 2
+            and model_router.assess(result) >= Config.MODEL_ROUTER_MIN_CONFIDENCE
+        )
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = self.stats.copy()
+        with self.condition:
+            stats['pending'] = len(self.pending)
+        return stats
+
+# Global instance
+ai_batcher = AIRequestBatcher(
+    max_documents=Config.AI_BATCH_MAX_DOCUMENTS,
+    max_wait_seconds=Config.AI_BATCH_MAX_WAIT_MS / 1000.0,
+    max_document_tokens=Config.AI_BATCH_DOC_TOKEN_BUDGET
+)
@@ -1,119 +1,647 @@
-import google.generativeai as genai
 import os
-import json
-import re
+import time
+import asyncio
+import functools
+from concurrent.futures import wait, FIRST_COMPLETED
+import requests
 from google.api_core import exceptions
-from services.key_manager import key_manager
+from services.key_manager import key_manager, KeysExhausted
+from services.gemini_pool import gemini_pool
+from services.prompt_builder import PromptBuilder, OCR_PROMPT_INSTRUCTIONS, token_counter, followup_instructions
+from services.response_schema import rc_response_schema, NOT_FOUND
+from services.json_stream import IncrementalJSONFieldParser
+from services.hedging import get_hedge_pool
+from services.model_router import model_router
+from services.metrics import (
+    timed, observe_stage, current_trace, use_trace,
+    gemini_request_seconds, gemini_attempts_total, gemini_hedges_total, gemini_tokens_total
+)
+from utils.helpers import EXTRACTED_FIELDS, add_calculated_fields
 from config import Config
 
+RATE_LIMITED_ERROR = "All API keys rate limited. Please try again later."
+
 class AIProcessor:
     def __init__(self):
-        # Initialize key manager with all available keys
-        key_manager.initialize_keys(Config.GOOGLE_AI_KEYS)
+        # Keys and per-key clients are set up once per process, not per request
+        gemini_pool.initialize(Config.GOOGLE_AI_KEYS)
         
         # Вибираємо одну з доступних сучасних моделей
-        self.model_name = "models/gemini-1.5-flash-latest"
-        print(f"Using model: {self.model_name}")
+        self.model_name = Config.GEMINI_MODEL
+    
+    def _get_model_with_key(self, api_key, model_name=None):
+        """Return the pooled model bound to this key's long-lived client"""
+        return gemini_pool.get_model(api_key, model_name or self.model_name)
+    
+    def _measure_tokens(self, prompt, response):
+        """Token usage reported by Gemini; also calibrates local estimates"""
+        usage = getattr(response, 'usage_metadata', None)
+        prompt_tokens = getattr(usage, 'prompt_token_count', 0) if usage else 0
+        total_tokens = getattr(usage, 'total_token_count', 0) if usage else 0
+        
+        # Only text prompts calibrate the estimator; image parts are billed separately
+        if prompt_tokens and isinstance(prompt, str):
+            token_counter.observe(prompt, prompt_tokens)
+        if total_tokens:
+            return total_tokens
+        return self._estimate_prompt_tokens(prompt) + token_counter.estimate(response.text)
     
-    def _get_model_with_key(self, api_key):
-        """Configure and return model with specific API key"""
-        genai.configure(api_key=api_key)
-        return genai.GenerativeModel(self.model_name)
+    def _estimate_prompt_tokens(self, prompt):
+        """Estimate for a text prompt or a list of text and inline image parts"""
+        if isinstance(prompt, str):
+            return token_counter.estimate(prompt)
+        return sum(
+            token_counter.estimate(part) if isinstance(part, str) else Config.GEMINI_IMAGE_TOKENS
+            for part in prompt
+        )
     
     def process_with_gemini(self, text, deadhead=0):
         """
         Process RC text using Google Gemini with automatic key rotation
         """
-        prompt = f"""
-        Analyze this Rate Confirmation document and extract the following information as valid JSON.
-        If any information is not found, use "Not found".
-
-        REQUIRED FIELDS:
-        - broker_name: broker name & contact info (phone, email)
-        - carrier_name: carrier name & MC number
-        - load_number: load number
-        - pickup_number: pickup number, PRO number, BOL number, or reference number
-        - rate: total rate (numeric value only)
-        - distance: distance from Pickup to Delivery in miles (numeric value only)
-        - pickup_address: complete pickup address with ZIP code
-        - pickup_time: pickup date, time, and appointment type (FCFS, appointment, etc.)
-        - delivery_address: complete delivery address with ZIP code  
-        - delivery_time: delivery date, time, and appointment type
-        - commodity: commodity type and description
-        - weight: weight in lbs (numeric value only)
-        - equipment: equipment type (van, reefer, flatbed, etc.)
-        - notes: special instructions, detention, lumper, requirements
-
-        IMPORTANT: 
-        - Deadhead distance: {deadhead} miles (add this to distance for total)
-        - Calculate total_distance = distance + deadhead
-        - Calculate rate_per_mile = rate / total_distance (round to 2 decimal places)
-        - Return ONLY valid JSON format, no other text or explanations
-
-        Rate Confirmation text to analyze:
-        {text[:15000]}  # Limit text length to avoid token limits
+        result = self.extract_fields(text)
+        if 'error' in result:
+            return result
+        return add_calculated_fields(result, deadhead)
+    
+    def extract_fields(self, text, page_count=1, ocr_pages=0):
         """
-
-        max_retries = 3
+        Extract raw RC fields with Gemini. The result does not depend on
+        deadhead, so it can be cached per document. The model router picks
+        the first tier; failed or low-confidence answers move up a tier.
+        All tiers and the follow-up share one AI_DEADLINE.
+        """
+        deadline = time.monotonic() + Config.AI_DEADLINE
+        prompt = self._build_prompt(text)
+        cascade = model_router.cascade(model_router.route(text, page_count, ocr_pages))
+        best = None  # (confidence, answer, tier)
+        for tier in cascade:
+            result = self.generate(
+                prompt, rc_response_schema.parse,
+                max_retries=3 if tier is cascade[-1] else Config.MODEL_ROUTER_TIER_ATTEMPTS,
+                generation_config=self.json_generation_config(),
+                model_name=tier.model, deadline=deadline
+            )
+            best, done = self._judge_answer(best, result, tier, cascade)
+            if done:
+                break
+        
+        if best is None:
+            model_router.record_outcome(cascade[-1], answered=False)
+            return result
+        _, result, tier = best
+        model_router.record_outcome(tier, answered=True)
+        return self.complete_fields(text, result, model_name=tier.model, deadline=deadline)
+    
+    def _build_prompt(self, text):
+        """Compact the text and pack the most relevant parts into the token budget"""
+        with timed('prompt_build'):
+            prompt, prompt_stats = PromptBuilder().build(text)
+        print(
+            f"Prompt: {prompt_stats['prompt_chars']} chars, ~{prompt_stats['estimated_tokens']} tokens "
+            f"({prompt_stats['segments_kept']}/{prompt_stats['segments']} segments)"
+        )
+        return prompt
+    
+    def _judge_answer(self, best, result, tier, cascade):
+        """
+        Keep the most confident answer of the cascade so far. Returns
+        (best, done): done once an answer is confident enough; otherwise
+        the escalation to the next tier is recorded.
+        """
+        if 'error' not in result:
+            confidence = model_router.assess(result)
+            if best is None or confidence > best[0]:
+                best = (confidence, result, tier)
+            if confidence >= Config.MODEL_ROUTER_MIN_CONFIDENCE:
+                return best, True
+        if tier is not cascade[-1]:
+            model_router.record_escalation(tier, 'error' if 'error' in result else 'low_confidence')
+        return best, False
+    
+    def json_generation_config(self, schema=None):
+        """Gemini JSON mode constrained to the RC field schema (None when AI_JSON_MODE is off)"""
+        if not Config.AI_JSON_MODE:
+            return None
+        return {
+            'response_mime_type': 'application/json',
+            'response_schema': schema or rc_response_schema.gemini_schema()
+        }
+    
+    def complete_fields(self, text, result, model_name=None, deadline=None):
+        """
+        Fill the fields a parsed answer left out (see '_missing') by asking
+        for just those fields with a small follow-up prompt, instead of
+        repeating the whole extraction. Fields still missing are 'Not found'.
+        The follow-up gets what is left of deadline, if one is given.
+        """
+        if 'error' in result:
+            return result
+        missing = result.pop('_missing', [])
+        if missing and Config.AI_FOLLOWUP_ENABLED:
+            print(f"Re-requesting {len(missing)} missing fields: {', '.join(missing)}")
+            prompt, parse_response, generation_config = self._followup_request(text, missing)
+            followup = self.generate(
+                prompt, parse_response, max_retries=1, generation_config=generation_config, model_name=model_name,
+                deadline=deadline
+            )
+            missing = self._merge_followup(result, missing, followup)
+        for field in missing:
+            result[field] = NOT_FOUND
+        return result
+    
+    def extract_changed_fields(self, text, fields):
+        """
+        Extract just the given fields of a revised RC (the ones its
+        changes touch) with the small follow-up prompt. Fields the answer
+        leaves out are 'Not found'.
+        """
+        print(f"Re-extracting {len(fields)} changed fields: {', '.join(fields)}")
+        prompt, parse_response, generation_config = self._followup_request(text, fields)
+        result = self.generate(prompt, parse_response, generation_config=generation_config)
+        return self._fill_changed_fields(result)
+    
+    def _fill_changed_fields(self, result):
+        if 'error' not in result:
+            for field in result.pop('_missing', []):
+                result[field] = NOT_FOUND
+        return result
+    
+    def _followup_request(self, text, missing):
+        """(prompt, parser, generation config) asking for just the missing fields"""
+        with timed('prompt_build'):
+            prompt, _ = PromptBuilder(Config.AI_FOLLOWUP_TOKEN_BUDGET).build(
+                text, instructions=followup_instructions(missing)
+            )
+        return (
+            prompt,
+            lambda response_text: rc_response_schema.parse(response_text, missing),
+            self.json_generation_config(rc_response_schema.gemini_schema(missing))
+        )
+    
+    def _merge_followup(self, result, missing, followup):
+        """Add a follow-up answer's fields to result; returns the fields still missing"""
+        if 'error' in followup:
+            rc_response_schema.record_followup(len(missing), 0)
+            return missing
+        still_missing = followup.pop('_missing', [])
+        rc_response_schema.record_followup(len(missing), len(missing) - len(still_missing))
+        result.update(followup)
+        return still_missing
+    
+    def transcribe_image(self, image_bytes, mime_type='image/jpeg'):
+        """
+        OCR a scanned page by sending it to Gemini as an inline image part.
+        Returns {'text': ...} or a dict with an 'error' key.
+        """
+        contents = [OCR_PROMPT_INSTRUCTIONS, {'mime_type': mime_type, 'data': image_bytes}]
+        return self.generate(contents, lambda response_text: {'text': response_text})
+    
+    def generate(self, prompt, parse_response, max_retries=3, generation_config=None, model_name=None,
+                 deadline=None):
+        """
+        Send a prompt (text, or a list of text and inline image parts) to
+        Gemini with automatic key rotation and return
+        parse_response(response.text). Parse errors count as failed attempts.
+        Each call is bounded by GEMINI_ATTEMPT_TIMEOUT and all attempts
+        together by AI_DEADLINE, or by the caller's deadline (a
+        time.monotonic() value) when several calls share one. Keys are
+        reserved against model_name's budget (GEMINI_MODEL by default).
+        """
+        model_name = model_name or self.model_name
+        # Reserve the prompt plus a typical answer against the key's token budget
+        estimated_tokens = self._estimate_prompt_tokens(prompt) + Config.AI_EXPECTED_OUTPUT_TOKENS
+        if deadline is None:
+            deadline = time.monotonic() + Config.AI_DEADLINE
+        if Config.HEDGING_ENABLED:
+            return self._generate_hedged(
+                prompt, parse_response, max_retries, estimated_tokens, deadline, generation_config, model_name
+            )
+        
+        error_message = "Failed to process after multiple attempts"
         for attempt in range(max_retries):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return {"error": "AI request deadline exceeded"}
             try:
-                # Get an active API key
-                api_key = key_manager.get_active_key()
+                # Get the key with the most spare capacity, waiting briefly if all are busy
+                with timed('key_wait'):
+                    api_key = key_manager.get_active_key(
+                        estimated_tokens, timeout=min(Config.KEY_WAIT_TIMEOUT, remaining), model=model_name
+                    )
+            except KeysExhausted:
+                # The key manager already waited as long as was useful, so another try would fail too
+                return {"error": RATE_LIMITED_ERROR}
+            except Exception as e:
+                error_message = self._report_failure('', e)
+                continue
+            
+            ok, result = self._attempt(
+                api_key, prompt, parse_response, estimated_tokens, deadline, generation_config, model_name
+            )
+            if ok:
+                return result
+            error_message = result
+        
+        return {"error": error_message}
+    
+    def _generate_hedged(self, prompt, parse_response, max_retries, estimated_tokens, deadline,
+                         generation_config=None, model_name=None):
+        """
+        Run calls on the hedge pool. If a call has not answered after the
+        hedge delay (a high percentile of recent latencies) and the keys
+        have spare capacity, the same prompt is sent on a different key.
+        The first valid answer wins; slower calls are left to finish in the
+        background and still settle their key's tokens. Failed calls are
+        retried while attempts and time remain.
+        """
+        pool = get_hedge_pool()
+        trace = current_trace()
+        pending = {}  # future -> (api key, is hedge)
+        attempts = 0
+        hedges = 0
+        hedge_skipped = False
+        hedge_at = None
+        error_message = "Failed to process after multiple attempts"
+        fallback = None  # a parsed answer that reported an error, used if nothing better arrives
+        
+        def launch(api_key, is_hedge):
+            future = pool.submit(
+                self._attempt_in_trace, trace, api_key, prompt, parse_response, estimated_tokens, deadline,
+                generation_config, model_name
+            )
+            pending[future] = (api_key, is_hedge)
+        
+        while True:
+            now = time.monotonic()
+            remaining = deadline - now
+            if remaining <= 0:
+                return {"error": "AI request deadline exceeded"}
+            
+            if not pending:
+                if attempts >= max_retries:
+                    return fallback or {"error": error_message}
+                attempts += 1
+                try:
+                    with timed('key_wait'):
+                        api_key = key_manager.get_active_key(
+                            estimated_tokens, timeout=min(Config.KEY_WAIT_TIMEOUT, remaining), model=model_name
+                        )
+                except KeysExhausted:
+                    return fallback or {"error": RATE_LIMITED_ERROR}
+                except Exception as e:
+                    error_message = self._report_failure('', e)
+                    continue
+                launch(api_key, False)
+                hedge_at = time.monotonic() + model_router.tracker(model_name).hedge_delay()
+                continue
+            
+            can_hedge = hedges < Config.HEDGE_MAX_EXTRA
+            timeout = max(0.0, min(remaining, hedge_at - now)) if can_hedge else remaining
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                _, is_hedge = pending.pop(future)
+                ok, result = future.result()
+                if ok and 'error' not in result:
+                    if is_hedge:
+                        gemini_hedges_total.inc(outcome='won')
+                    return result
+                if ok:
+                    fallback = result
+                else:
+                    error_message = result
+            
+            if done or not can_hedge or time.monotonic() < hedge_at:
+                continue
+            hedge_key = self._spare_key(
+                estimated_tokens, {api_key for api_key, _ in pending.values()}, model_name
+            )
+            if hedge_key is None:
+                if not hedge_skipped:
+                    hedge_skipped = True
+                    gemini_hedges_total.inc(outcome='skipped_no_capacity')
+                # Capacity may free up while the slow call is still running
+                hedge_at = time.monotonic() + Config.HEDGE_MIN_DELAY
+                continue
+            hedges += 1
+            gemini_hedges_total.inc(outcome='launched')
+            print(f"Hedging slow Gemini call on key {hedge_key[:10]}...")
+            launch(hedge_key, True)
+    
+    def _spare_key(self, estimated_tokens, busy_keys, model_name=None):
+        """A different key for a hedge, only while the keys have requests to spare"""
+        if key_manager.get_available_capacity(model_name) < Config.HEDGE_MIN_SPARE_REQUESTS:
+            return None
+        try:
+            return key_manager.get_active_key(estimated_tokens, timeout=0, exclude=busy_keys, model=model_name)
+        except Exception:
+            return None
+    
+    def _attempt_in_trace(self, trace, *args):
+        """_attempt on a pool thread, recording stages into the request's trace"""
+        with use_trace(trace):
+            return self._attempt(*args)
+    
+    def _attempt(self, api_key, prompt, parse_response, estimated_tokens, deadline, generation_config=None,
+                 model_name=None):
+        """
+        One Gemini call on a reserved key. Returns (True, parsed response)
+        or (False, error message).
+        """
+        attempt_started = None
+        try:
+            model = self._get_model_with_key(api_key, model_name)
+            timeout = max(0.001, min(Config.GEMINI_ATTEMPT_TIMEOUT, deadline - time.monotonic()))
+            attempt_started = time.perf_counter()
+            response = model.generate_content(
+                prompt, generation_config=generation_config, request_options={'timeout': timeout}
+            )
+            seconds = self._record_attempt(api_key, 'ok', attempt_started)
+            attempt_started = None
+            return self._settle_response(
+                api_key, prompt, response, parse_response, estimated_tokens, seconds, model_name
+            )
                 
-                model = self._get_model_with_key(api_key)
-                response = model.generate_content(prompt)
+        except Exception as e:
+            return False, self._report_failure(api_key, e, attempt_started, model_name)
+    
+    def _settle_response(self, api_key, prompt, response, parse_response, estimated_tokens, seconds,
+                         model_name=None):
+        """
+        Record a successful call's latency and tokens against its key, then
+        parse the answer. Returns (True, parsed) or (False, error message).
+        """
+        model_router.record_call(model_name or self.model_name, seconds)
+        print(f"Gemini Response (Key: {api_key[:10]}...):", response.text[:200] + "...")  # Debug output
+        
+        tokens_used = self._measure_tokens(prompt, response)
+        key_manager.report_success(api_key, tokens_used, reserved_tokens=estimated_tokens, model=model_name)
+        gemini_tokens_total.inc(tokens_used, key=key_manager.key_label(api_key))
+        
+        try:
+            with timed('json_parse'):
+                return True, parse_response(response.text)
+        except ValueError as e:
+            return False, self._parse_failure(api_key, e)
+    
+    def _parse_failure(self, api_key, error):
+        """
+        An answer that could not be parsed or repaired. The call itself
+        worked, so the attempt is retried without counting against the key.
+        """
+        print(f"Unusable Gemini answer from key {api_key[:10]}...: {str(error)}")
+        return f"AI response could not be parsed: {str(error)}"
+    
+    async def extract_fields_async(self, text, page_count=1, ocr_pages=0):
+        """
+        extract_fields for the ASGI app: keys are checked out and Gemini is
+        called without blocking the event loop, so one process keeps many
+        extractions in flight. Calls are not hedged.
+        """
+        deadline = time.monotonic() + Config.AI_DEADLINE
+        # With PROMPT_EXACT_TOKENS the builder may call countTokens, so it runs in a thread
+        prompt = await asyncio.to_thread(self._build_prompt, text)
+        cascade = model_router.cascade(model_router.route(text, page_count, ocr_pages))
+        best = None  # (confidence, answer, tier)
+        for tier in cascade:
+            result = await self.generate_async(
+                prompt, rc_response_schema.parse,
+                max_retries=3 if tier is cascade[-1] else Config.MODEL_ROUTER_TIER_ATTEMPTS,
+                generation_config=self.json_generation_config(),
+                model_name=tier.model, deadline=deadline
+            )
+            best, done = self._judge_answer(best, result, tier, cascade)
+            if done:
+                break
+        
+        if best is None:
+            model_router.record_outcome(cascade[-1], answered=False)
+            return result
+        _, result, tier = best
+        model_router.record_outcome(tier, answered=True)
+        return await self.complete_fields_async(text, result, model_name=tier.model, deadline=deadline)
+    
+    async def complete_fields_async(self, text, result, model_name=None, deadline=None):
+        """complete_fields with an awaited follow-up request"""
+        if 'error' in result:
+            return result
+        missing = result.pop('_missing', [])
+        if missing and Config.AI_FOLLOWUP_ENABLED:
+            print(f"Re-requesting {len(missing)} missing fields: {', '.join(missing)}")
+            prompt, parse_response, generation_config = await asyncio.to_thread(self._followup_request, text, missing)
+            followup = await self.generate_async(
+                prompt, parse_response, max_retries=1, generation_config=generation_config, model_name=model_name,
+                deadline=deadline
+            )
+            missing = self._merge_followup(result, missing, followup)
+        for field in missing:
+            result[field] = NOT_FOUND
+        return result
+    
+    async def extract_changed_fields_async(self, text, fields):
+        """extract_changed_fields with an awaited request"""
+        print(f"Re-extracting {len(fields)} changed fields: {', '.join(fields)}")
+        prompt, parse_response, generation_config = await asyncio.to_thread(self._followup_request, text, fields)
+        result = await self.generate_async(prompt, parse_response, generation_config=generation_config)
+        return self._fill_changed_fields(result)
+    
+    async def generate_async(self, prompt, parse_response, max_retries=3, generation_config=None, model_name=None,
+                             deadline=None):
+        """generate on the event loop, with the same key rotation, timeouts and deadline"""
+        model_name = model_name or self.model_name
+        estimated_tokens = self._estimate_prompt_tokens(prompt) + Config.AI_EXPECTED_OUTPUT_TOKENS
+        if deadline is None:
+            deadline = time.monotonic() + Config.AI_DEADLINE
+        
+        error_message = "Failed to process after multiple attempts"
+        for attempt in range(max_retries):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return {"error": "AI request deadline exceeded"}
+            try:
+                with timed('key_wait'):
+                    api_key = await key_manager.get_active_key_async(
+                        estimated_tokens, timeout=min(Config.KEY_WAIT_TIMEOUT, remaining), model=model_name
+                    )
+            except KeysExhausted:
+                return {"error": RATE_LIMITED_ERROR}
+            
+            ok, result = await self._attempt_async(
+                api_key, prompt, parse_response, estimated_tokens, deadline, generation_config, model_name
+            )
+            if ok:
+                return result
+            error_message = result
+        
+        return {"error": error_message}
+    
+    async def _attempt_async(self, api_key, prompt, parse_response, estimated_tokens, deadline,
+                             generation_config=None, model_name=None):
+        """_attempt awaiting the call: natively over gRPC, on the REST thread pool otherwise"""
+        attempt_started = None
+        try:
+            timeout = max(0.001, min(Config.GEMINI_ATTEMPT_TIMEOUT, deadline - time.monotonic()))
+            request_options = {'timeout': timeout}
+            attempt_started = time.perf_counter()
+            if gemini_pool.native_async:
+                model = gemini_pool.get_async_model(api_key, model_name or self.model_name)
+                response = await model.generate_content_async(
+                    prompt, generation_config=generation_config, request_options=request_options
+                )
+            else:
+                model = self._get_model_with_key(api_key, model_name)
+                response = await asyncio.get_running_loop().run_in_executor(
+                    gemini_pool.get_rest_executor(),
+                    functools.partial(
+                        model.generate_content, prompt,
+                        generation_config=generation_config, request_options=request_options
+                    )
+                )
+            seconds = self._record_attempt(api_key, 'ok', attempt_started)
+            attempt_started = None
+            # Reports write the key state backend, so they run off the event loop
+            return await asyncio.to_thread(
+                self._settle_response, api_key, prompt, response, parse_response, estimated_tokens, seconds, model_name
+            )
+        
+        except Exception as e:
+            return False, await asyncio.to_thread(self._report_failure, api_key, e, attempt_started, model_name)
+    
+    def stream_fields(self, text, max_retries=3, page_count=1, ocr_pages=0):
+        """
+        Extract raw RC fields with Gemini's streaming generation. Yields
+        {'event': 'field', 'field', 'value'} as soon as each field is complete
+        in the streamed JSON, then one {'event': 'complete', 'data'} or
+        {'event': 'error', 'error'}. A retry after a partial stream only
+        yields fields whose value changed. The stream stays on the routed
+        tier, since the client has already seen its fields.
+        """
+        with timed('prompt_build'):
+            prompt, prompt_stats = PromptBuilder().build(text)
+        print(
+            f"Streaming prompt: {prompt_stats['prompt_chars']} chars, ~{prompt_stats['estimated_tokens']} tokens"
+        )
+        
+        tier = model_router.route(text, page_count, ocr_pages)
+        api_key = ''
+        estimated_tokens = token_counter.estimate(prompt) + Config.AI_EXPECTED_OUTPUT_TOKENS
+        # Streams are not hedged (the client already sees fields), but share the timeouts
+        deadline = time.monotonic() + Config.AI_DEADLINE
+        emitted = {}
+        for attempt in range(max_retries):
+            attempt_started = None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                yield {'event': 'error', 'error': "AI request deadline exceeded"}
+                return
+            try:
+                with timed('key_wait'):
+                    api_key = key_manager.get_active_key(
+                        estimated_tokens, timeout=min(Config.KEY_WAIT_TIMEOUT, remaining), model=tier.model
+                    )
                 
-                print(f"Gemini Response (Key: {api_key[:10]}...):", response.text[:200] + "...")  # Debug output
+                model = self._get_model_with_key(api_key, tier.model)
+                timeout = max(0.001, min(Config.GEMINI_ATTEMPT_TIMEOUT, deadline - time.monotonic()))
+                attempt_started = time.perf_counter()
+                response = model.generate_content(
+                    prompt, stream=True, generation_config=self.json_generation_config(),
+                    request_options={'timeout': timeout}
+                )
                 
-                # Estimate tokens used (approximate)
-                tokens_used = len(prompt) // 4 + len(response.text) // 4
-                key_manager.report_success(api_key, tokens_used)
+                parser = IncrementalJSONFieldParser()
+                chunks = []
+                for chunk in response:
+                    chunks.append(chunk.text)
+                    for field, value in parser.feed(chunk.text):
+                        # Only schema fields reach the client; the UI merges whatever it is sent
+                        if field not in EXTRACTED_FIELDS:
+                            continue
+                        value = rc_response_schema.coerce(field, value)
+                        if field not in emitted or emitted[field] != value:
+                            emitted[field] = value
+                            yield {'event': 'field', 'field': field, 'value': value}
                 
-                # Clean the response to extract just the JSON
-                json_match = re.search(r'\{[\s\S]*\}', response.text)
-                if json_match:
-                    result = json.loads(json_match.group())
-                    
-                    # Add calculated fields
-                    try:
-                        rate = float(result.get('rate', 0))
-                        distance = float(result.get('distance', 0))
-                        total_distance = distance + deadhead
-                        rate_per_mile = round(rate / total_distance, 2) if total_distance > 0 else 0
-                        
-                        result['total_distance'] = total_distance
-                        result['rate_per_mile'] = rate_per_mile
-                        result['deadhead'] = deadhead
-                    except (ValueError, TypeError):
-                        result['total_distance'] = 'n/a'
-                        result['rate_per_mile'] = 'n/a'
-                    
-                    return result
-                else:
-                    return {"error": "Failed to parse AI response. No JSON found."}
-                    
-            except exceptions.ResourceExhausted as e:
-                print(f"Rate limit exceeded for key: {api_key[:10]}...")
-                key_manager.report_rate_limit(api_key)
-                if attempt == max_retries - 1:
-                    return {"error": "All API keys rate limited. Please try again later."}
+                model_router.record_call(tier.model, self._record_attempt(api_key, 'ok', attempt_started))
+                attempt_started = None
                 
-            except exceptions.PermissionDenied as e:
-                print(f"Permission denied for key: {api_key[:10]}...")
-                key_manager.report_error(api_key, str(e))
-                if attempt == max_retries - 1:
-                    return {"error": "API key permission denied"}
-                    
-            except exceptions.InvalidArgument as e:
-                print(f"Invalid argument for key: {api_key[:10]}...")
-                key_manager.report_error(api_key, str(e))
-                if attempt == max_retries - 1:
-                    return {"error": "Invalid API request"}
-                    
+                response_text = ''.join(chunks)
+                print(f"Gemini streamed response (Key: {api_key[:10]}...):", response_text[:200] + "...")
+                
+                tokens_used = self._measure_tokens(prompt, response)
+                key_manager.report_success(api_key, tokens_used, reserved_tokens=estimated_tokens, model=tier.model)
+                gemini_tokens_total.inc(tokens_used, key=key_manager.key_label(api_key))
+                
+                try:
+                    with timed('json_parse'):
+                        extracted_data = rc_response_schema.parse(response_text)
+                except ValueError as e:
+                    error_message = self._parse_failure(api_key, e)
+                    if attempt == max_retries - 1:
+                        model_router.record_outcome(tier, answered=False)
+                        yield {'event': 'error', 'error': error_message}
+                        return
+                    continue
+                missing = extracted_data.get('_missing', [])
+                model_router.record_outcome(tier, answered=True)
+                extracted_data = self.complete_fields(text, extracted_data, model_name=tier.model, deadline=deadline)
+                for field in missing:
+                    if extracted_data[field] != NOT_FOUND:
+                        yield {'event': 'field', 'field': field, 'value': extracted_data[field]}
+                yield {'event': 'complete', 'data': extracted_data}
+                return
+                
+            except KeysExhausted:
+                model_router.record_outcome(tier, answered=False)
+                yield {'event': 'error', 'error': RATE_LIMITED_ERROR}
+                return
             except Exception as e:
-                print(f"Gemini processing error with key {api_key[:10]}...: {str(e)}")
-                key_manager.report_error(api_key, str(e))
+                error_message = self._report_failure(api_key, e, attempt_started, tier.model)
                 if attempt == max_retries - 1:
-                    return {"error": f"AI processing error: {str(e)}"}
+                    model_router.record_outcome(tier, answered=False)
+                    yield {'event': 'error', 'error': error_message}
+                    return
+        
+        yield {'event': 'error', 'error': "Failed to process after multiple attempts"}
+    
+    def _record_attempt(self, api_key, outcome, started):
+        """Record one Gemini call (started is None when no call was made); returns its duration"""
+        if started is None:
+            return None
+        seconds = time.perf_counter() - started
+        key_label = key_manager.key_label(api_key)
+        gemini_request_seconds.observe(seconds, key=key_label, outcome=outcome)
+        gemini_attempts_total.inc(key=key_label, outcome=outcome)
+        observe_stage('gemini', seconds)
+        return seconds
+    
+    def _report_failure(self, api_key, error, attempt_started=None, model_name=None):
+        """Report a failed attempt against the key; returns the error to surface if it was the last attempt"""
+        # The REST transport raises TooManyRequests for HTTP 429; gRPC raises its subclass ResourceExhausted
+        if isinstance(error, exceptions.TooManyRequests):
+            self._record_attempt(api_key, 'rate_limited', attempt_started)
+            print(f"Rate limit exceeded for key: {api_key[:10]}...")
+            key_manager.report_rate_limit(api_key, model=model_name)
+            return RATE_LIMITED_ERROR
+        
+        # A stalled call says nothing about the key, so it is not counted against it
+        if isinstance(error, (exceptions.DeadlineExceeded, requests.exceptions.Timeout)):
+            self._record_attempt(api_key, 'timeout', attempt_started)
+            print(f"Gemini call timed out for key: {api_key[:10]}...")
+            return "AI request timed out"
+        
+        if isinstance(error, exceptions.PermissionDenied):
+            self._record_attempt(api_key, 'permission_denied', attempt_started)
+            print(f"Permission denied for key: {api_key[:10]}...")
+            key_manager.report_error(api_key, str(error), model=model_name)
+            return "API key permission denied"
+        
+        if isinstance(error, exceptions.InvalidArgument):
+            self._record_attempt(api_key, 'invalid_argument', attempt_started)
+            print(f"Invalid argument for key: {api_key[:10]}...")
+            key_manager.report_error(api_key, str(error), model=model_name)
+            return "Invalid API request"
         
-        return {"error": "Failed to process after multiple attempts"}
+        self._record_attempt(api_key, 'error', attempt_started)
+        print(f"Gemini processing error with key {api_key[:10]}...: {str(error)}")
+        key_manager.report_error(api_key, str(error), model=model_name)
+        return f"AI processing error: {str(error)}"
@@ -0,0 +1,480 @@
+import re
+import time
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from config import Config
+from services.pdf_extractor import PDFTextExtractor
+from services.ai_processor import AIProcessor
+from services.ai_batcher import ai_batcher
+from services.fallback_processor import FallbackProcessor
+from services.result_cache import result_cache
+from services.near_duplicate import near_duplicate_index, affected_fields, same_load
+from services.template_index import template_index
+from services.load_history import load_history
+from services.geo_distance import geo_distance
+from services.admission import admission_controller, AdmissionRejected
+from services.response_schema import NOT_FOUND
+from services.metrics import timed, pdf_page_seconds
+from utils.helpers import (
+    EXTRACTED_FIELDS, format_response_data, compute_file_hash, add_calculated_fields, worker_context
+)
+
+_MILES_PATTERN = re.compile(r'\d[\d,]*(?:\.\d+)?')
+
+def _parse_miles(value):
+    """First number in an extracted distance ("1,234 mi" -> 1234.0), 0 when there is none"""
+    match = _MILES_PATTERN.search(str(value or ''))
+    return float(match.group().replace(',', '')) if match else 0.0
+
+def extract_document_in_worker(source):
+    """Extract a document in a worker process (module level so it can be pickled)"""
+    # Already inside a worker process, so pages are not fanned out again
+    return AnalysisPipeline().extract_document(source, parallel=False)
+
+_extract_pool = None
+_extract_pool_lock = threading.Lock()
+
+def get_extract_pool():
+    """Worker processes that extract documents for the ASGI app"""
+    global _extract_pool
+    with _extract_pool_lock:
+        if _extract_pool is None:
+            _extract_pool = ProcessPoolExecutor(max_workers=Config.ASYNC_EXTRACT_WORKERS, mp_context=worker_context())
+        return _extract_pool
+
+class AnalysisPipeline:
+    """
+    Shared analysis steps used by /api/analyze and the batch workers:
+    cache lookup -> text extraction -> layout template / fast path,
+    revision of an analyzed RC, or AI -> response formatting. Only the AI
+    calls take an admission slot in the pipeline's priority class
+    ('interactive' or 'bulk'), so local answers never wait for key capacity.
+    """
+
+    def __init__(self, ai_processor=None, priority='interactive'):
+        self.ai_processor = ai_processor
+        self.priority = priority
+
+    def lookup_cache(self, file_hash):
+        """Return a cached raw extraction for the file hash, if any"""
+        if not Config.CACHE_ENABLED:
+            return None
+        with timed('cache_lookup'):
+            extracted_data = result_cache.get(file_hash)
+        if extracted_data is not None:
+            print(f"Result cache hit: {file_hash[:12]}...")
+        return extracted_data
+
+    def extract_document(self, source, parallel=True):
+        """
+        Extract text (and first-page word boxes when templates are enabled)
+        from an uploaded document (path, bytes or file-like)
+        """
+        pdf_extractor = PDFTextExtractor(max_chars=Config.PDF_TEXT_CHAR_BUDGET, parallel=parallel)
+        layout_pages = Config.TEMPLATE_LAYOUT_PAGES if Config.TEMPLATES_ENABLED else 0
+        with timed('pdf_extract'):
+            extraction = pdf_extractor.extract(source, layout_pages=layout_pages)
+        self.record_extraction(extraction)
+        print(
+            f"Extracted text length: {len(extraction['text'])} characters "
+            f"({extraction['pages_extracted']}/{extraction['page_count']} pages, "
+            f"{extraction['total_seconds']}s)"
+        )
+        return extraction
+
+    def record_extraction(self, extraction):
+        """Record per-page extraction timings (pages OCR'd or read from the text layer)"""
+        ocr_pages = set(extraction.get('ocr_pages', []))
+        for page in extraction['pages']:
+            source = 'ocr' if page['page'] in ocr_pages else 'text'
+            pdf_page_seconds.observe(page['seconds'], source=source)
+
+    def try_fast_path(self, extraction, file_hash=None):
+        """
+        Return a confident local extraction (cached like an AI result), or None.
+        Values from a learned layout template are used as known fields; a
+        sample of the documents they answer goes to the AI anyway, so a bad
+        template is corrected or evicted when its result is learned.
+        """
+        if not Config.FAST_PATH_ENABLED:
+            return None
+
+        known_fields = {}
+        if Config.TEMPLATES_ENABLED:
+            known_fields = template_index.match(extraction.get('words'))
+            if known_fields and template_index.sample_audit():
+                print("Layout template audit: sending the document to the AI")
+                return None
+
+        with timed('fast_path'):
+            extracted_data = FallbackProcessor().try_fast_path(extraction['text'], known_fields=known_fields)
+        if extracted_data is not None:
+            self.store(file_hash, extracted_data, extraction)
+        return extracted_data
+
+    def find_revision(self, extraction):
+        """
+        (prior document, fields to re-extract) when the text is a near
+        duplicate of an analyzed RC with the same load number, else None.
+        A revision touching more than NEAR_DUP_MAX_CHANGED_FIELDS fields is
+        analyzed as a new RC.
+        """
+        if not Config.NEAR_DUP_ENABLED:
+            return None
+        with timed('near_duplicate'):
+            prior = near_duplicate_index.find(extraction['text'])
+            if prior is None:
+                return None
+            if not same_load(prior['fields'], extraction['text']):
+                print(f"Similar to {prior['key'][:12]}... but not the same load number, analyzing in full")
+                return None
+            fields, changed_lines = affected_fields(prior['text'], extraction['text'], prior['fields'])
+        if len(fields) > Config.NEAR_DUP_MAX_CHANGED_FIELDS:
+            print(f"Near duplicate of {prior['key'][:12]}... changes {len(fields)} fields, analyzing in full")
+            return None
+        print(
+            f"Near duplicate of {prior['key'][:12]}... (similarity {prior['similarity']}, "
+            f"{len(changed_lines)} changed lines, fields: {', '.join(fields) or 'none'})"
+        )
+        return prior, fields
+
+    def local_revision_fields(self, extraction, fields):
+        """Confident regex values for a revision's changed fields; returns (values, fields left for the AI)"""
+        if not fields or not Config.FAST_PATH_ENABLED:
+            return {}, fields
+        with timed('fast_path'):
+            local = FallbackProcessor().extract_fields(extraction['text'])
+        values = {
+            field: local['fields'][field]
+            for field in fields
+            if local['confidence'].get(field, 0) >= Config.FAST_PATH_MIN_CONFIDENCE
+        }
+        return values, [field for field in fields if field not in values]
+
+    def merge_revision(self, extraction, file_hash, prior, values, ai_fields):
+        """
+        The prior fields updated with the re-extracted ones, stored like any
+        extraction; '_revision' tells finalize which fields changed
+        """
+        extracted_data = dict(prior['fields'], **values)
+        changed = [
+            field for field in EXTRACTED_FIELDS
+            if extracted_data.get(field, NOT_FOUND) != prior['fields'].get(field, NOT_FOUND)
+        ]
+        near_duplicate_index.record_revision(len(values) - len(ai_fields), len(ai_fields))
+        self.store(file_hash, extracted_data, extraction)
+        return dict(extracted_data, _revision={
+            'previous_file_hash': prior['key'],
+            'similarity': prior['similarity'],
+            'reextracted_fields': [field for field in EXTRACTED_FIELDS if field in values],
+            'changed_fields': changed
+        })
+
+    def try_revision(self, extraction, file_hash=None):
+        """
+        Re-extract only what a revised RC changed: regex values where they
+        are confident, a small AI prompt for the rest. Returns the merged
+        extraction, or None for a new document (or when the AI fails, so
+        the full extraction runs instead).
+        """
+        revision = self.find_revision(extraction)
+        if revision is None:
+            return None
+        prior, fields = revision
+        values, ai_fields = self.local_revision_fields(extraction, fields)
+        if ai_fields:
+            with admission_controller.admit(self.priority):
+                answer = self._get_ai_processor().extract_changed_fields(extraction['text'], ai_fields)
+            if 'error' in answer:
+                print(f"Revision re-extraction failed: {answer['error']}")
+                return None
+            values.update((field, answer[field]) for field in ai_fields)
+        return self.merge_revision(extraction, file_hash, prior, values, ai_fields)
+
+    async def try_revision_async(self, extraction, file_hash=None):
+        """try_revision with an awaited AI request; index lookups and writes run in threads"""
+        revision = await asyncio.to_thread(self.find_revision, extraction)
+        if revision is None:
+            return None
+        prior, fields = revision
+        values, ai_fields = await asyncio.to_thread(self.local_revision_fields, extraction, fields)
+        if ai_fields:
+            async with admission_controller.admit_async(self.priority):
+                answer = await self._get_ai_processor().extract_changed_fields_async(extraction['text'], ai_fields)
+            if 'error' in answer:
+                print(f"Revision re-extraction failed: {answer['error']}")
+                return None
+            values.update((field, answer[field]) for field in ai_fields)
+        return await asyncio.to_thread(self.merge_revision, extraction, file_hash, prior, values, ai_fields)
+
+    def _get_ai_processor(self):
+        if self.ai_processor is None:
+            self.ai_processor = AIProcessor()
+        return self.ai_processor
+
+    def extract_fields(self, extraction, file_hash=None, use_fast_path=True, batched=None):
+        """
+        Extract fields with the local fast path, falling back to the AI when
+        any field is below the confidence threshold. A revision of an
+        analyzed RC only re-extracts the fields it changed. With
+        batched=True the AI request is shared with other queued documents.
+        AI results also teach the template index the document's layout.
+        Raises AdmissionRejected when the AI is needed but can't be reached
+        in time.
+        """
+        if not extraction['text'].strip():
+            return {'error': 'No text could be read from the document'}
+
+        if use_fast_path:
+            extracted_data = self.try_fast_path(extraction, file_hash)
+            if extracted_data is not None:
+                return extracted_data
+
+        extracted_data = self.try_revision(extraction, file_hash)
+        if extracted_data is not None:
+            return extracted_data
+
+        if batched is None:
+            batched = Config.AI_BATCHING_ENABLED
+
+        with admission_controller.admit(self.priority):
+            if batched:
+                extracted_data = ai_batcher.extract_fields(extraction['text'])
+            else:
+                extracted_data = self._get_ai_processor().extract_fields(
+                    extraction['text'], extraction.get('page_count', 1), len(extraction.get('ocr_pages', []))
+                )
+
+        if 'error' not in extracted_data:
+            self.store(file_hash, extracted_data, extraction)
+            self.learn_layout(extraction, extracted_data)
+        return extracted_data
+
+    def learn_layout(self, extraction, extracted_data):
+        """Teach the template index where an AI result's values sit on the page"""
+        if not Config.TEMPLATES_ENABLED:
+            return
+        try:
+            template_index.learn(extraction.get('words'), extracted_data)
+        except Exception as e:
+            print(f"Template learning error: {str(e)}")
+
+    def store(self, file_hash, extracted_data, extraction=None):
+        """Store a successful extraction in the result cache (and its text in the near-duplicate index)"""
+        if file_hash and Config.CACHE_ENABLED:
+            result_cache.set(file_hash, extracted_data)
+        if file_hash and extraction is not None and Config.NEAR_DUP_ENABLED:
+            try:
+                near_duplicate_index.add(file_hash, extraction['text'], extracted_data)
+            except Exception as e:
+                print(f"Near-duplicate index error: {str(e)}")
+
+    def estimate_distances(self, extracted_data, deadhead=0, truck_location=None):
+        """
+        Fill a missing loaded distance from the pickup/delivery addresses and,
+        when the truck location is given without a deadhead, estimate the
+        deadhead to the pickup. Returns (extracted_data, deadhead, estimated
+        fields); the cached extraction is never modified.
+        """
+        estimated = []
+        pickup_address = extracted_data.get('pickup_address')
+        with timed('geo_distance'):
+            if Config.GEO_FILL_MISSING_DISTANCE and _parse_miles(extracted_data.get('distance')) <= 0:
+                miles = geo_distance.estimate_miles(pickup_address, extracted_data.get('delivery_address'))
+                if miles:
+                    extracted_data = dict(extracted_data, distance=miles)
+                    estimated.append('distance')
+            if truck_location and not deadhead:
+                miles = geo_distance.estimate_miles(truck_location, pickup_address)
+                if miles is not None:
+                    deadhead = miles
+                    estimated.append('deadhead')
+        return extracted_data, deadhead, estimated
+
+    def finalize(self, extracted_data, deadhead=0, file_hash=None, truck_location=None):
+        """
+        Add deadhead-derived fields, record the load for analytics and
+        format the API response (with the changed fields of a revision)
+        """
+        revision = extracted_data.get('_revision')
+        extracted_data, deadhead, estimated = self.estimate_distances(extracted_data, deadhead, truck_location)
+        if Config.LOAD_HISTORY_ENABLED:
+            try:
+                load_history.record(extracted_data, deadhead, file_hash)
+            except Exception as e:
+                print(f"Load history error: {str(e)}")
+        with timed('format_response'):
+            processed_data = add_calculated_fields(extracted_data, deadhead)
+            response = format_response_data(processed_data)
+        for field in estimated:
+            response[f'{field}_estimated'] = True
+        if 'deadhead' in estimated:
+            response['deadhead'] = deadhead
+        if revision is not None:
+            response['revision'] = revision
+        return response
+
+    def analyze_file(self, source, deadhead=0, file_hash=None, truck_location=None):
+        """
+        Run the full pipeline for one file (path or bytes). Returns the
+        formatted response, or a dict with an 'error' key. Raises
+        AdmissionRejected when a file that needs the AI can't be analyzed
+        in time.
+        """
+        file_hash = file_hash or compute_file_hash(source)
+        extracted_data = self.lookup_cache(file_hash)
+
+        if extracted_data is None:
+            extraction = self.extract_document(source)
+            extracted_data = self.extract_fields(extraction, file_hash)
+            if 'error' in extracted_data:
+                return {'error': extracted_data['error']}
+
+        return self.finalize(extracted_data, deadhead, file_hash, truck_location)
+
+    async def analyze_file_async(self, source, deadhead=0, file_hash=None, truck_location=None):
+        """
+        analyze_file for the ASGI app. Text extraction runs in the worker
+        process pool and the AI is awaited, so the event loop stays free
+        for other requests; cache, fast path and formatting are shared and
+        run in threads, since they read and write SQLite.
+        """
+        file_hash = file_hash or await asyncio.to_thread(compute_file_hash, source)
+        extracted_data = await asyncio.to_thread(self.lookup_cache, file_hash)
+
+        if extracted_data is None:
+            with timed('pdf_extract'):
+                extraction = await asyncio.get_running_loop().run_in_executor(
+                    get_extract_pool(), extract_document_in_worker, source
+                )
+            # Extraction ran in a worker process, so its timings are recorded here
+            self.record_extraction(extraction)
+            extracted_data = await self.extract_fields_async(extraction, file_hash)
+            if 'error' in extracted_data:
+                return {'error': extracted_data['error']}
+
+        return await asyncio.to_thread(self.finalize, extracted_data, deadhead, file_hash, truck_location)
+
+    async def extract_fields_async(self, extraction, file_hash=None):
+        """
+        extract_fields with an awaited, unbatched AI request. The local steps
+        (regex, templates, indexes and their SQLite writes) run in threads.
+        """
+        if not extraction['text'].strip():
+            return {'error': 'No text could be read from the document'}
+
+        extracted_data = await asyncio.to_thread(self.try_fast_path, extraction, file_hash)
+        if extracted_data is not None:
+            return extracted_data
+
+        extracted_data = await self.try_revision_async(extraction, file_hash)
+        if extracted_data is not None:
+            return extracted_data
+
+        async with admission_controller.admit_async(self.priority):
+            extracted_data = await self._get_ai_processor().extract_fields_async(
+                extraction['text'], extraction.get('page_count', 1), len(extraction.get('ocr_pages', []))
+            )
+        if 'error' not in extracted_data:
+            await asyncio.to_thread(self.store, file_hash, extracted_data, extraction)
+            await asyncio.to_thread(self.learn_layout, extraction, extracted_data)
+        return extracted_data
+
+    def analyze_stream(self, source, deadhead=0, file_hash=None, truck_location=None):
+        """
+        Run the pipeline for one file, yielding (event, data) pairs as each
+        stage finishes: 'extracted', 'fields' (fast path fields, then AI
+        fields as Gemini streams them), and finally 'result' with the
+        formatted response or 'error'. Always uses an unbatched AI request,
+        since queueing for a batch would delay the first fields. An error
+        from admission control (taken only for the AI) carries its status
+        and retry_after.
+        """
+        started = time.time()
+        file_hash = file_hash or compute_file_hash(source)
+        extracted_data = self.lookup_cache(file_hash)
+        if extracted_data is not None:
+            yield 'cached', {'elapsed': round(time.time() - started, 3)}
+            yield 'result', self.finalize(extracted_data, deadhead, file_hash, truck_location)
+            return
+
+        try:
+            yield from self._analyze_uncached_stream(source, deadhead, file_hash, truck_location, started)
+        except AdmissionRejected as e:
+            yield 'error', {'error': str(e), 'status': e.status, 'retry_after': e.retry_after}
+
+    def _analyze_uncached_stream(self, source, deadhead, file_hash, truck_location, started):
+        """analyze_stream from text extraction on, for a file that is not cached"""
+        extraction = self.extract_document(source)
+        yield 'extracted', {
+            'chars': len(extraction['text']),
+            'page_count': extraction['page_count'],
+            'pages_extracted': extraction['pages_extracted'],
+            'truncated': extraction['truncated'],
+            'ocr_pages': extraction.get('ocr_pages', []),
+            'elapsed': round(time.time() - started, 3)
+        }
+        if not extraction['text'].strip():
+            yield 'error', {'error': 'No text could be read from the document'}
+            return
+
+        fields = {}
+        if Config.FAST_PATH_ENABLED:
+            known_fields, audit = {}, False
+            if Config.TEMPLATES_ENABLED:
+                known_fields = template_index.match(extraction.get('words'))
+                audit = bool(known_fields) and template_index.sample_audit()
+            with timed('fast_path'):
+                local = FallbackProcessor().extract_fields(extraction['text'], known_fields=known_fields)
+            fields = {
+                field: local['fields'][field]
+                for field in EXTRACTED_FIELDS
+                if local['confidence'].get(field, 0) >= Config.FAST_PATH_MIN_CONFIDENCE
+            }
+            if fields:
+                yield 'fields', {'source': 'fast_path', 'fields': fields, 'elapsed': round(time.time() - started, 3)}
+            if len(fields) == len(EXTRACTED_FIELDS) and not audit:
+                print(f"Fast path extraction succeeded (template: {local['template']})")
+                self.store(file_hash, fields, extraction)
+                yield 'result', self.finalize(fields, deadhead, file_hash, truck_location)
+                return
+
+        extracted_data = self.try_revision(extraction, file_hash)
+        if extracted_data is not None:
+            # Fields not on screen yet or corrected, like AI fields below
+            yield 'fields', {
+                'source': 'revision',
+                'fields': {
+                    field: extracted_data[field]
+                    for field in EXTRACTED_FIELDS if fields.get(field) != extracted_data.get(field)
+                },
+                'elapsed': round(time.time() - started, 3)
+            }
+            yield 'result', self.finalize(extracted_data, deadhead, file_hash, truck_location)
+            return
+
+        with admission_controller.admit(self.priority):
+            for event in self._get_ai_processor().stream_fields(
+                extraction['text'], page_count=extraction.get('page_count', 1),
+                ocr_pages=len(extraction.get('ocr_pages', []))
+            ):
+                if event['event'] == 'field':
+                    # Confident local values are already on screen; only send what the AI adds or corrects
+                    if fields.get(event['field']) != event['value']:
+                        yield 'fields', {
+                            'source': 'ai',
+                            'fields': {event['field']: event['value']},
+                            'elapsed': round(time.time() - started, 3)
+                        }
+                elif event['event'] == 'error':
+                    yield 'error', {'error': event['error']}
+                    return
+                else:
+                    extracted_data = event['data']
+                    if 'error' in extracted_data:
+                        yield 'error', {'error': extracted_data['error']}
+                        return
+                    self.store(file_hash, extracted_data, extraction)
+                    self.learn_layout(extraction, extracted_data)
+                    yield 'result', self.finalize(extracted_data, deadhead, file_hash, truck_location)
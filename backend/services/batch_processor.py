@@ -0,0 +1,245 @@
+import os
+import time
+import uuid
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from config import Config
+from services.analysis_pipeline import AnalysisPipeline, extract_document_in_worker
+from services.ai_processor import AIProcessor
+from services.admission import AdmissionRejected
+from utils.helpers import compute_file_hash, worker_context
+
+class BatchJob:
+    """
+    State of one batch submission. Items are completed out of order;
+    completion order is kept so results can be streamed as they finish.
+    """
+
+    def __init__(self, files, deadhead=0, truck_location=None):
+        self.job_id = uuid.uuid4().hex
+        self.deadhead = deadhead
+        self.truck_location = truck_location
+        self.created_at = time.time()
+        self.finished_at = None
+        self.pipeline = AnalysisPipeline(AIProcessor(), priority='bulk')
+        self.items = [
+            {
+                'index': index,
+                'filename': filename,
+                'file_path': file_path,
+                'status': 'queued',
+                'result': None,
+                'error': None
+            }
+            for index, (filename, file_path) in enumerate(files)
+        ]
+        self.completed_order = []
+        self.condition = threading.Condition()
+
+    def set_item_status(self, index, status):
+        with self.condition:
+            self.items[index]['status'] = status
+
+    def complete_item(self, index, result=None, error=None):
+        """Record an item result and wake up streaming readers"""
+        with self.condition:
+            item = self.items[index]
+            item['status'] = 'failed' if error else 'completed'
+            item['result'] = result
+            item['error'] = error
+            self.completed_order.append(index)
+            if len(self.completed_order) == len(self.items):
+                self.finished_at = time.time()
+            self.condition.notify_all()
+
+        try:
+            os.remove(item['file_path'])
+        except OSError:
+            pass
+
+    def is_done(self):
+        return len(self.completed_order) == len(self.items)
+
+    def _item_view(self, item):
+        return {
+            'index': item['index'],
+            'filename': item['filename'],
+            'status': item['status'],
+            'result': item['result'],
+            'error': item['error']
+        }
+
+    def get_status(self):
+        """Get job progress without the per-item results"""
+        with self.condition:
+            counts = {}
+            for item in self.items:
+                counts[item['status']] = counts.get(item['status'], 0) + 1
+            return {
+                'job_id': self.job_id,
+                'status': 'completed' if self.is_done() else 'processing',
+                'total': len(self.items),
+                'counts': counts,
+                'created_at': self.created_at,
+                'finished_at': self.finished_at,
+                'items': [
+                    {'index': item['index'], 'filename': item['filename'], 'status': item['status']}
+                    for item in self.items
+                ]
+            }
+
+    def get_results(self):
+        """Get all finished items in completion order"""
+        with self.condition:
+            return [self._item_view(self.items[index]) for index in self.completed_order]
+
+    def iter_results(self, timeout=None):
+        """Yield items as they complete until the job is done or timeout expires"""
+        deadline = time.time() + timeout if timeout else None
+        sent = 0
+        while True:
+            with self.condition:
+                while sent >= len(self.completed_order) and not self.is_done():
+                    remaining = deadline - time.time() if deadline else None
+                    if remaining is not None and remaining <= 0:
+                        return
+                    self.condition.wait(timeout=remaining)
+                pending = [self._item_view(self.items[index]) for index in self.completed_order[sent:]]
+                done = self.is_done()
+
+            for item in pending:
+                sent += 1
+                yield item
+
+            if done and sent >= len(self.items):
+                return
+
+class BatchProcessor:
+    """
+    Bounded worker pool for batch analysis. PDF extraction runs in a process
+    pool; AI calls run in a thread pool sized from the number of API keys and
+    are admitted as bulk work, behind interactive uploads.
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self._extract_pool = None
+        self._ai_pool = None
+
+    def _get_pools(self):
+        with self.lock:
+            if self._extract_pool is None:
+                self._extract_pool = ProcessPoolExecutor(
+                    max_workers=Config.BATCH_EXTRACT_WORKERS, mp_context=worker_context()
+                )
+            if self._ai_pool is None:
+                key_count = len([key for key in Config.GOOGLE_AI_KEYS if key.strip()])
+                ai_workers = max(1, key_count) * Config.BATCH_AI_WORKERS_PER_KEY
+                self._ai_pool = ThreadPoolExecutor(max_workers=ai_workers, thread_name_prefix='batch-ai')
+            return self._extract_pool, self._ai_pool
+
+    def submit(self, files, deadhead=0, truck_location=None):
+        """
+        Queue a list of (filename, file_path) tuples for analysis.
+        Returns the created BatchJob.
+        """
+        self._prune_jobs()
+        job = BatchJob(files, deadhead, truck_location)
+        with self.lock:
+            self.jobs[job.job_id] = job
+
+        extract_pool, ai_pool = self._get_pools()
+        for item in job.items:
+            index = item['index']
+            try:
+                file_hash = compute_file_hash(item['file_path'])
+                extracted_data = job.pipeline.lookup_cache(file_hash)
+            except OSError as e:
+                job.complete_item(index, error=f"File read error: {str(e)}")
+                continue
+
+            if extracted_data is not None:
+                job.complete_item(index, result=job.pipeline.finalize(extracted_data, deadhead, file_hash, truck_location))
+                continue
+
+            job.set_item_status(index, 'extracting')
+            future = extract_pool.submit(extract_document_in_worker, item['file_path'])
+            future.add_done_callback(
+                lambda f, index=index, file_hash=file_hash: ai_pool.submit(
+                    self._run_ai_stage, job, index, file_hash, f
+                )
+            )
+
+        print(f"Batch job {job.job_id} queued with {len(job.items)} files")
+        return job
+
+    def _run_ai_stage(self, job, index, file_hash, extract_future):
+        """Run the AI extraction for one item once its text is ready"""
+        try:
+            extraction = extract_future.result()
+        except Exception as e:
+            job.complete_item(index, error=f"PDF extraction error: {str(e)}")
+            return
+        # Extraction ran in a worker process, so its timings are recorded here
+        job.pipeline.record_extraction(extraction)
+
+        try:
+            # Confident local extractions never need an API key
+            extracted_data = job.pipeline.try_fast_path(extraction, file_hash)
+            if extracted_data is not None:
+                job.complete_item(index, result=job.pipeline.finalize(
+                    extracted_data, job.deadhead, file_hash, job.truck_location
+                ))
+                return
+
+            job.set_item_status(index, 'analyzing')
+            try:
+                extracted_data = self._extract_admitted(job, extraction, file_hash)
+            except AdmissionRejected as e:
+                job.complete_item(index, error=str(e))
+                return
+            if 'error' in extracted_data:
+                job.complete_item(index, error=extracted_data['error'])
+            else:
+                job.complete_item(index, result=job.pipeline.finalize(
+                    extracted_data, job.deadhead, file_hash, job.truck_location
+                ))
+        except Exception as e:
+            job.complete_item(index, error=f"AI processing error: {str(e)}")
+
+    def _extract_admitted(self, job, extraction, file_hash):
+        """
+        AI extraction as bulk work (the pipeline admits its AI calls in the
+        job's priority class). Items shed for interactive uploads or timed
+        out in the queue try again until BATCH_CAPACITY_WAIT_SECONDS have
+        passed; only a wait that can't be met at all fails the item.
+        """
+        give_up_at = time.time() + Config.BATCH_CAPACITY_WAIT_SECONDS
+        while True:
+            try:
+                return job.pipeline.extract_fields(
+                    extraction, file_hash, use_fast_path=False, batched=Config.AI_BATCHING_FOR_JOBS
+                )
+            except AdmissionRejected as e:
+                if e.reason not in ('shed', 'timed_out') or time.time() + e.retry_after > give_up_at:
+                    raise
+                time.sleep(e.retry_after)
+
+    def get_job(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _prune_jobs(self):
+        """Drop finished jobs older than the retention window"""
+        cutoff = time.time() - Config.BATCH_JOB_TTL_SECONDS
+        with self.lock:
+            expired = [
+                job_id for job_id, job in self.jobs.items()
+                if job.finished_at and job.finished_at < cutoff
+            ]
+            for job_id in expired:
+                del self.jobs[job_id]
+
+# Global instance
+batch_processor = BatchProcessor()
@@ -1,57 +1,294 @@
+import os
 import re
 import json
+from typing import Dict, Any, List, Optional, Tuple
+from config import Config
+from utils.helpers import EXTRACTED_FIELDS, add_calculated_fields
+
+_FLAGS = re.IGNORECASE | re.MULTILINE
+
+_ZIP_RE = re.compile(r'\b\d{5}(?:-\d{4})?\b')
+_STATE_RE = re.compile(r'\b[A-Z]{2}\b')
+_DATE_RE = re.compile(
+    r'\b(?:\d{1,2}[/-]\d{1,2}(?:[/-]\d{2,4})?|'
+    r'(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?\s+\d{1,2})\b',
+    re.IGNORECASE
+)
+
+# Generic label-based patterns: field -> [(compiled pattern, base confidence)]
+FIELD_PATTERNS = {
+    'broker_name': [
+        (re.compile(r'^\s*broker\s*(?:name)?\s*[:#]\s*([^\n]+)', _FLAGS), 0.9),
+        (re.compile(r'broker[:\s]+([^\n]+)', _FLAGS), 0.6),
+    ],
+    'carrier_name': [
+        (re.compile(r'^\s*carrier\s*(?:name)?\s*[:#]\s*([^\n]+)', _FLAGS), 0.9),
+        (re.compile(r'carrier[:\s]+([^\n]+)', _FLAGS), 0.6),
+    ],
+    'load_number': [
+        (re.compile(r'\bload\s*(?:#|no\.?|number|id)\s*[:#]?\s*([A-Z0-9][A-Z0-9-]{2,})', _FLAGS), 0.95),
+        (re.compile(r'load[:\s#]+([A-Z0-9-]+)', _FLAGS), 0.6),
+    ],
+    'pickup_number': [
+        (re.compile(
+            r'\b(?:pickup|pu|pro|bol|reference|ref)\s*(?:#|no\.?|number)\s*[:#]?\s*([A-Z0-9][A-Z0-9-]{2,})',
+            _FLAGS
+        ), 0.9),
+        (re.compile(r'pickup[:\s#]+([A-Z0-9-]+)', _FLAGS), 0.5),
+    ],
+    'rate': [
+        (re.compile(
+            r'\b(?:total\s+(?:rate|pay|carrier\s+pay|amount)|carrier\s+pay)\s*[:\s]*\$\s*([\d,]+(?:\.\d{2})?)',
+            _FLAGS
+        ), 0.95),
+        (re.compile(r'rate[:\s$]+([\d,]+\.?\d*)', _FLAGS), 0.6),
+    ],
+    'distance': [
+        (re.compile(r'\b(?:total\s+)?(?:miles|mileage|distance)\s*[:\s]+([\d,]+)', _FLAGS), 0.9),
+        (re.compile(r'\b([\d,]+)\s*(?:loaded\s+)?mi(?:les)?\b', _FLAGS), 0.7),
+    ],
+    'pickup_address': [
+        (re.compile(r'^\s*(?:pickup|shipper|origin)\s*(?:address|location)?\s*[:#]\s*([^\n]+)', _FLAGS), 0.9),
+        (re.compile(r'pickup[:\s]+([^\n]+)', _FLAGS), 0.5),
+    ],
+    'pickup_time': [
+        (re.compile(
+            r'^\s*(?:pickup|ship|shipper)\s*(?:date|time|date/time|appt|appointment)\s*[:#]\s*([^\n]+)',
+            _FLAGS
+        ), 0.9),
+    ],
+    'delivery_address': [
+        (re.compile(
+            r'^\s*(?:delivery|consignee|destination|drop)\s*(?:address|location)?\s*[:#]\s*([^\n]+)',
+            _FLAGS
+        ), 0.9),
+        (re.compile(r'delivery[:\s]+([^\n]+)', _FLAGS), 0.5),
+    ],
+    'delivery_time': [
+        (re.compile(
+            r'^\s*(?:delivery|deliver|consignee|drop)\s*(?:date|time|date/time|appt|appointment)\s*[:#]\s*([^\n]+)',
+            _FLAGS
+        ), 0.9),
+    ],
+    'commodity': [
+        (re.compile(r'^\s*commodity\s*(?:description)?\s*[:#]\s*([^\n]+)', _FLAGS), 0.9),
+        (re.compile(r'commodity[:\s]+([^\n]+)', _FLAGS), 0.6),
+    ],
+    'weight': [
+        (re.compile(r'\bweight\s*[:\s]+([\d,]+)\s*(?:lbs?|pounds)\b', _FLAGS), 0.95),
+        (re.compile(r'weight[:\s]+([\d,]+)', _FLAGS), 0.7),
+    ],
+    'equipment': [
+        (re.compile(r'^\s*(?:equipment|trailer)\s*(?:type)?\s*[:#]\s*([^\n]+)', _FLAGS), 0.9),
+        (re.compile(
+            r'\b(dry\s*van|reefer|refrigerated|flatbed|step\s*deck|conestoga|power\s*only|hotshot|van)\b',
+            _FLAGS
+        ), 0.6),
+    ],
+    'notes': [
+        (re.compile(r'^\s*(?:notes|special\s+instructions|comments|remarks)\s*[:#]\s*([^\n]+)', _FLAGS), 0.85),
+    ],
+}
+
+NUMERIC_FIELDS = {
+    # field -> plausible (min, max) range
+    'rate': (50, 50000),
+    'distance': (1, 5000),
+    'weight': (1, 80000),
+}
+
+ADDRESS_FIELDS = {'pickup_address', 'delivery_address'}
+TIME_FIELDS = {'pickup_time', 'delivery_time'}
+
+# Base confidence of a value read from a learned layout template's box
+LAYOUT_CONFIDENCE = 0.97
+
+def load_broker_templates(path):
+    """
+    Load per-broker regex templates from a JSON file. Each entry looks like:
+    {"name": "...", "match": "<regex identifying the broker>",
+     "fields": {"<field>": "<regex with one group>"},
+     "defaults": {"<field>": "<value used when the layout never has it>"}}
+    """
+    if not path or not os.path.exists(path):
+        return []
+
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            raw_templates = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Could not load broker templates from {path}: {e}")
+        return []
+
+    templates = []
+    for entry in raw_templates:
+        try:
+            templates.append({
+                'name': entry['name'],
+                'match': re.compile(entry['match'], _FLAGS),
+                'fields': {
+                    field: re.compile(pattern, _FLAGS)
+                    for field, pattern in entry.get('fields', {}).items()
+                },
+                'defaults': entry.get('defaults', {}),
+                'confidence': float(entry.get('confidence', 0.97))
+            })
+        except (KeyError, re.error) as e:
+            print(f"Skipping invalid broker template {entry.get('name', '?')}: {e}")
+    print(f"Loaded {len(templates)} broker templates")
+    return templates
 
 class FallbackProcessor:
-    def __init__(self):
-        pass
-    
+    """
+    Local regex extractor. Used as a first pass before the AI: every field
+    gets a confidence score and the caller decides whether it is good enough.
+    """
+
+    _templates = None
+
+    def __init__(self, templates=None):
+        if templates is not None:
+            self.templates = templates
+        else:
+            if FallbackProcessor._templates is None:
+                FallbackProcessor._templates = load_broker_templates(Config.BROKER_TEMPLATES_PATH)
+            self.templates = FallbackProcessor._templates
+
     def process_with_fallback(self, text: str, deadhead: int = 0) -> Dict[str, Any]:
         """
         Резервний метод обробки, якщо основні не працюють
         """
         try:
-            # Спрощена обробка
-            result = {
-                'broker_name': self._extract_pattern(text, r'broker[:\s]+([^\n]+)'),
-                'carrier_name': self._extract_pattern(text, r'carrier[:\s]+([^\n]+)'),
-                'load_number': self._extract_pattern(text, r'load[:\s#]+([A-Z0-9-]+)'),
-                'pickup_number': self._extract_pattern(text, r'pickup[:\s#]+([A-Z0-9-]+)'),
-                'rate': self._extract_numeric(text, r'rate[:\s$]+([\d,]+\.?\d*)'),
-                'distance': self._extract_numeric(text, r'distance[:\s]+(\d+)'),
-                'pickup_address': self._extract_pattern(text, r'pickup[:\s]+([^\n]+)'),
-                'delivery_address': self._extract_pattern(text, r'delivery[:\s]+([^\n]+)'),
-                'commodity': self._extract_pattern(text, r'commodity[:\s]+([^\n]+)'),
-                'weight': self._extract_numeric(text, r'weight[:\s]+(\d+)'),
-                'notes': 'Extracted with fallback parser'
-            }
-            
-            # Додаємо calculated fields
-            try:
-                rate = float(result.get('rate', 0))
-                distance = float(result.get('distance', 0))
-                total_distance = distance + deadhead
-                result['total_distance'] = total_distance
-                result['rate_per_mile'] = round(rate / total_distance, 2) if total_distance > 0 else 0
-            except:
-                result['total_distance'] = 'n/a'
-                result['rate_per_mile'] = 'n/a'
-            
-            return result
-            
+            result = self.extract_fields(text)['fields']
+            if result['notes'] == 'Not found':
+                result['notes'] = 'Extracted with fallback parser'
+            return add_calculated_fields(result, deadhead)
         except Exception as e:
             return {"error": f"Fallback processing failed: {str(e)}"}
-    
-    def _extract_pattern(self, text: str, pattern: str) -> str:
-        """Витягнути текст за шаблоном"""
-        match = re.search(pattern, text, re.IGNORECASE)
-        return match.group(1).strip() if match else 'Not found'
-    
-    def _extract_numeric(self, text: str, pattern: str) -> float:
-        """Витягнути числове значення"""
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            try:
-                return float(match.group(1).replace(',', ''))
-            except:
-                pass
-        return 0
+
+    def extract_fields(self, text: str, known_fields: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Extract all fields with a confidence score per field. known_fields are
+        values read elsewhere (e.g. from a learned layout template); they are
+        validated like regex matches, and a better scoring match replaces
+        one below FAST_PATH_MIN_CONFIDENCE.
+        Returns {'fields': {...}, 'confidence': {...}, 'template': name or None}
+        """
+        fields, confidence = {}, {}
+        for field, value in (known_fields or {}).items():
+            value, score = self._score_value(field, str(value), LAYOUT_CONFIDENCE)
+            if value is not None:
+                fields[field] = value
+                confidence[field] = score
+
+        template = self._match_template(text)
+        if template:
+            for field, pattern in template['fields'].items():
+                if self._settled(field, confidence):
+                    continue
+                value, score = self._score_candidate(field, pattern.search(text), template['confidence'])
+                if value is not None and score > confidence.get(field, 0):
+                    fields[field] = value
+                    confidence[field] = score
+            for field, value in template['defaults'].items():
+                if field not in fields:
+                    fields[field] = value
+                    confidence[field] = template['confidence']
+
+        for field in EXTRACTED_FIELDS:
+            if self._settled(field, confidence):
+                continue
+            value, score = self._best_generic_match(text, field)
+            if value is not None and score > confidence.get(field, 0):
+                fields[field] = value
+                confidence[field] = score
+            elif field not in fields:
+                fields[field] = 'Not found'
+                confidence[field] = score
+
+        return {
+            'fields': fields,
+            'confidence': confidence,
+            'template': template['name'] if template else None
+        }
+
+    def try_fast_path(self, text: str, min_confidence: Optional[float] = None,
+                      known_fields: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """
+        Return the raw extraction if every field clears the confidence
+        threshold, otherwise None so the caller falls back to the AI.
+        """
+        if min_confidence is None:
+            min_confidence = Config.FAST_PATH_MIN_CONFIDENCE
+
+        extraction = self.extract_fields(text, known_fields)
+        low_confidence = self._low_confidence_fields(extraction['confidence'], min_confidence)
+        if low_confidence:
+            print(f"Fast path skipped, low confidence: {', '.join(low_confidence)}")
+            return None
+
+        print(
+            f"Fast path extraction succeeded (template: {extraction['template']}, "
+            f"layout fields: {len(known_fields or {})})"
+        )
+        return extraction['fields']
+
+    def _settled(self, field: str, confidence: Dict[str, float]) -> bool:
+        """Whether a field already has a value confident enough to skip the remaining patterns"""
+        return confidence.get(field, 0) >= Config.FAST_PATH_MIN_CONFIDENCE
+
+    def _low_confidence_fields(self, confidence: Dict[str, float], min_confidence: float) -> List[str]:
+        return [field for field in EXTRACTED_FIELDS if confidence.get(field, 0) < min_confidence]
+
+    def _match_template(self, text: str) -> Optional[Dict[str, Any]]:
+        for template in self.templates:
+            if template['match'].search(text):
+                return template
+        return None
+
+    def _best_generic_match(self, text: str, field: str) -> Tuple[Optional[Any], float]:
+        best_value, best_score = None, 0.0
+        for pattern, base_confidence in FIELD_PATTERNS.get(field, []):
+            value, score = self._score_candidate(field, pattern.search(text), base_confidence)
+            if value is not None and score > best_score:
+                best_value, best_score = value, score
+        return best_value, best_score
+
+    def _score_candidate(self, field: str, match, base_confidence: float) -> Tuple[Optional[Any], float]:
+        """Normalize a regex match and adjust its confidence by validating the value"""
+        if not match:
+            return None, 0.0
+
+        raw_value = match.group(1).strip() if match.groups() else match.group(0).strip()
+        return self._score_value(field, raw_value, base_confidence)
+
+    def _score_value(self, field: str, raw_value: str, base_confidence: float) -> Tuple[Optional[Any], float]:
+        """Normalize a raw value and adjust its confidence by validating it"""
+        raw_value = raw_value.strip()
+        if not raw_value or raw_value == 'Not found':
+            return None, 0.0
+
+        if field in NUMERIC_FIELDS:
+            value = self._to_number(raw_value)
+            if value is None:
+                return None, 0.0
+            low, high = NUMERIC_FIELDS[field]
+            return value, base_confidence if low <= value <= high else base_confidence * 0.3
+
+        if field in ADDRESS_FIELDS:
+            has_zip = bool(_ZIP_RE.search(raw_value))
+            has_state = bool(_STATE_RE.search(raw_value))
+            if has_zip:
+                return raw_value, base_confidence
+            return raw_value, base_confidence * (0.7 if has_state else 0.4)
+
+        if field in TIME_FIELDS:
+            return raw_value, base_confidence if _DATE_RE.search(raw_value) else base_confidence * 0.5
+
+        return raw_value, base_confidence
+
+    def _to_number(self, value: str) -> Optional[float]:
+        try:
+            return float(value.replace(',', '').replace('$', ''))
+        except ValueError:
+            return None
@@ -0,0 +1,123 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+from services.key_manager import key_manager
+
+class GeminiClientPool:
+    """
+    One long-lived GenerativeServiceClient per API key, built once per
+    process. Models are bound to their key's client instead of calling
+    genai.configure, which mutates global state shared by all threads.
+    The clients' channels keep their connections open between requests.
+    Clients are built on first use so importing the app stays fast. The
+    ASGI app gets models bound to per-key asyncio gRPC clients instead;
+    with the REST transport (which has no asyncio client) its calls run
+    on a thread pool.
+    """
+
+    def __init__(self):
+        self.clients = {}  # api key -> GenerativeServiceClient
+        self.models = {}  # (api key, model name) -> GenerativeModel
+        self.async_clients = {}  # api key -> GenerativeServiceAsyncClient
+        self.async_models = {}  # (api key, model name) -> GenerativeModel
+        self.lock = threading.Lock()
+        self._initialized_keys = None
+        self._rest_executor = None
+
+    def initialize(self, keys):
+        """Register keys with the key manager (idempotent); clients are built lazily"""
+        active_keys = tuple(key for key in keys if key.strip())
+        with self.lock:
+            if self._initialized_keys == active_keys:
+                return
+            key_manager.initialize_keys(list(active_keys))
+            self._initialized_keys = active_keys
+            print(f"Gemini client pool ready for {len(active_keys)} keys")
+
+    def _build_client(self, api_key):
+        from google.ai import generativelanguage as glm
+        from google.api_core.client_options import ClientOptions
+
+        return glm.GenerativeServiceClient(
+            client_options=ClientOptions(api_key=api_key, api_endpoint=Config.GEMINI_API_ENDPOINT or None),
+            transport=Config.GEMINI_TRANSPORT
+        )
+
+    @property
+    def native_async(self):
+        """Whether the transport has an asyncio client (gRPC does, REST doesn't)"""
+        return Config.GEMINI_TRANSPORT == 'grpc'
+
+    def _build_async_client(self, api_key):
+        from google.ai import generativelanguage as glm
+        from google.api_core.client_options import ClientOptions
+
+        return glm.GenerativeServiceAsyncClient(
+            client_options=ClientOptions(api_key=api_key, api_endpoint=Config.GEMINI_API_ENDPOINT or None),
+            transport='grpc_asyncio'
+        )
+
+    def get_async_model(self, api_key, model_name):
+        """
+        GenerativeModel for generate_content_async, bound to api_key's
+        asyncio client. Build it on the event loop that will use it: the
+        client's channel belongs to that loop.
+        """
+        cache_key = (api_key, model_name)
+        model = self.async_models.get(cache_key)
+        if model is not None:
+            return model
+
+        with self.lock:
+            model = self.async_models.get(cache_key)
+            if model is None:
+                client = self.async_clients.get(api_key)
+                if client is None:
+                    client = self.async_clients[api_key] = self._build_async_client(api_key)
+                import google.generativeai as genai
+                model = genai.GenerativeModel(model_name)
+                model._async_client = client
+                self.async_models[cache_key] = model
+            return model
+
+    def get_rest_executor(self):
+        """Threads that run blocking REST calls for the ASGI app"""
+        with self.lock:
+            if self._rest_executor is None:
+                self._rest_executor = ThreadPoolExecutor(
+                    max_workers=Config.ASYNC_REST_THREADS, thread_name_prefix='gemini-rest'
+                )
+            return self._rest_executor
+
+    def get_model(self, api_key, model_name):
+        """Return a GenerativeModel bound to api_key's pooled client"""
+        cache_key = (api_key, model_name)
+        model = self.models.get(cache_key)
+        if model is not None:
+            return model
+
+        with self.lock:
+            model = self.models.get(cache_key)
+            if model is None:
+                client = self.clients.get(api_key)
+                if client is None:
+                    client = self.clients[api_key] = self._build_client(api_key)
+                import google.generativeai as genai
+                model = genai.GenerativeModel(model_name)
+                # GenerativeModel only falls back to the global client when none is set
+                model._client = client
+                self.models[cache_key] = model
+            return model
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'clients': len(self.clients),
+                'models': len(self.models),
+                'async_clients': len(self.async_clients),
+                'transport': Config.GEMINI_TRANSPORT,
+                'endpoint': Config.GEMINI_API_ENDPOINT or 'default'
+            }
+
+# Global instance
+gemini_pool = GeminiClientPool()
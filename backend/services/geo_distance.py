@@ -0,0 +1,197 @@
+import os
+import re
+import math
+import threading
+from functools import lru_cache
+from collections import namedtuple
+from config import Config
+from utils.helpers import extract_state
+
+# NumPy is imported where it is used so the app starts quickly
+EARTH_RADIUS_MILES = 3958.8
+
+_ZIP_PATTERN = re.compile(r'\b(\d{5})(?:-\d{4})?\b')
+_CITY_WORDS = 4  # longest city name tried when an address has no commas ("Salt Lake City")
+
+# A resolved centroid; key is the ZIP or 'ST:CITY', source is 'zip' or 'city'
+GeoPoint = namedtuple('GeoPoint', ['key', 'lat', 'lon', 'state', 'source'])
+
+def haversine_miles(lat1, lon1, lat2, lon2):
+    """Great-circle miles between points in degrees; works elementwise on NumPy arrays"""
+    import numpy as np
+
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(value, dtype=np.float64)) for value in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(a))
+
+def _haversine_scalar(lat1, lon1, lat2, lon2):
+    """haversine_miles for two points, without NumPy call overhead"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * math.asin(math.sqrt(a))
+
+_CITY_ABBREVIATIONS = {'ST': 'SAINT', 'STE': 'SAINTE', 'FT': 'FORT', 'MT': 'MOUNT'}
+
+def _city_keys(city, state):
+    """Table keys to try for a city: as written, then with St./Ft./Mt. spelled out"""
+    words = city.upper().replace('.', ' ').split()
+    keys = [f"{state}:{' '.join(words)}"]
+    if words and words[0] in _CITY_ABBREVIATIONS:
+        keys.append(f"{state}:{' '.join([_CITY_ABBREVIATIONS[words[0]]] + words[1:])}")
+    return [key[:24].encode('ascii', 'ignore') for key in keys]
+
+class GeoDistanceEngine:
+    """
+    Offline miles between RC addresses. Addresses resolve to a ZIP
+    centroid, or to a city centroid from "City, ST", using the bundled
+    tables in data/ (memory-mapped on first use). Road miles are the
+    great-circle distance times GEO_ROAD_FACTOR. Resolved addresses and
+    lanes are memoized, so repeated lanes cost a dict lookup.
+    """
+
+    def __init__(self, data_dir, road_factor=1.2, cache_size=50000):
+        self.data_dir = data_dir
+        self.road_factor = road_factor
+        self.lock = threading.Lock()
+        self.tables = None
+        self.resolve = lru_cache(maxsize=cache_size)(self._resolve)
+        self._lane_miles = lru_cache(maxsize=cache_size)(self._compute_lane_miles)
+
+    def _load(self):
+        if self.tables is not None:
+            return self.tables
+        with self.lock:
+            if self.tables is None:
+                import numpy as np
+
+                tables = {}
+                try:
+                    for name in ('zip_codes', 'zip_points', 'zip_states', 'city_keys', 'city_points'):
+                        tables[name] = np.load(os.path.join(self.data_dir, f'{name}.npy'), mmap_mode='r')
+                except (OSError, ValueError) as e:
+                    print(f"Geo tables not available in {self.data_dir}: {e}")
+                    tables = {}
+                self.tables = tables
+        return self.tables
+
+    @property
+    def available(self):
+        return bool(self._load())
+
+    def _zip_point(self, tables, zip_code, state=None):
+        import numpy as np
+
+        codes = tables['zip_codes']
+        index = int(np.searchsorted(codes, zip_code))
+        if index >= len(codes) or codes[index] != zip_code:
+            return None
+        zip_state = tables['zip_states'][index].decode()
+        if state and zip_state != state:
+            return None
+        lat, lon = tables['zip_points'][index]
+        return GeoPoint(f'{zip_code:05d}', float(lat), float(lon), zip_state, 'zip')
+
+    def _city_point(self, tables, city, state):
+        import numpy as np
+
+        keys = tables['city_keys']
+        for key in _city_keys(city, state):
+            index = int(np.searchsorted(keys, key))
+            if index < len(keys) and keys[index] == key:
+                lat, lon = tables['city_points'][index]
+                return GeoPoint(key.decode(), float(lat), float(lon), state, 'city')
+        return None
+
+    def _city_candidates(self, address, state):
+        """City names that could precede the state in an address, most specific first"""
+        text = _ZIP_PATTERN.sub(' ', address)
+        parts = [part.strip(' .') for part in text.split(',') if part.strip(' .')]
+        for position in range(len(parts) - 1, -1, -1):
+            words = parts[position].split()
+            if not words or words[-1].upper() != state:
+                continue
+            if len(words) == 1:
+                # "Dallas, TX": the city is the previous part
+                return [parts[position - 1]] if position > 0 else []
+            words = words[:-1]
+            # "123 Main St Dallas TX": try the last few words, longest first
+            return [' '.join(words[-count:]) for count in range(min(_CITY_WORDS, len(words)), 0, -1)]
+        return []
+
+    def _resolve(self, address):
+        """Centroid for an address, ZIP or "City, ST" (None when unknown)"""
+        tables = self._load()
+        if not tables or not isinstance(address, str):
+            return None
+        state = extract_state(address)
+
+        # Street numbers can look like ZIPs, so the last ZIP that fits the state wins
+        for zip_code in reversed(_ZIP_PATTERN.findall(address)):
+            point = self._zip_point(tables, int(zip_code), state)
+            if point:
+                return point
+        if state:
+            for city in self._city_candidates(address, state):
+                point = self._city_point(tables, city, state)
+                if point:
+                    return point
+        return None
+
+    def _compute_lane_miles(self, origin, destination):
+        straight = _haversine_scalar(origin.lat, origin.lon, destination.lat, destination.lon)
+        return round(straight * self.road_factor, 1)
+
+    def estimate_miles(self, origin_address, destination_address):
+        """Estimated road miles between two addresses, or None if either can't be resolved"""
+        origin = self.resolve(origin_address)
+        destination = self.resolve(destination_address)
+        if origin is None or destination is None:
+            return None
+        # Memoized per lane (resolved centroids), whatever the address spelling
+        return self._lane_miles(origin, destination)
+
+    def estimate_miles_many(self, origin_addresses, destination_addresses):
+        """Vectorized estimate_miles for parallel lists; NaN where an address can't be resolved"""
+        import numpy as np
+
+        coordinates = np.full((len(origin_addresses), 4), np.nan)
+        for row, (origin_address, destination_address) in enumerate(zip(origin_addresses, destination_addresses)):
+            origin = self.resolve(origin_address)
+            destination = self.resolve(destination_address)
+            if origin is not None and destination is not None:
+                coordinates[row] = (origin.lat, origin.lon, destination.lat, destination.lon)
+        miles = haversine_miles(coordinates[:, 0], coordinates[:, 1], coordinates[:, 2], coordinates[:, 3])
+        return np.round(miles * self.road_factor, 1)
+
+    def describe_lane(self, origin_address, destination_address):
+        """Resolved centroids and the estimate for an API response"""
+        origin = self.resolve(origin_address)
+        destination = self.resolve(destination_address)
+        result = {
+            'origin': origin._asdict() if origin else None,
+            'destination': destination._asdict() if destination else None,
+            'road_factor': self.road_factor,
+            'miles': None
+        }
+        if origin is not None and destination is not None:
+            straight = _haversine_scalar(origin.lat, origin.lon, destination.lat, destination.lon)
+            result['straight_line_miles'] = round(straight, 1)
+            result['miles'] = self.estimate_miles(origin_address, destination_address)
+        return result
+
+    def get_stats(self):
+        resolve_info = self.resolve.cache_info()
+        lane_info = self._lane_miles.cache_info()
+        return {
+            'available': self.available,
+            'road_factor': self.road_factor,
+            'resolved_addresses': resolve_info.currsize,
+            'resolve_hits': resolve_info.hits,
+            'lanes': lane_info.currsize,
+            'lane_hits': lane_info.hits
+        }
+
+# Global instance
+geo_distance = GeoDistanceEngine(
+    Config.GEO_DATA_DIR, road_factor=Config.GEO_ROAD_FACTOR, cache_size=Config.GEO_CACHE_SIZE
+)
@@ -0,0 +1,61 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+
+class LatencyTracker:
+    """
+    Sliding window of recent successful Gemini call durations. The hedge
+    delay is a high percentile of this window, so a duplicate request is
+    only sent for calls that are already slower than almost all others.
+    """
+
+    def __init__(self, window=200, min_samples=20):
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, fraction):
+        """Latency at the given fraction (0..1), or None until there are enough samples"""
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def summary(self):
+        """Sample count and p50/p95 seconds of the window, for stats"""
+        with self.lock:
+            ordered = sorted(self.samples)
+        if not ordered:
+            return {'samples': 0, 'p50': None, 'p95': None}
+        return {
+            'samples': len(ordered),
+            'p50': round(ordered[int(0.5 * (len(ordered) - 1))], 3),
+            'p95': round(ordered[int(0.95 * (len(ordered) - 1))], 3)
+        }
+
+    def hedge_delay(self):
+        """Seconds to wait on a call before hedging it"""
+        observed = self.percentile(Config.HEDGE_PERCENTILE)
+        if observed is None:
+            return Config.HEDGE_DEFAULT_DELAY
+        return max(observed, Config.HEDGE_MIN_DELAY)
+
+_hedge_pool = None
+_hedge_pool_lock = threading.Lock()
+
+def get_hedge_pool():
+    """Threads that run hedged Gemini attempts; losing attempts finish here in the background"""
+    global _hedge_pool
+    with _hedge_pool_lock:
+        if _hedge_pool is None:
+            _hedge_pool = ThreadPoolExecutor(max_workers=Config.HEDGE_WORKERS, thread_name_prefix='gemini-hedge')
+        return _hedge_pool
+
+# Global instance
+gemini_latency = LatencyTracker()
@@ -0,0 +1,67 @@
+import json
+
+class IncrementalJSONFieldParser:
+    """
+    Emits top-level "key": value pairs of a JSON object while it is still
+    being streamed. Text before the opening brace (e.g. a ```json fence)
+    is skipped.
+    """
+
+    def __init__(self):
+        self.buffer = ''
+        self.position = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.pair_start = None
+        self.emitted = set()
+
+    def feed(self, chunk):
+        """Add streamed text; return a list of (key, value) pairs completed by it"""
+        self.buffer += chunk
+        pairs = []
+
+        while self.position < len(self.buffer):
+            char = self.buffer[self.position]
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in '{[':
+                self.depth += 1
+                if self.depth == 1 and char == '{':
+                    self.pair_start = self.position + 1
+            elif char in '}]':
+                if self.depth == 1:
+                    pairs.extend(self._emit(self.position))
+                self.depth -= 1
+            elif char == ',' and self.depth == 1:
+                pairs.extend(self._emit(self.position))
+                self.pair_start = self.position + 1
+
+            self.position += 1
+
+        return pairs
+
+    def _emit(self, end):
+        if self.pair_start is None:
+            return []
+        pair_text = self.buffer[self.pair_start:end].strip()
+        if not pair_text:
+            return []
+        try:
+            pair = json.loads('{' + pair_text + '}')
+        except ValueError:
+            return []
+        result = []
+        for key, value in pair.items():
+            if key not in self.emitted:
+                self.emitted.add(key)
+                result.append((key, value))
+        return result
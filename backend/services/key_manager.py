@@ -1,139 +1,362 @@
 import time
+import asyncio
+import hashlib
 import threading
-from datetime import datetime, timedelta
-from collections import defaultdict
-import random
+from config import Config
+from services.key_state import create_key_state_backend
+
+def _default_limits():
+    return (Config.RATE_LIMIT_REQUESTS, Config.RATE_LIMIT_TOKENS)
+
+def _new_state(limits):
+    request_limit, token_limit = limits
+    return {
+        'status': 'active',
+        'last_used': 0,
+        'requests_count': 0,
+        'tokens_used': 0,
+        'errors_count': 0,
+        'last_error': None,
+        'disabled_until': 0,
+        # Token buckets: refill continuously to the per-minute limits
+        'requests_available': float(request_limit),
+        'tokens_available': float(token_limit),
+        'refilled_at': time.time()
+    }
+
+def _refill(state, now, limits):
+    """Refill both buckets and lift an expired rate-limit or error cooldown"""
+    request_limit, token_limit = limits
+    elapsed = now - state['refilled_at']
+    if elapsed > 0:
+        state['requests_available'] = min(
+            float(request_limit),
+            state['requests_available'] + elapsed * request_limit / 60.0
+        )
+        state['tokens_available'] = min(
+            float(token_limit),
+            state['tokens_available'] + elapsed * token_limit / 60.0
+        )
+        state['refilled_at'] = now
+    # Keys disabled before errors had a cooldown have disabled_until 0 and are lifted here too
+    if state['status'] in ('rate_limited', 'error') and now >= state['disabled_until']:
+        state['status'] = 'active'
+        state['errors_count'] = 0
+    return state
+
+def _has_capacity(state, estimated_tokens, limits):
+    return (
+        state['status'] == 'active'
+        and state['requests_available'] >= 1
+        and state['tokens_available'] >= min(estimated_tokens, limits[1])
+    )
+
+def _time_until_capacity(state, now, estimated_tokens, limits):
+    """Seconds until this key could take a request, counting its cooldown"""
+    request_limit, token_limit = limits
+    wait = max(0.0, state['disabled_until'] - now) if state['status'] != 'active' else 0.0
+    request_gap = max(0.0, 1 - state['requests_available'])
+    token_gap = max(0.0, min(estimated_tokens, token_limit) - state['tokens_available'])
+    return max(
+        wait,
+        request_gap * 60.0 / request_limit,
+        token_gap * 60.0 / token_limit
+    )
+
+class KeysExhausted(Exception):
+    """No key can take a request for the model within the wait allowed"""
 
 class APIKeyManager:
+    """
+    Per-key request/token buckets and cooldowns. The state lives in a
+    pluggable backend (KEY_STATE_BACKEND) so several gunicorn workers or
+    instances share one view of each key's quota. Cooldowns are stored as
+    wall-clock deadlines and lifted lazily when state is read, so no timer
+    threads are needed. Each model has its own buckets per key (Gemini
+    quotas are per model); calls without a model use the default model,
+    whose state is the key's original entry.
+    """
+
     _instance = None
     _lock = threading.Lock()
-    
+
     def __new__(cls):
         with cls._lock:
             if cls._instance is None:
                 cls._instance = super().__new__(cls)
                 cls._instance._initialized = False
             return cls._instance
-    
+
     def __init__(self):
         if self._initialized:
             return
-            
+
         self.keys = []
-        self.key_status = {}  # key -> {'status': 'active'|'rate_limited'|'error', 'last_used': timestamp, 'requests_count': 0, 'tokens_used': 0}
-        self.rate_limit_reset_time = time.time() + 60  # Reset every minute
+        self.key_ids = {}  # key -> stable id used in the shared backend (never the raw key)
+        self.backend = create_key_state_backend(Config.KEY_STATE_BACKEND)
         self.lock = threading.Lock()
+        self.capacity_changed = threading.Condition(self.lock)
+        self.model_limits = {}  # model -> (requests, tokens) per minute
+        self.default_model = None
         self._initialized = True
-    
-    def initialize_keys(self, keys):
-        """Initialize with API keys"""
-        with self.lock:
-            self.keys = [key for key in keys if key.strip()]
-            for key in self.keys:
-                self.key_status[key] = {
-                    'status': 'active',
-                    'last_used': 0,
-                    'requests_count': 0,
-                    'tokens_used': 0,
-                    'errors_count': 0,
-                    'last_error': None
-                }
-            print(f"Initialized {len(self.keys)} API keys")
-    
-    def get_active_key(self):
-        """Get an active API key with load balancing"""
-        with self.lock:
-            # Reset counters if minute has passed
-            if time.time() > self.rate_limit_reset_time:
-                self._reset_counters()
-            
-            active_keys = [
-                key for key in self.keys 
-                if self.key_status[key]['status'] == 'active'
-            ]
-            
-            if not active_keys:
-                # If all keys are rate limited, try to reset some
-                self._reset_old_rate_limits()
-                active_keys = [
-                    key for key in self.keys 
-                    if self.key_status[key]['status'] == 'active'
-                ]
-            
-            if not active_keys:
-                raise Exception("All API keys are rate limited or unavailable")
-            
-            # Choose key with least recent usage (round-robin with load balancing)
-            active_keys.sort(key=lambda k: self.key_status[k]['last_used'])
-            selected_key = active_keys[0]
-            
-            self.key_status[selected_key]['last_used'] = time.time()
-            self.key_status[selected_key]['requests_count'] += 1
-            
-            return selected_key
-    
-    def report_success(self, key, tokens_used=0):
-        """Report successful API call"""
-        with self.lock:
-            if key in self.key_status:
-                self.key_status[key]['tokens_used'] += tokens_used
-                self.key_status[key]['errors_count'] = 0
-    
-    def report_error(self, key, error_message):
-        """Report API error"""
+
+    def _key_id(self, key):
+        return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+    def key_label(self, key):
+        """Short, non-secret name for a key in logs and metrics"""
+        key_id = self.key_ids.get(key)
+        return key_id[:8] if key_id else 'none'
+
+    def configure_models(self, model_limits, default_model=None):
+        """Set per-minute (requests, tokens) limits per model; other models use RATE_LIMIT_*"""
         with self.lock:
-            if key in self.key_status:
-                self.key_status[key]['errors_count'] += 1
-                self.key_status[key]['last_error'] = error_message
-                
-                # If too many errors, temporarily disable the key
-                if self.key_status[key]['errors_count'] >= 5:
-                    self.key_status[key]['status'] = 'error'
-                    print(f"Key disabled due to multiple errors: {key[:10]}...")
-    
-    def report_rate_limit(self, key):
-        """Report rate limit hit"""
+            self.model_limits = dict(model_limits)
+            self.default_model = default_model
+
+    def _limits(self, model):
+        return self.model_limits.get(model or self.default_model) or _default_limits()
+
+    def _state_id(self, key_id, model):
+        if model is None or model == self.default_model:
+            return key_id
+        return f"{key_id}:{model.rsplit('/', 1)[-1]}"
+
+    def initialize_keys(self, keys):
+        """Initialize with API keys. Keys that are already known keep their state."""
+        active_keys = [key for key in keys if key.strip()]
         with self.lock:
-            if key in self.key_status:
-                self.key_status[key]['status'] = 'rate_limited'
-                # Auto-reenable after 2 minutes
-                threading.Timer(120, self._reenable_key, args=[key]).start()
-                print(f"Key rate limited: {key[:10]}...")
-    
-    def _reset_counters(self):
-        """Reset rate limit counters"""
-        for key in self.keys:
-            self.key_status[key]['requests_count'] = 0
-            self.key_status[key]['tokens_used'] = 0
-        self.rate_limit_reset_time = time.time() + 60
-    
-    def _reset_old_rate_limits(self):
-        """Reset old rate limits"""
-        current_time = time.time()
+            # Ids first, so readers iterating self.keys always find their state
+            self.key_ids = {key: self._key_id(key) for key in active_keys}
+            self.keys = active_keys
+        limits = self._limits(None)
         for key in self.keys:
-            if (self.key_status[key]['status'] == 'rate_limited' and 
-                current_time - self.key_status[key]['last_used'] > 120):
-                self.key_status[key]['status'] = 'active'
-                self.key_status[key]['errors_count'] = 0
-    
-    def _reenable_key(self, key):
-        """Re-enable a rate limited key"""
+            self.backend.update(self.key_ids[key], lambda state: (state or _new_state(limits), None))
+        print(f"Initialized {len(self.keys)} API keys ({self.backend.name} state)")
+
+    def _load_states(self, now, model=None):
+        limits = self._limits(model)
+        state_ids = {key: self._state_id(key_id, model) for key, key_id in self.key_ids.items()}
+        states = self.backend.load_many(list(state_ids.values()))
+        return {
+            key: _refill(states.get(state_id) or _new_state(limits), now, limits)
+            for key, state_id in state_ids.items()
+        }
+
+    def _ranked_keys(self, states, estimated_tokens, exclude=(), model=None):
+        """Keys with capacity, largest share of remaining capacity first"""
+        request_limit, token_limit = limits = self._limits(model)
+        candidates = [
+            key for key in self.keys
+            if key not in exclude and _has_capacity(states[key], estimated_tokens, limits)
+        ]
+        return sorted(candidates, key=lambda key: (
+            -min(
+                states[key]['requests_available'] / request_limit,
+                states[key]['tokens_available'] / token_limit
+            ),
+            states[key]['last_used']
+        ))
+
+    def _wait_time(self, states, now, estimated_tokens, exclude=(), model=None):
+        limits = self._limits(model)
+        waits = [
+            _time_until_capacity(states[key], now, estimated_tokens, limits)
+            for key in self.keys if key not in exclude
+        ]
+        waits = [wait for wait in waits if wait is not None]
+        return min(waits) if waits else None
+
+    def _try_reserve(self, estimated_tokens, exclude=(), model=None):
+        """
+        Reserve one request plus estimated_tokens on the key with the most
+        remaining capacity. Returns (key, None), or (None, seconds until a
+        key could have capacity; None if none ever will).
+        """
+        limits = self._limits(model)
+
+        def reserve(state):
+            state = _refill(state or _new_state(limits), time.time(), limits)
+            if not _has_capacity(state, estimated_tokens, limits):
+                return state, False
+            state['requests_available'] -= 1
+            state['tokens_available'] -= estimated_tokens
+            state['requests_count'] += 1
+            state['last_used'] = time.time()
+            return state, True
+
+        now = time.time()
+        states = self._load_states(now, model)
+        # Another worker may win the race for a key; then try the next one
+        for key in self._ranked_keys(states, estimated_tokens, exclude, model):
+            if self.backend.update(self._state_id(self.key_ids[key], model), reserve):
+                return key, None
+        return None, self._wait_time(states, now, estimated_tokens, exclude, model)
+
+    def get_active_key(self, estimated_tokens=0, timeout=0, exclude=(), model=None):
+        """
+        Get the active API key with the most remaining capacity for model
+        and reserve one request plus estimated_tokens on it. Waits up to
+        timeout seconds for capacity before giving up. Keys in exclude are
+        never returned.
+        """
+        deadline = time.time() + timeout
+        while True:
+            key, wait = self._try_reserve(estimated_tokens, exclude, model)
+            if key is not None:
+                return key
+            remaining = deadline - time.time()
+            if wait is None or remaining <= 0 or wait > remaining:
+                raise KeysExhausted("All API keys are rate limited or unavailable")
+            self._sleep(min(max(wait, 0.05), remaining))
+
+    async def get_active_key_async(self, estimated_tokens=0, timeout=0, exclude=(), model=None):
+        """
+        get_active_key for the event loop: the backend is read in a thread
+        (it may be SQLite or Redis) and waiting for capacity blocks none
+        """
+        deadline = time.time() + timeout
+        while True:
+            key, wait = await asyncio.to_thread(self._try_reserve, estimated_tokens, exclude, model)
+            if key is not None:
+                return key
+            remaining = deadline - time.time()
+            if wait is None or remaining <= 0 or wait > remaining:
+                raise KeysExhausted("All API keys are rate limited or unavailable")
+            await asyncio.sleep(min(max(wait, 0.05), remaining))
+
+    def wait_for_capacity(self, timeout, estimated_tokens=0, model=None):
+        """Block until some key could take a request, without reserving it"""
+        deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            states = self._load_states(now, model)
+            if self._ranked_keys(states, estimated_tokens, model=model):
+                return True
+            wait = self._wait_time(states, now, estimated_tokens, model=model)
+            remaining = deadline - now
+            if wait is None or remaining <= 0:
+                return False
+            self._sleep(min(max(wait, 0.05), remaining))
+
+    def _sleep(self, seconds):
+        """Wait for capacity; local reports wake waiters early"""
         with self.lock:
-            if key in self.key_status:
-                self.key_status[key]['status'] = 'active'
-                self.key_status[key]['errors_count'] = 0
-                print(f"Key re-enabled: {key[:10]}...")
-    
-    def get_status(self):
-        """Get current status of all keys"""
+            self.capacity_changed.wait(timeout=seconds)
+
+    def _notify(self):
         with self.lock:
-            status = {}
-            for key in self.keys:
-                status[key[:10] + '...'] = self.key_status[key].copy()
-                # Don't expose full key in status
-                if 'key' in status[key[:10] + '...']:
-                    del status[key[:10] + '...']['key']
-            return status
+            self.capacity_changed.notify_all()
+
+    def _update_key(self, key, update_fn, model=None):
+        key_id = self.key_ids.get(key)
+        if key_id is None:
+            return
+        limits = self._limits(model)
+
+        def apply(state):
+            state = _refill(state or _new_state(limits), time.time(), limits)
+            update_fn(state)
+            return state, None
+
+        self.backend.update(self._state_id(key_id, model), apply)
+
+    def get_available_capacity(self, model=None):
+        """Get number of requests active keys can make right now"""
+        states = self._load_states(time.time(), model)
+        return sum(
+            int(state['requests_available'])
+            for state in states.values()
+            if state['status'] == 'active' and state['requests_available'] > 0
+        )
+
+    def estimate_wait(self, requests=1, model=None):
+        """
+        Seconds until the keys could have served requests more calls for
+        model, counting what is left in the buckets now, the refill rate
+        and rate-limit or error cooldowns. None when there are no keys.
+        """
+        now = time.time()
+        request_limit = self._limits(model)[0]
+        states = list(self._load_states(now, model).values())
+        if not states:
+            return None
+        available = sum(
+            max(0.0, state['requests_available']) for state in states if state['status'] == 'active'
+        )
+        if available >= requests:
+            return 0.0
+        # Keys cooling down only start refilling once their cooldown is over
+        cooldown = min(
+            max(0.0, state['disabled_until'] - now) if state['status'] != 'active' else 0.0
+            for state in states
+        )
+        return cooldown + (requests - available) * 60.0 / (request_limit * len(states))
+
+    def report_success(self, key, tokens_used=0, reserved_tokens=0, model=None):
+        """Report successful API call; settles the reserved token estimate"""
+        def update(state):
+            state['tokens_used'] += tokens_used
+            state['errors_count'] = 0
+            state['tokens_available'] -= tokens_used - reserved_tokens
+
+        self._update_key(key, update, model)
+        self._notify()
+
+    def report_error(self, key, error_message, model=None):
+        """Report API error; consecutive errors disable the key for KEY_ERROR_COOLDOWN seconds"""
+        def update(state):
+            state['errors_count'] += 1
+            state['last_error'] = error_message
+
+            # If too many errors, temporarily disable the key
+            if state['errors_count'] >= Config.KEY_ERROR_LIMIT and state['status'] != 'error':
+                state['status'] = 'error'
+                state['disabled_until'] = time.time() + Config.KEY_ERROR_COOLDOWN
+                print(f"Key disabled due to multiple errors: {key[:10]}... ({Config.KEY_ERROR_COOLDOWN}s)")
+
+        self._update_key(key, update, model)
+
+    def report_rate_limit(self, key, cooldown=120, model=None):
+        """Report rate limit hit; the key is drained and cools down for every worker"""
+        def update(state):
+            state['status'] = 'rate_limited'
+            state['disabled_until'] = time.time() + cooldown
+            state['requests_available'] = min(state['requests_available'], 0.0)
+            state['tokens_available'] = min(state['tokens_available'], 0.0)
+
+        self._update_key(key, update, model)
+        self._notify()
+        print(f"Key rate limited: {key[:10]}... ({model or self.default_model or 'default model'})")
+
+    def get_key_states(self, model=None):
+        """Current state of every key for a model, keyed by the raw key"""
+        return self._load_states(time.time(), model)
+
+    def get_status(self):
+        """Get current status of all keys (default model), with per-model buckets under 'models'"""
+        states = self.get_key_states()
+        other_models = [model for model in self.model_limits if model != self.default_model]
+        model_states = {model: self.get_key_states(model) for model in other_models}
+        status = {}
+        for key in self.keys:
+            key_info = dict(states[key])
+            key_info['requests_available'] = max(0, int(key_info['requests_available']))
+            key_info['tokens_available'] = max(0, int(key_info['tokens_available']))
+            del key_info['refilled_at']
+            if other_models:
+                key_info['models'] = {
+                    model.rsplit('/', 1)[-1]: {
+                        'status': model_states[model][key]['status'],
+                        'requests_count': model_states[model][key]['requests_count'],
+                        'requests_available': max(0, int(model_states[model][key]['requests_available'])),
+                        'tokens_available': max(0, int(model_states[model][key]['tokens_available']))
+                    }
+                    for model in other_models
+                }
+            # Don't expose full key in status
+            status[key[:10] + '...'] = key_info
+        return status
 
 # Global instance
 key_manager = APIKeyManager()
@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import random
+import socket
+import sqlite3
+import threading
+from urllib.parse import urlparse, unquote
+
+class InProcessKeyStateBackend:
+    """Key state kept in this process only (single worker deployments)"""
+
+    name = 'memory'
+
+    def __init__(self):
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def load_many(self, key_ids):
+        with self.lock:
+            return {key_id: dict(self.states[key_id]) for key_id in key_ids if key_id in self.states}
+
+    def update(self, key_id, update_fn):
+        """
+        Atomically apply update_fn(state or None) -> (new_state, result)
+        and return result
+        """
+        with self.lock:
+            current = self.states.get(key_id)
+            new_state, result = update_fn(dict(current) if current else None)
+            self.states[key_id] = new_state
+            return result
+
+class SQLiteKeyStateBackend:
+    """
+    Key state in a SQLite file shared by every worker on the host. Updates
+    run in an IMMEDIATE transaction, so read-modify-write is atomic across
+    processes.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+        folder = os.path.dirname(db_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        conn = self._get_conn()
+        conn.execute('CREATE TABLE IF NOT EXISTS key_state (key_id TEXT PRIMARY KEY, state TEXT NOT NULL)')
+
+    def _get_conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.local.conn = conn
+        return conn
+
+    def load_many(self, key_ids):
+        if not key_ids:
+            return {}
+        conn = self._get_conn()
+        placeholders = ','.join('?' for _ in key_ids)
+        rows = conn.execute(
+            f'SELECT key_id, state FROM key_state WHERE key_id IN ({placeholders})', list(key_ids)
+        ).fetchall()
+        return {key_id: json.loads(state) for key_id, state in rows}
+
+    def update(self, key_id, update_fn):
+        conn = self._get_conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT state FROM key_state WHERE key_id = ?', (key_id,)).fetchone()
+            new_state, result = update_fn(json.loads(row[0]) if row else None)
+            conn.execute(
+                'INSERT OR REPLACE INTO key_state (key_id, state) VALUES (?, ?)',
+                (key_id, json.dumps(new_state))
+            )
+            conn.execute('COMMIT')
+            return result
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+class RespConnection:
+    """Minimal Redis protocol (RESP2) client over a plain socket"""
+
+    def __init__(self, host, port, db=0, password=None, timeout=5):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.reader = self.sock.makefile('rb')
+        if password:
+            self.execute('AUTH', password)
+        if db:
+            self.execute('SELECT', db)
+
+    def execute(self, *args):
+        parts = [f'*{len(args)}\r\n'.encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(f'${len(data)}\r\n'.encode() + data + b'\r\n')
+        self.sock.sendall(b''.join(parts))
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b'+':
+            return payload.decode()
+        if prefix == b'-':
+            raise RuntimeError(f"Redis error: {payload.decode()}")
+        if prefix == b':':
+            return int(payload)
+        if prefix == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2]
+        if prefix == b'*':
+            count = int(payload)
+            if count < 0:
+                return None
+            return [self._read_reply() for _ in range(count)]
+        raise RuntimeError(f"Unexpected Redis reply: {line!r}")
+
+    def close(self):
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+class RedisKeyStateBackend:
+    """
+    Key state in Redis (or anything speaking the Redis protocol), shared by
+    every worker and instance. Updates use WATCH/MULTI/EXEC and retry, after
+    a short random backoff, when another writer changed the key in between.
+    """
+
+    name = 'redis'
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None, prefix='smartrc:keys', max_retries=20):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.prefix = prefix
+        self.max_retries = max_retries
+        self.local = threading.local()
+
+    def _get_conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = RespConnection(self.host, self.port, self.db, self.password)
+            self.local.conn = conn
+        return conn
+
+    def _execute(self, *args):
+        try:
+            return self._get_conn().execute(*args)
+        except (OSError, ConnectionError):
+            # Reconnect once on a dropped connection
+            self._reset_conn()
+            return self._get_conn().execute(*args)
+
+    def _reset_conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+        self.local.conn = None
+
+    def _redis_key(self, key_id):
+        return f'{self.prefix}:{key_id}'
+
+    def load_many(self, key_ids):
+        key_ids = list(key_ids)
+        if not key_ids:
+            return {}
+        values = self._execute('MGET', *[self._redis_key(key_id) for key_id in key_ids])
+        return {key_id: json.loads(value) for key_id, value in zip(key_ids, values) if value is not None}
+
+    def update(self, key_id, update_fn):
+        redis_key = self._redis_key(key_id)
+        for attempt in range(self.max_retries):
+            if attempt:
+                # Spread out writers that keep colliding on a busy key
+                time.sleep(random.uniform(0, 0.001 * min(attempt, 10)))
+            conn = self._get_conn()
+            try:
+                conn.execute('WATCH', redis_key)
+                raw = conn.execute('GET', redis_key)
+                new_state, result = update_fn(json.loads(raw) if raw is not None else None)
+                conn.execute('MULTI')
+                conn.execute('SET', redis_key, json.dumps(new_state))
+                if conn.execute('EXEC') is not None:
+                    return result
+            except (OSError, ConnectionError):
+                self._reset_conn()
+                raise
+            except Exception:
+                conn.execute('UNWATCH')
+                raise
+        raise RuntimeError(f"Key state update for {key_id} kept conflicting")
+
+def create_key_state_backend(url):
+    """
+    Build a backend from a URL:
+    memory://  |  sqlite:///path/to/keys.db  |  redis://[:password@]host:port/db
+    """
+    parsed = urlparse(url or 'memory://')
+    if parsed.scheme in ('', 'memory'):
+        return InProcessKeyStateBackend()
+    if parsed.scheme == 'sqlite':
+        path = parsed.path
+        # sqlite:///relative.db -> relative.db, sqlite:////abs/path.db -> /abs/path.db
+        if path.startswith('/') and not path.startswith('//'):
+            path = path[1:]
+        elif path.startswith('//'):
+            path = path[1:]
+        return SQLiteKeyStateBackend(path or 'cache/key_state.db')
+    if parsed.scheme == 'redis':
+        db = int(parsed.path.lstrip('/') or 0)
+        password = unquote(parsed.password) if parsed.password else None
+        return RedisKeyStateBackend(parsed.hostname or 'localhost', parsed.port or 6379, db, password)
+    raise ValueError(f"Unsupported key state backend: {url}")
@@ -0,0 +1,460 @@
+import os
+import re
+import time
+import uuid
+import atexit
+import hashlib
+import threading
+from config import Config
+from utils.helpers import extract_state
+from services.geo_distance import geo_distance
+
+# First number on each line: "$1,500.00 USD" -> "1,500.00", "Not found" -> ""
+_FIRST_NUMBER = re.compile(r'^[^\d\n]*(\d[\d,]*(?:\.\d+)?)?[^\n]*$', re.M)
+_NAME_PUNCTUATION = re.compile(r"[^\w\s&']+")
+_MISSING_VALUES = {'', 'NOT FOUND', 'N/A', 'NONE', 'UNKNOWN'}
+
+# NumPy dtypes by name; NumPy is imported where it is used so the app starts quickly
+NUMERIC_COLUMNS = {
+    'rate': 'float64',
+    'distance': 'float32',
+    'deadhead': 'float32',
+    'weight': 'float32',
+    'recorded_at': 'float64'
+}
+CATEGORY_COLUMNS = ('origin', 'destination', 'broker', 'equipment')
+
+# Names accepted by group_by, and the category columns behind them
+GROUP_DIMENSIONS = {
+    'lane': ('origin', 'destination'),
+    'origin': ('origin',),
+    'destination': ('destination',),
+    'broker': ('broker',),
+    'equipment': ('equipment',)
+}
+METRICS = ('rate_per_mile', 'rate', 'distance')
+
+def parse_numbers(values):
+    """
+    First number in each value as a float64 array (NaN when there is none).
+    All values are parsed with one regex pass over the joined text.
+    """
+    import numpy as np
+
+    if not len(values):
+        return np.empty(0, dtype=np.float64)
+    blob = '\n'.join('' if value is None else str(value).replace('\n', ' ') for value in values)
+    parts = np.char.replace(np.array(_FIRST_NUMBER.findall(blob)), ',', '')
+    return np.where(parts == '', 'nan', parts).astype(np.float64)
+
+def normalize_name(value):
+    """Broker/equipment name as stored: upper case, no punctuation, '' when missing"""
+    if not isinstance(value, str):
+        return ''
+    value = ' '.join(_NAME_PUNCTUATION.sub(' ', value).upper().split())
+    return '' if value in _MISSING_VALUES else value
+
+def _normalize_category(column, value):
+    if column in ('origin', 'destination'):
+        return extract_state(value) or ''
+    return normalize_name(value)
+
+def _document_id(load):
+    """Stable row id: the file hash when known, otherwise a hash of the extracted fields"""
+    file_hash = load.get('file_hash') or load.get('doc_id')
+    if file_hash:
+        return str(file_hash)[:16]
+    fingerprint = '|'.join(str(load.get(field, '')) for field in (
+        'broker_name', 'load_number', 'rate', 'pickup_address', 'delivery_address', 'pickup_time'
+    ))
+    return hashlib.sha256(fingerprint.encode()).hexdigest()[:16]
+
+def _grouped_percentiles(group_keys, values, percentiles):
+    """
+    Count, mean and percentiles (linear interpolation, like np.percentile)
+    of values for every distinct group key, from a single sort
+    """
+    import numpy as np
+
+    order = np.lexsort((values, group_keys))
+    keys = group_keys[order]
+    values = values[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.empty(0, dtype=np.int64)
+    counts = np.diff(np.r_[starts, len(keys)])
+    if not len(starts):
+        return keys, counts, np.empty(0), np.empty((0, len(percentiles)))
+
+    means = np.add.reduceat(values, starts) / counts
+    positions = starts[:, None] + (np.asarray(percentiles, dtype=np.float64) / 100.0)[None, :] * (counts[:, None] - 1)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.minimum(lower + 1, (starts + counts - 1)[:, None])
+    fraction = positions - lower
+    quantiles = values[lower] + (values[upper] - values[lower]) * fraction
+    return keys[starts], counts, means, quantiles
+
+class LoadHistoryStore:
+    """
+    Columnar history of analyzed loads for lane analytics. Each flush
+    writes one segment (an .npz of column arrays), so several workers can
+    append without coordinating; segments are merged once there are too
+    many. Rate and distance are parsed once at ingestion, names are
+    dictionary-encoded, and queries run on whole NumPy columns.
+    """
+
+    def __init__(self, directory, flush_rows=100, flush_seconds=30, max_segments=32, max_rows=1000000):
+        self.directory = directory
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.max_segments = max_segments
+        self.max_rows = max_rows
+        self.lock = threading.Lock()
+        self.pending = []  # loads recorded by this process and not yet written
+        self.pending_since = None
+        self.segment_cache = {}  # segment file name -> arrays
+        self.table = None
+        self.table_segments = None
+        self.compacting = False
+        self.stats = {'recorded': 0, 'ingested': 0, 'segments_written': 0, 'compactions': 0, 'queries': 0,
+                      'distances_estimated': 0}
+
+    def record(self, extracted_data, deadhead=0, file_hash=None):
+        """Queue one analyzed RC; written in the next segment"""
+        load = dict(extracted_data, deadhead=deadhead, file_hash=file_hash)
+        with self.lock:
+            self.pending.append(load)
+            self.stats['recorded'] += 1
+            if self.pending_since is None:
+                self.pending_since = time.time()
+            due = (
+                len(self.pending) >= self.flush_rows
+                or time.time() - self.pending_since >= self.flush_seconds
+            )
+        if due:
+            self.flush()
+
+    def ingest(self, loads, default_deadhead=0):
+        """
+        Bulk-add analyzed RCs (raw extractions or API responses, optionally
+        with 'deadhead' and 'file_hash'). Returns the number of rows written.
+        """
+        loads = [
+            dict({'deadhead': default_deadhead}, **load)
+            for load in loads if isinstance(load, dict) and 'error' not in load
+        ]
+        if loads:
+            self._write_segment(self._build_columns(loads))
+        with self.lock:
+            self.stats['ingested'] += len(loads)
+            self.stats['segments_written'] += 1 if loads else 0
+        return len(loads)
+
+    def flush(self):
+        """Write the queued loads as a segment"""
+        with self.lock:
+            loads, self.pending, self.pending_since = self.pending, [], None
+        if loads:
+            self._write_segment(self._build_columns(loads))
+            with self.lock:
+                self.stats['segments_written'] += 1
+
+    def _fill_distances(self, distance, loads):
+        """Estimate missing loaded miles from the addresses (in place)"""
+        import numpy as np
+
+        missing = np.flatnonzero(~(distance > 0))
+        if len(missing) == 0:
+            return
+        estimates = geo_distance.estimate_miles_many(
+            [loads[row].get('pickup_address') for row in missing],
+            [loads[row].get('delivery_address') for row in missing]
+        )
+        distance[missing] = np.where(np.isnan(estimates), distance[missing], estimates)
+        with self.lock:
+            self.stats['distances_estimated'] += int(np.count_nonzero(~np.isnan(estimates)))
+
+    def _build_columns(self, loads):
+        """Column arrays for a list of loads"""
+        import numpy as np
+
+        columns = {
+            'doc_id': np.array([_document_id(load) for load in loads], dtype='S16'),
+            'rate': parse_numbers([load.get('rate') for load in loads]),
+            'distance': parse_numbers([load.get('distance') for load in loads]),
+            'deadhead': np.nan_to_num(parse_numbers([load.get('deadhead') for load in loads])),
+            'weight': parse_numbers([load.get('weight') for load in loads]),
+            'recorded_at': np.array([load.get('recorded_at') or time.time() for load in loads], dtype=np.float64)
+        }
+        if Config.GEO_FILL_MISSING_DISTANCE:
+            self._fill_distances(columns['distance'], loads)
+        for column, dtype in NUMERIC_COLUMNS.items():
+            columns[column] = columns[column].astype(dtype)
+
+        sources = {
+            'origin': 'pickup_address',
+            'destination': 'delivery_address',
+            'broker': 'broker_name',
+            'equipment': 'equipment'
+        }
+        for column, field in sources.items():
+            # Names repeat a lot across loads, so each distinct value is normalized once
+            normalized = {}
+            values = []
+            for load in loads:
+                value = load.get(field)
+                if not isinstance(value, str):
+                    value = None
+                if value not in normalized:
+                    normalized[value] = _normalize_category(column, value)
+                values.append(normalized[value])
+            values = np.array(values, dtype=str)
+            vocab, codes = np.unique(values, return_inverse=True)
+            columns[column] = codes.astype(np.int32)
+            columns[f'{column}_vocab'] = vocab
+        return columns
+
+    def _segment_names(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory) if name.startswith('segment-') and name.endswith('.npz'))
+
+    def _write_segment(self, columns):
+        import numpy as np
+
+        os.makedirs(self.directory, exist_ok=True)
+        # Time-ordered names, so later segments win when a document appears twice
+        name = f'segment-{time.time_ns():020d}-{os.getpid()}-{uuid.uuid4().hex[:6]}.npz'
+        temp_path = os.path.join(self.directory, f'.{name}.tmp')
+        with open(temp_path, 'wb') as f:
+            np.savez(f, **columns)
+        os.replace(temp_path, os.path.join(self.directory, name))
+        return name
+
+    def _read_segment(self, name):
+        import numpy as np
+
+        arrays = self.segment_cache.get(name)
+        if arrays is None:
+            with np.load(os.path.join(self.directory, name), allow_pickle=False) as data:
+                arrays = {key: data[key] for key in data.files}
+            self.segment_cache[name] = arrays
+        return arrays
+
+    def _merge(self, segments):
+        """One table from several segments: shared vocabularies, latest row per document"""
+        import numpy as np
+
+        table = {'vocab': {}}
+        for column in NUMERIC_COLUMNS:
+            table[column] = np.concatenate([segment[column] for segment in segments])
+        table['doc_id'] = np.concatenate([segment['doc_id'] for segment in segments])
+        for column in CATEGORY_COLUMNS:
+            vocab = np.unique(np.concatenate([segment[f'{column}_vocab'] for segment in segments]))
+            table['vocab'][column] = vocab
+            table[column] = np.concatenate([
+                np.searchsorted(vocab, segment[f'{column}_vocab']).astype(np.int32)[segment[column]]
+                for segment in segments
+            ])
+
+        # Re-analyzing a document replaces its row (e.g. with a new deadhead)
+        reversed_ids = table['doc_id'][::-1]
+        _, last_seen = np.unique(reversed_ids, return_index=True)
+        keep = np.sort(len(reversed_ids) - 1 - last_seen)
+        if len(keep) > self.max_rows:
+            keep = keep[np.argsort(table['recorded_at'][keep], kind='stable')[-self.max_rows:]]
+            keep.sort()
+        if len(keep) < len(table['doc_id']):
+            for column in list(NUMERIC_COLUMNS) + ['doc_id'] + list(CATEGORY_COLUMNS):
+                table[column] = table[column][keep]
+        return table
+
+    def _table_to_segment(self, table):
+        columns = {column: table[column] for column in list(NUMERIC_COLUMNS) + ['doc_id'] + list(CATEGORY_COLUMNS)}
+        for column in CATEGORY_COLUMNS:
+            columns[f'{column}_vocab'] = table['vocab'][column]
+        return columns
+
+    def _empty_table(self):
+        import numpy as np
+
+        table = {column: np.empty(0, dtype=dtype) for column, dtype in NUMERIC_COLUMNS.items()}
+        table['doc_id'] = np.empty(0, dtype='S16')
+        table['vocab'] = {}
+        for column in CATEGORY_COLUMNS:
+            table[column] = np.empty(0, dtype=np.int32)
+            table['vocab'][column] = np.empty(0, dtype=str)
+        return table
+
+    def _load(self):
+        """The merged table over all segments on disk (reloaded when segments change)"""
+        self.flush()
+        with self.lock:
+            for attempt in range(3):
+                names = self._segment_names()
+                if names == self.table_segments:
+                    return self.table
+                try:
+                    segments = [self._read_segment(name) for name in names]
+                except FileNotFoundError:
+                    # Another worker compacted these segments; list again
+                    continue
+                self.table = self._merge(segments) if segments else self._empty_table()
+                self.table_segments = names
+                self.segment_cache = {name: self.segment_cache[name] for name in names}
+                table = self.table
+                compact = len(names) > self.max_segments and not self.compacting
+                if compact:
+                    self.compacting = True
+                break
+            else:
+                raise RuntimeError("Load history segments kept changing while loading")
+        if compact:
+            self._compact(names, table)
+        return table
+
+    def _compact(self, names, table):
+        """Replace the given segments with one holding their merged table (called without the lock)"""
+        try:
+            columns = self._table_to_segment(table)
+            merged_name = self._write_segment(columns)
+            for name in names:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+            with self.lock:
+                # Segments written meanwhile by other workers are picked up by the next load
+                if self.table_segments == names:
+                    self.segment_cache = {merged_name: columns}
+                    self.table_segments = [merged_name]
+                self.stats['compactions'] += 1
+        finally:
+            with self.lock:
+                self.compacting = False
+
+    def _filter_mask(self, table, filters):
+        import numpy as np
+
+        mask = np.ones(len(table['doc_id']), dtype=bool)
+        for column, value in (filters or {}).items():
+            if value in (None, ''):
+                continue
+            if column not in CATEGORY_COLUMNS:
+                raise ValueError(f"Unknown filter: {column}")
+            normalized = value.upper() if column in ('origin', 'destination') else normalize_name(value)
+            vocab = table['vocab'][column]
+            index = np.searchsorted(vocab, normalized)
+            if index >= len(vocab) or vocab[index] != normalized:
+                return np.zeros(len(mask), dtype=bool)
+            mask &= table[column] == index
+        return mask
+
+    def _metric_values(self, table, metric, deadhead):
+        """Metric per row and the rows where it is defined; deadhead overrides the recorded one"""
+        import numpy as np
+
+        rate = table['rate']
+        distance = table['distance'].astype(np.float64)
+        if metric == 'rate':
+            return rate, np.isfinite(rate) & (rate > 0)
+        if metric == 'distance':
+            return distance, np.isfinite(distance) & (distance > 0)
+        if metric != 'rate_per_mile':
+            raise ValueError(f"Unknown metric: {metric}")
+
+        recorded = table['deadhead'].astype(np.float64)
+        total_distance = distance + (recorded if deadhead is None else float(deadhead))
+        valid = np.isfinite(rate) & (rate > 0) & np.isfinite(distance) & (distance > 0) & (total_distance > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = np.where(valid, rate / total_distance, 0.0)
+        return values, valid
+
+    def _group_keys(self, table, group_by):
+        import numpy as np
+
+        columns = []
+        for name in group_by:
+            if name not in GROUP_DIMENSIONS:
+                raise ValueError(f"Unknown group: {name}")
+            columns.extend(column for column in GROUP_DIMENSIONS[name] if column not in columns)
+        if not columns:
+            return columns, [], np.zeros(len(table['doc_id']), dtype=np.int64)
+        sizes = [max(1, len(table['vocab'][column])) for column in columns]
+        keys = np.ravel_multi_index([table[column].astype(np.int64) for column in columns], sizes)
+        return columns, sizes, keys
+
+    def rate_percentiles(self, group_by=('lane',), metric='rate_per_mile', percentiles=(25, 50, 75, 90),
+                         deadhead=None, filters=None, min_count=1, limit=50):
+        """
+        Count, mean and percentiles of metric per group (any of
+        GROUP_DIMENSIONS), largest groups first. deadhead recalculates
+        rate per mile for every load as if it had that deadhead.
+        """
+        import numpy as np
+
+        started = time.perf_counter()
+        table = self._load()
+        values, valid = self._metric_values(table, metric, deadhead)
+        mask = valid & self._filter_mask(table, filters)
+        columns, sizes, keys = self._group_keys(table, group_by)
+
+        group_keys, counts, means, quantiles = _grouped_percentiles(keys[mask], values[mask], percentiles)
+        selected = np.flatnonzero(counts >= min_count)
+        selected = selected[np.argsort(-counts[selected], kind='stable')][:limit]
+        decoded = np.unravel_index(group_keys[selected], sizes) if columns else []
+
+        groups = []
+        for position, index in enumerate(selected):
+            group = {
+                column: str(table['vocab'][column][decoded[number][position]]) or 'Unknown'
+                for number, column in enumerate(columns)
+            }
+            entry = {'group': group, 'count': int(counts[index]), 'mean': round(float(means[index]), 2)}
+            for percentile, value in zip(percentiles, quantiles[index]):
+                entry[f'p{percentile:g}'] = round(float(value), 2)
+            groups.append(entry)
+
+        with self.lock:
+            self.stats['queries'] += 1
+        return {
+            'metric': metric,
+            'group_by': list(group_by),
+            'deadhead': 'recorded' if deadhead is None else deadhead,
+            'loads': int(mask.sum()),
+            'groups': groups,
+            'query_ms': round((time.perf_counter() - started) * 1000, 2)
+        }
+
+    def deadhead_what_if(self, deadheads, group_by=(), percentiles=(50,), filters=None, min_count=1, limit=50):
+        """Rate per mile with the recorded deadheads and with each deadhead applied to every load"""
+        recorded = self.rate_percentiles(group_by, 'rate_per_mile', percentiles, None, filters, min_count, limit)
+        scenarios = [
+            self.rate_percentiles(group_by, 'rate_per_mile', percentiles, deadhead, filters, min_count, limit)
+            for deadhead in deadheads
+        ]
+        return {'recorded': recorded, 'scenarios': scenarios}
+
+    def get_stats(self):
+        import numpy as np
+
+        table = self._load()
+        with self.lock:
+            return dict(
+                self.stats,
+                loads=int(len(table['doc_id'])),
+                segments=len(self.table_segments or []),
+                brokers=int(len(table['vocab']['broker'])),
+                lanes=int(len(np.unique(
+                    table['origin'].astype(np.int64) * max(1, len(table['vocab']['destination'])) + table['destination']
+                ))),
+                directory=self.directory
+            )
+
+# Global instance
+load_history = LoadHistoryStore(
+    Config.LOAD_HISTORY_DIR,
+    flush_rows=Config.LOAD_HISTORY_FLUSH_ROWS,
+    flush_seconds=Config.LOAD_HISTORY_FLUSH_SECONDS,
+    max_segments=Config.LOAD_HISTORY_MAX_SEGMENTS,
+    max_rows=Config.LOAD_HISTORY_MAX_ROWS
+)
+atexit.register(load_history.flush)
@@ -0,0 +1,265 @@
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from a cache hit up to a slow multi-retry Gemini call
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class _Metric:
+    metric_type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _labels(self, key, extra=()):
+        return list(zip(self.label_names, key)) + list(extra)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.metric_type}']
+        with self.lock:
+            lines.extend(self._samples())
+        return lines
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def _samples(self):
+        return [
+            f'{self.name}{_format_labels(self._labels(key))} {_format_value(value)}'
+            for key, value in sorted(self.values.items())
+        ]
+
+class Gauge(Counter):
+    """Value that goes up and down"""
+
+    metric_type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(_Metric):
+    """Cumulative bucket counts plus sum and count, per label set"""
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][index] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def _samples(self):
+        lines = []
+        for key, series in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series['buckets']):
+                cumulative += count
+                labels = self._labels(key, [('le', _format_value(float(bound)))])
+                lines.append(f'{self.name}_bucket{_format_labels(labels)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self._labels(key))} {_format_value(round(series["sum"], 6))}')
+            lines.append(f'{self.name}_count{_format_labels(self._labels(key))} {series["count"]}')
+        return lines
+
+class MetricsRegistry:
+    """
+    Process-local metrics rendered in the Prometheus text format. Values
+    owned by other services (key states, cache counters) are read at scrape
+    time through registered collectors instead of being mirrored here.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def _register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self._register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def register_collector(self, collector):
+        """
+        collector() returns a list of (name, type, documentation, samples)
+        where samples is a list of (labels dict, value)
+        """
+        with self.lock:
+            self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics)
+            collectors = list(self.collectors)
+
+        for metric in metrics:
+            lines.extend(metric.render())
+
+        for collector in collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                print(f"Metrics collector error: {str(e)}")
+                continue
+            for name, metric_type, documentation, samples in families:
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                for labels, value in samples:
+                    lines.append(f'{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}')
+
+        return '\n'.join(lines) + '\n'
+
+class RequestTrace:
+    """Stage timings of the request handled by the current thread (or asyncio task)"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = []
+
+    def add(self, stage, seconds):
+        self.stages.append((stage, seconds))
+
+    def server_timing(self):
+        """Server-Timing header value (durations in milliseconds)"""
+        entries = [f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in self.stages]
+        entries.append(f'total;dur={(time.perf_counter() - self.started) * 1000:.1f}')
+        return ', '.join(entries)
+
+# A context variable rather than a thread local, so concurrent requests on
+# one event loop thread (the ASGI app) each keep their own trace
+_trace = contextvars.ContextVar('request_trace', default=None)
+
+def start_trace():
+    trace = RequestTrace()
+    _trace.set(trace)
+    return trace
+
+def current_trace():
+    return _trace.get()
+
+def end_trace():
+    trace = current_trace()
+    _trace.set(None)
+    return trace
+
+@contextmanager
+def use_trace(trace):
+    """Record stages from a helper thread into a request's trace"""
+    token = _trace.set(trace)
+    try:
+        yield
+    finally:
+        _trace.reset(token)
+
+def observe_stage(stage, seconds):
+    """Record a stage duration in the histogram and the current request's trace"""
+    stage_seconds.observe(seconds, stage=stage)
+    trace = current_trace()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+@contextmanager
+def timed(stage):
+    """Time a block as a pipeline stage"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+# Global instance
+metrics = MetricsRegistry()
+
+stage_seconds = metrics.histogram(
+    'smartrc_stage_seconds', 'Time spent in each analysis stage', ['stage']
+)
+pdf_page_seconds = metrics.histogram(
+    'smartrc_pdf_page_seconds', 'Time to extract one PDF page (including OCR)', ['source'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+gemini_request_seconds = metrics.histogram(
+    'smartrc_gemini_request_seconds', 'Duration of each Gemini attempt', ['key', 'outcome']
+)
+gemini_attempts_total = metrics.counter(
+    'smartrc_gemini_attempts_total', 'Gemini attempts by key and outcome', ['key', 'outcome']
+)
+gemini_hedges_total = metrics.counter(
+    'smartrc_gemini_hedges_total', 'Hedged Gemini calls: launched, won, or skipped for lack of spare capacity', ['outcome']
+)
+gemini_model_seconds = metrics.histogram(
+    'smartrc_gemini_model_seconds', 'Duration of successful Gemini calls per model tier', ['model']
+)
+model_routes_total = metrics.counter(
+    'smartrc_model_routes_total', 'Model router decisions: routed, escalated, answered or failed per tier', ['model', 'decision']
+)
+gemini_tokens_total = metrics.counter(
+    'smartrc_gemini_tokens_total', 'Tokens used per key', ['key']
+)
+http_requests_in_flight = metrics.gauge(
+    'smartrc_http_requests_in_flight', 'Requests currently being handled'
+)
+http_request_seconds = metrics.histogram(
+    'smartrc_http_request_seconds', 'HTTP request latency', ['endpoint', 'method', 'status']
+)
+admission_decisions_total = metrics.counter(
+    'smartrc_admission_decisions_total', 'Admission decisions per priority class: admitted, rejected, shed or timed out', ['priority', 'outcome']
+)
+admission_wait_seconds = metrics.histogram(
+    'smartrc_admission_wait_seconds', 'Time a request queued before it could start analysis', ['priority']
+)
@@ -0,0 +1,215 @@
+import re
+import threading
+from collections import namedtuple
+from config import Config
+from services.key_manager import key_manager
+from services.hedging import LatencyTracker, gemini_latency
+from services.fallback_processor import NUMERIC_FIELDS
+from services.response_schema import NOT_FOUND
+from services.metrics import gemini_model_seconds, model_routes_total
+from utils.helpers import EXTRACTED_FIELDS
+
+# One Gemini model with its per-key budget; index 0 is the fastest tier
+ModelTier = namedtuple('ModelTier', ['index', 'model', 'requests_per_minute', 'tokens_per_minute'])
+
+# Fields an answer must get right to be trusted without asking a stronger tier
+CORE_FIELDS = ('broker_name', 'load_number', 'rate', 'pickup_address', 'delivery_address', 'pickup_time', 'delivery_time')
+
+_STOP_RE = re.compile(r'\b(?:stop|pick\s*-?\s*up|drop|delivery)\s*(?:#|no\.?)?\s*(\d{1,2})\b', re.IGNORECASE)
+_PARTY_RE = re.compile(r'\b(?:shipper|consignee|receiver)\b', re.IGNORECASE)
+_NUMBER_TOKEN_RE = re.compile(r'(?<![\w.])\$?\d[\d,.:/-]*')
+_COLUMN_GAP_RE = re.compile(r'\S(?: {2,}|\t| ?\| ?)\S')
+
+def parse_model_tiers(spec):
+    """'model|requests/min|tokens/min,model,...' -> [ModelTier]; missing limits are RATE_LIMIT_*"""
+    tiers = []
+    for entry in spec.split(','):
+        parts = [part.strip() for part in entry.split('|')]
+        if not parts[0]:
+            continue
+        requests = int(parts[1]) if len(parts) > 1 and parts[1] else Config.RATE_LIMIT_REQUESTS
+        tokens = int(parts[2]) if len(parts) > 2 and parts[2] else Config.RATE_LIMIT_TOKENS
+        tiers.append(ModelTier(len(tiers), parts[0], requests, tokens))
+    return tiers
+
+def _is_table_line(line):
+    """Rows of rate/stop/commodity tables: several numbers, or columns split by wide gaps or pipes"""
+    return len(_NUMBER_TOKEN_RE.findall(line)) >= 3 or len(_COLUMN_GAP_RE.findall(line)) >= 2
+
+def _count_stops(text):
+    """Numbered stops ("Stop 3", "Pickup #2"), or shipper/consignee blocks when stops aren't numbered"""
+    numbered = {int(number) for number in _STOP_RE.findall(text)}
+    return max(len(numbered), min(len(_PARTY_RE.findall(text)), 10))
+
+class ModelRouter:
+    """
+    Picks the Gemini tier for a document. The document's score grows with
+    its length, page count, OCR'd pages, table density and stops; easy
+    documents start on the fastest tier, the rest one tier up. An answer
+    that fails or scores below MODEL_ROUTER_MIN_CONFIDENCE is asked again
+    on the next tier. Each tier's per-key budget is set in the key manager.
+    """
+
+    def __init__(self, tiers):
+        self.tiers = tiers
+        self.lock = threading.Lock()
+        self.trackers = {tier.model: LatencyTracker() for tier in tiers}
+        self.counts = {tier.model: {'routed': 0, 'escalated': 0, 'answered': 0, 'failed': 0} for tier in tiers}
+        self.decisions = {'easy': 0, 'hard': 0}
+        self.escalations = {'error': 0, 'low_confidence': 0}
+        self.score_total = 0.0
+        key_manager.configure_models(
+            {tier.model: (tier.requests_per_minute, tier.tokens_per_minute) for tier in tiers},
+            default_model=Config.GEMINI_MODEL
+        )
+
+    def score(self, text, page_count=1, ocr_pages=0):
+        """Complexity score of a document and the features behind it"""
+        lines = [line for line in text.splitlines() if line.strip()]
+        table_lines = sum(1 for line in lines if _is_table_line(line))
+        features = {
+            'chars': len(text),
+            'pages': page_count,
+            'ocr_pages': ocr_pages,
+            'table_density': round(table_lines / len(lines), 3) if lines else 0.0,
+            'stops': _count_stops(text)
+        }
+        # A single-load RC is a few thousand characters on one or two pages
+        score = (
+            len(text) / 8000
+            + max(0, page_count - 2) * 0.25
+            + (0.5 if ocr_pages else 0.0)
+            + features['table_density'] * 1.5
+            + max(0, features['stops'] - 2) * 0.5
+        )
+        return round(score, 3), features
+
+    def route(self, text, page_count=1, ocr_pages=0):
+        """First tier for a document: the fastest one for easy documents"""
+        score, features = self.score(text, page_count, ocr_pages)
+        tier = self._record_route([score])
+        print(f"Model route: {self.label(tier.model)} (score {score:.2f}, {features['stops']} stops)")
+        return tier
+
+    def route_many(self, texts):
+        """One tier for a batched prompt: the one its hardest document needs"""
+        tier = self._record_route([self.score(text)[0] for text in texts])
+        print(f"Model route for {len(texts)} documents: {self.label(tier.model)}")
+        return tier
+
+    def _record_route(self, scores):
+        hard = sum(1 for score in scores if score >= Config.MODEL_ROUTER_EASY_MAX_SCORE)
+        tier = self.tiers[0] if not hard or len(self.tiers) == 1 else self.tiers[1]
+        with self.lock:
+            self.decisions['easy'] += len(scores) - hard
+            self.decisions['hard'] += hard
+            self.score_total += sum(scores)
+            self.counts[tier.model]['routed'] += len(scores)
+        model_routes_total.inc(len(scores), model=self.label(tier.model), decision='routed')
+        return tier
+
+    def cascade(self, tier):
+        """The tier and every stronger one, in order"""
+        return self.tiers[tier.index:]
+
+    def assess(self, result):
+        """
+        Confidence (0..1) in a parsed answer: the share of checked values
+        that are valid, with numbers in a plausible range. A core field the
+        answer reports as 'Not found' is taken as absent from the document
+        and does not lower it, nor do fields left out (a follow-up can fill
+        them), unless most are missing.
+        """
+        missing = set(result.get('_missing', ()))
+        if len(missing) > len(EXTRACTED_FIELDS) // 2:
+            return 0.0
+        answered = [field for field in CORE_FIELDS if field not in missing]
+        found = sum(result.get(field, NOT_FOUND) != NOT_FOUND for field in answered)
+        if found * 2 < len(answered):
+            # Most core fields empty: the model did not read the document
+            return round(found / len(answered), 3)
+        checked = passed = found
+        for field, (low, high) in NUMERIC_FIELDS.items():
+            value = result.get(field)
+            if isinstance(value, float) and not low <= value <= high:
+                checked += 1
+        return round(passed / checked, 3) if checked else 0.0
+
+    def record_call(self, model, seconds):
+        """Latency of a successful call on a tier"""
+        self.tracker(model).observe(seconds)
+        gemini_model_seconds.observe(seconds, model=self.label(model))
+
+    def record_escalation(self, tier, reason):
+        with self.lock:
+            self.counts[tier.model]['escalated'] += 1
+            self.escalations[reason] += 1
+        model_routes_total.inc(model=self.label(tier.model), decision='escalated')
+        print(f"Escalating from {self.label(tier.model)} ({reason})")
+
+    def record_outcome(self, tier, answered, documents=1):
+        decision = 'answered' if answered else 'failed'
+        with self.lock:
+            self.counts[tier.model][decision] += documents
+        model_routes_total.inc(documents, model=self.label(tier.model), decision=decision)
+
+    def demand(self):
+        """
+        [(model, calls per document)] from recent routing: a tier is called
+        for the documents routed to it and those the tier below escalated.
+        Before any routing, every document goes to the first tier.
+        """
+        with self.lock:
+            routed = sum(self.decisions.values())
+            if not routed:
+                return [(self.tiers[0].model, 1.0)]
+            shares, escalated = [], 0
+            for tier in self.tiers:
+                calls = self.counts[tier.model]['routed'] + escalated
+                escalated = self.counts[tier.model]['escalated']
+                if calls:
+                    shares.append((tier.model, calls / routed))
+            return shares
+
+    def tracker(self, model):
+        """Latency window of a tier (used for its hedge delay)"""
+        return self.trackers.get(model, gemini_latency)
+
+    def label(self, model):
+        return model.rsplit('/', 1)[-1]
+
+    def get_stats(self):
+        with self.lock:
+            counts = {model: dict(tier_counts) for model, tier_counts in self.counts.items()}
+            decisions = dict(self.decisions)
+            escalations = dict(self.escalations)
+            routed = sum(decisions.values())
+            mean_score = round(self.score_total / routed, 3) if routed else None
+        answered = sum(tier_counts['answered'] for tier_counts in counts.values())
+        return {
+            'enabled': Config.MODEL_ROUTING_ENABLED,
+            'decisions': decisions,
+            'escalations': escalations,
+            'mean_score': mean_score,
+            'tiers': [
+                dict(
+                    counts[tier.model],
+                    model=tier.model,
+                    requests_per_minute=tier.requests_per_minute,
+                    tokens_per_minute=tier.tokens_per_minute,
+                    answer_share=round(counts[tier.model]['answered'] / answered, 3) if answered else 0.0,
+                    latency=self.tracker(tier.model).summary()
+                )
+                for tier in self.tiers
+            ]
+        }
+
+def _configured_tiers():
+    if Config.MODEL_ROUTING_ENABLED:
+        tiers = parse_model_tiers(Config.GEMINI_MODEL_TIERS)
+        if tiers:
+            return tiers
+    return [ModelTier(0, Config.GEMINI_MODEL, Config.RATE_LIMIT_REQUESTS, Config.RATE_LIMIT_TOKENS)]
+
+# Global instance
+model_router = ModelRouter(_configured_tiers())
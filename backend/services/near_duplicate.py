@@ -0,0 +1,297 @@
+import os
+import re
+import json
+import time
+import zlib
+import difflib
+import hashlib
+import sqlite3
+import threading
+from config import Config
+from services.fallback_processor import FIELD_PATTERNS, NUMERIC_FIELDS
+from services.response_schema import NOT_FOUND
+from utils.helpers import EXTRACTED_FIELDS
+
+# NumPy is imported where it is used so the app starts quickly
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = 0xFFFFFFFF
+_HASH_CHUNK = 2048  # shingles permuted at once, bounds the temporary array
+_MAX_CANDIDATES = 8
+_NUMBER_RE = re.compile(r'\d[\d,]*(?:\.\d+)?')
+
+def normalize_lines(text):
+    """Lower-cased lines of extracted text with whitespace collapsed; blank lines dropped"""
+    return [' '.join(line.lower().split()) for line in text.splitlines() if line.strip()]
+
+def _mentions(line, field, value):
+    """Whether a normalized line holds a field's prior value"""
+    if value in (None, '', NOT_FOUND):
+        return False
+    if field in NUMERIC_FIELDS:
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return False
+        return any(abs(float(found.replace(',', '')) - number) < 0.01 for found in _NUMBER_RE.findall(line))
+    value = ' '.join(str(value).lower().split())
+    # Values such as addresses can span several lines of the document
+    return len(value) >= 3 and (value in line or (len(line) >= 8 and line in value))
+
+def same_load(prior_fields, text):
+    """
+    Whether text still carries the prior document's load number. Loads
+    from one broker share most of their boilerplate, so similar text
+    alone does not make a revision.
+    """
+    return any(_mentions(line, 'load_number', prior_fields.get('load_number')) for line in normalize_lines(text))
+
+def affected_fields(old_text, new_text, old_fields):
+    """
+    Fields a revision may have changed: those whose prior value is on a
+    changed line, or whose label (a fallback_processor pattern) is. Changed
+    lines no field accounts for are put down to the notes. Returns
+    (fields, changed lines).
+    """
+    old_lines, new_lines = normalize_lines(old_text), normalize_lines(new_text)
+    changed = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, old_start, old_end, new_start, new_end in matcher.get_opcodes():
+        if tag != 'equal':
+            changed.extend(old_lines[old_start:old_end])
+            changed.extend(new_lines[new_start:new_end])
+
+    fields = set()
+    for line in changed:
+        hits = {field for field in EXTRACTED_FIELDS if _mentions(line, field, old_fields.get(field))}
+        hits.update(
+            field for field, patterns in FIELD_PATTERNS.items()
+            if any(pattern.search(line) for pattern, _ in patterns)
+        )
+        fields.update(hits or {'notes'})
+    return [field for field in EXTRACTED_FIELDS if field in fields], changed
+
+class NearDuplicateIndex:
+    """
+    Index of analyzed RC texts for spotting revised versions of a load
+    (new rate, appointment or note, otherwise the same document). Each text
+    gets a MinHash signature of its word shingles; LSH buckets (bands of
+    the signature) find candidates without comparing against every entry.
+    Signatures, compressed texts and extracted fields live in SQLite,
+    bounded to max_entries with least recently used eviction.
+    """
+
+    def __init__(self, db_path, max_entries=5000, ttl_seconds=7 * 24 * 3600, permutations=128, bands=16,
+                 shingle_words=3, min_similarity=0.8):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.bands = bands
+        self.rows = permutations // bands
+        self.shingle_words = shingle_words
+        self.min_similarity = min_similarity
+        self._hash_params = None
+        self.lock = threading.Lock()
+        self._conn = None
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'revisions': 0,
+            'local_fields': 0,
+            'ai_fields': 0
+        }
+
+    def _get_conn(self):
+        """Open the SQLite file lazily so importing the module stays cheap"""
+        if self._conn is None:
+            folder = os.path.dirname(self.db_path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS documents ('
+                'key TEXT PRIMARY KEY, signature BLOB NOT NULL, text BLOB NOT NULL, fields TEXT NOT NULL, '
+                'created_at REAL NOT NULL, last_access REAL NOT NULL)'
+            )
+            self._conn.execute('CREATE TABLE IF NOT EXISTS buckets (bucket INTEGER NOT NULL, key TEXT NOT NULL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_buckets_bucket ON buckets (bucket)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_buckets_key ON buckets (key)')
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_documents_last_access ON documents (last_access)'
+            )
+            self._conn.commit()
+        return self._conn
+
+    def _permutations(self):
+        """(a, b) of the universal hashes, drawn on first use"""
+        if self._hash_params is None:
+            import numpy as np
+
+            # Fixed seed: signatures must agree across restarts and worker processes
+            rng = np.random.RandomState(1)
+            size = self.bands * self.rows
+            self._hash_params = (
+                rng.randint(1, 1 << 32, size=size, dtype=np.uint64),
+                rng.randint(0, 1 << 32, size=size, dtype=np.uint64)
+            )
+        return self._hash_params
+
+    def signature(self, text):
+        """MinHash signature (uint32 per permutation) of a text's word shingles, None for empty text"""
+        import numpy as np
+
+        words = ' '.join(normalize_lines(text)).split()
+        if not words:
+            return None
+        size = min(self.shingle_words, len(words))
+        shingles = {' '.join(words[index:index + size]) for index in range(len(words) - size + 1)}
+        a, b = self._permutations()
+        prime, max_hash = np.uint64(_MERSENNE_PRIME), np.uint64(_MAX_HASH)
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode()) for shingle in shingles), dtype=np.uint64, count=len(shingles)
+        )
+        signature = np.full(len(a), max_hash, dtype=np.uint64)
+        for start in range(0, len(hashes), _HASH_CHUNK):
+            chunk = hashes[start:start + _HASH_CHUNK]
+            # (a * h + b) mod p as a universal hash; a, b and h are below 2**32, so nothing overflows
+            permuted = (a[:, None] * chunk[None, :] + b[:, None]) % prime & max_hash
+            np.minimum(signature, permuted.min(axis=1), out=signature)
+        return signature.astype(np.uint32)
+
+    def _buckets(self, signature):
+        """One LSH bucket id per band (the band number is part of the hash)"""
+        return [
+            int.from_bytes(hashlib.blake2b(
+                bytes([band]) + signature[band * self.rows:(band + 1) * self.rows].tobytes(), digest_size=8
+            ).digest(), 'big', signed=True)
+            for band in range(self.bands)
+        ]
+
+    def similarity(self, left, right):
+        """Estimated Jaccard similarity of two signatures"""
+        import numpy as np
+
+        return float(np.mean(left == right))
+
+    def find(self, text):
+        """
+        The most similar analyzed document at or above min_similarity, as
+        {'key', 'similarity', 'text', 'fields'}, or None
+        """
+        import numpy as np
+
+        signature = self.signature(text)
+        if signature is None:
+            return None
+        buckets = self._buckets(signature)
+        with self.lock:
+            conn = self._get_conn()
+            candidates = conn.execute(
+                f"SELECT key FROM buckets WHERE bucket IN ({','.join('?' * len(buckets))}) "
+                'GROUP BY key ORDER BY COUNT(*) DESC LIMIT ?',
+                (*buckets, _MAX_CANDIDATES)
+            ).fetchall()
+            now = time.time()
+            best, best_score = None, 0.0
+            for (key,) in candidates:
+                row = conn.execute(
+                    'SELECT signature, text, fields, created_at FROM documents WHERE key = ?', (key,)
+                ).fetchone()
+                if row is None:
+                    continue
+                if self.ttl_seconds and now - row[3] > self.ttl_seconds:
+                    self._delete(conn, key)
+                    self.stats['expirations'] += 1
+                    continue
+                score = self.similarity(signature, np.frombuffer(row[0], dtype=np.uint32))
+                if score > best_score:
+                    best, best_score = (key, row), score
+
+            if best is None or best_score < self.min_similarity:
+                conn.commit()
+                self.stats['misses'] += 1
+                return None
+            key, row = best
+            conn.execute('UPDATE documents SET last_access = ? WHERE key = ?', (now, key))
+            conn.commit()
+            self.stats['hits'] += 1
+        return {
+            'key': key,
+            'similarity': round(best_score, 3),
+            'text': zlib.decompress(row[1]).decode('utf-8'),
+            'fields': json.loads(row[2])
+        }
+
+    def add(self, key, text, fields):
+        """Index an analyzed document (key is its file hash) and evict the least recently used over the limit"""
+        signature = self.signature(text)
+        if signature is None:
+            return
+        buckets = self._buckets(signature)
+        with self.lock:
+            conn = self._get_conn()
+            now = time.time()
+            self._delete(conn, key)
+            conn.execute(
+                'INSERT INTO documents (key, signature, text, fields, created_at, last_access) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, signature.tobytes(), zlib.compress(text.encode('utf-8')), json.dumps(fields), now, now)
+            )
+            conn.executemany('INSERT INTO buckets (bucket, key) VALUES (?, ?)', [(bucket, key) for bucket in buckets])
+            self.stats['stores'] += 1
+
+            count = conn.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+            overflow = count - self.max_entries
+            if overflow > 0:
+                for (old_key,) in conn.execute(
+                    'SELECT key FROM documents ORDER BY last_access ASC LIMIT ?', (overflow,)
+                ).fetchall():
+                    self._delete(conn, old_key)
+                self.stats['evictions'] += overflow
+            conn.commit()
+
+    def _delete(self, conn, key):
+        conn.execute('DELETE FROM documents WHERE key = ?', (key,))
+        conn.execute('DELETE FROM buckets WHERE key = ?', (key,))
+
+    def record_revision(self, local_fields, ai_fields):
+        """Count a revision answered by re-extracting these many fields locally and with the AI"""
+        with self.lock:
+            self.stats['revisions'] += 1
+            self.stats['local_fields'] += local_fields
+            self.stats['ai_fields'] += ai_fields
+
+    def clear(self):
+        """Remove all indexed documents"""
+        with self.lock:
+            conn = self._get_conn()
+            conn.execute('DELETE FROM documents')
+            conn.execute('DELETE FROM buckets')
+            conn.commit()
+
+    def get_stats(self):
+        """Lookup counters and current size"""
+        with self.lock:
+            conn = self._get_conn()
+            size = conn.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+            stats = self.stats.copy()
+            lookups = stats['hits'] + stats['misses']
+            stats['size'] = size
+            stats['max_entries'] = self.max_entries
+            stats['ttl_seconds'] = self.ttl_seconds
+            stats['min_similarity'] = self.min_similarity
+            stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0
+            return stats
+
+# Global instance
+near_duplicate_index = NearDuplicateIndex(
+    Config.NEAR_DUP_DB_PATH,
+    max_entries=Config.NEAR_DUP_MAX_ENTRIES,
+    ttl_seconds=Config.NEAR_DUP_TTL_SECONDS,
+    permutations=Config.NEAR_DUP_PERMUTATIONS,
+    bands=Config.NEAR_DUP_BANDS,
+    shingle_words=Config.NEAR_DUP_SHINGLE_WORDS,
+    min_similarity=Config.NEAR_DUP_MIN_SIMILARITY
+)
@@ -0,0 +1,220 @@
+import io
+import time
+import shutil
+import threading
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+from config import Config
+from services.result_cache import ResultCache
+from utils.helpers import worker_context
+
+# pdfplumber, PIL and pytesseract are imported where they are used so the app starts quickly
+HAS_PYTESSERACT = importlib.util.find_spec('pytesseract') is not None
+_tesseract_binary = None
+
+def has_tesseract():
+    """Whether pytesseract and the tesseract binary it runs are both installed (probed once)"""
+    global _tesseract_binary
+    if _tesseract_binary is None:
+        _tesseract_binary = False
+        if HAS_PYTESSERACT:
+            import pytesseract
+
+            _tesseract_binary = shutil.which(pytesseract.pytesseract.tesseract_cmd) is not None
+            if not _tesseract_binary:
+                print(f"tesseract binary not found ({pytesseract.pytesseract.tesseract_cmd}); local OCR is off")
+    return _tesseract_binary
+
+_ocr_pool = None
+_ocr_pool_lock = threading.Lock()
+
+def _get_ocr_pool():
+    """Shared process pool for rasterizing and OCR'ing pages"""
+    global _ocr_pool
+    with _ocr_pool_lock:
+        if _ocr_pool is None:
+            _ocr_pool = ProcessPoolExecutor(max_workers=Config.OCR_WORKERS, mp_context=worker_context())
+        return _ocr_pool
+
+def _fit_image(image):
+    """Upright the image (phone photos carry EXIF rotation) and cap its size"""
+    from PIL import Image, ImageOps
+
+    image = ImageOps.exif_transpose(image)
+    longest = max(image.size)
+    if longest > Config.OCR_MAX_IMAGE_SIDE:
+        scale = Config.OCR_MAX_IMAGE_SIDE / longest
+        image = image.resize((int(image.width * scale), int(image.height * scale)), Image.LANCZOS)
+    return image
+
+def _preprocess_image(image):
+    """Grayscale, contrast-stretched and denoised image for Tesseract"""
+    from PIL import Image, ImageOps, ImageFilter
+
+    image = _fit_image(image).convert('L')
+    if max(image.size) < 1500:
+        # Screenshots and small photos: glyphs are too short for reliable OCR
+        image = image.resize((image.width * 2, image.height * 2), Image.LANCZOS)
+    image = ImageOps.autocontrast(image, cutoff=1)
+    return image.filter(ImageFilter.MedianFilter(3))
+
+def _tesseract(image, language):
+    import pytesseract
+
+    return pytesseract.image_to_string(_preprocess_image(image), lang=language, config='--oem 1 --psm 3')
+
+def _render_pdf_page(source, page_index, dpi):
+    """Rasterize one PDF page (source is a path or raw bytes)"""
+    import pdfplumber
+
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    with pdfplumber.open(source) as pdf:
+        return pdf.pages[page_index].to_image(resolution=dpi).original.copy()
+
+def _encode_jpeg(image):
+    buffer = io.BytesIO()
+    _fit_image(image).convert('RGB').save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
+
+def _ocr_image_bytes(image_bytes, language):
+    """OCR an uploaded image in a worker process. Returns (text, seconds)"""
+    from PIL import Image
+
+    started = time.perf_counter()
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        text = _tesseract(image, language)
+    return text, time.perf_counter() - started
+
+def _ocr_pdf_page(source, page_index, dpi, language):
+    """Rasterize and OCR one PDF page in a worker process. Returns (text, seconds)"""
+    started = time.perf_counter()
+    text = _tesseract(_render_pdf_page(source, page_index, dpi), language)
+    return text, time.perf_counter() - started
+
+def _prepare_image_jpeg(image_bytes):
+    """Upright and downscale an uploaded image for Gemini. Returns (bytes, seconds)"""
+    from PIL import Image
+
+    started = time.perf_counter()
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        data = _encode_jpeg(image)
+    return data, time.perf_counter() - started
+
+def _render_pdf_page_jpeg(source, page_index, dpi):
+    """Rasterize one PDF page to JPEG bytes for Gemini. Returns (bytes, seconds)"""
+    started = time.perf_counter()
+    data = _encode_jpeg(_render_pdf_page(source, page_index, dpi))
+    return data, time.perf_counter() - started
+
+class OCREngine:
+    """
+    Text for image uploads and scanned PDF pages. The 'tesseract' engine
+    runs locally in a process pool; the 'gemini' engine sends each page as
+    an inline image part. Page results are cached by file hash and page.
+    """
+
+    def __init__(self, engine=None, parallel=True):
+        self.engine = engine or Config.OCR_ENGINE
+        self.parallel = parallel
+        self.language = Config.OCR_LANGUAGE
+        self.dpi = Config.OCR_DPI
+
+    @property
+    def available(self):
+        if self.engine == 'gemini':
+            return True
+        return has_tesseract()
+
+    def ocr_image(self, image_bytes, file_hash):
+        """OCR an uploaded image. Returns (text, seconds); the text is empty if OCR failed"""
+        if self.engine == 'gemini':
+            pages = self._run(file_hash, [1], _prepare_image_jpeg, lambda page_number: (image_bytes,))
+        else:
+            pages = self._run(file_hash, [1], _ocr_image_bytes, lambda page_number: (image_bytes, self.language))
+        return pages.get(1, ('', 0.0))
+
+    def ocr_pdf_pages(self, source, page_numbers, file_hash):
+        """
+        OCR the given (1-based) pages of a PDF. Returns {page_number: (text,
+        seconds)}; pages whose OCR failed are left out.
+        """
+        if self.engine == 'gemini':
+            return self._run(
+                file_hash, page_numbers, _render_pdf_page_jpeg,
+                lambda page_number: (source, page_number - 1, self.dpi)
+            )
+        return self._run(
+            file_hash, page_numbers, _ocr_pdf_page,
+            lambda page_number: (source, page_number - 1, self.dpi, self.language)
+        )
+
+    def _cache_key(self, file_hash, page_number):
+        return f"{file_hash}:{page_number}:{self.engine}:{self.language}:{self.dpi}"
+
+    def _run(self, file_hash, page_numbers, task, task_args):
+        """
+        Run task(*task_args(page)) for the pages missing from the cache. For
+        tesseract the task returns text; for gemini it returns the image to
+        transcribe. A page whose task or transcription fails is logged and
+        left out.
+        """
+        results = {}
+        missing = []
+        for page_number in page_numbers:
+            cached = ocr_page_cache.get(self._cache_key(file_hash, page_number)) if Config.CACHE_ENABLED else None
+            if cached is not None:
+                results[page_number] = (cached['text'], 0.0)
+            else:
+                missing.append(page_number)
+
+        if not missing:
+            return results
+
+        if self.parallel and len(missing) > 1:
+            pool = _get_ocr_pool()
+            futures = {page_number: pool.submit(task, *task_args(page_number)) for page_number in missing}
+            calls = {page_number: future.result for page_number, future in futures.items()}
+        else:
+            calls = {page_number: lambda page_number=page_number: task(*task_args(page_number)) for page_number in missing}
+        outputs = {}
+        for page_number, call in calls.items():
+            try:
+                outputs[page_number] = call()
+            except Exception as e:
+                print(f"OCR ({self.engine}) failed for page {page_number}: {str(e)}")
+
+        for page_number, (output, seconds) in outputs.items():
+            if self.engine == 'gemini':
+                started = time.perf_counter()
+                text = self._transcribe_with_gemini(output)
+                seconds += time.perf_counter() - started
+            else:
+                text = output
+
+            if text is None:
+                # Left out like a failed tesseract page, so the page keeps its text layer
+                continue
+            if Config.CACHE_ENABLED:
+                ocr_page_cache.set(self._cache_key(file_hash, page_number), {'text': text})
+            results[page_number] = (text, seconds)
+
+        print(f"OCR ({self.engine}): {len(missing)} pages, {len(page_numbers) - len(missing)} cached")
+        return results
+
+    def _transcribe_with_gemini(self, image_bytes):
+        """Page text from Gemini, or None if the request failed"""
+        # Imported here so local OCR workers don't load the Gemini client
+        from services.ai_processor import AIProcessor
+        result = AIProcessor().transcribe_image(image_bytes, 'image/jpeg')
+        if 'error' in result:
+            print(f"Gemini OCR error: {result['error']}")
+            return None
+        return result['text']
+
+# Global instance
+ocr_page_cache = ResultCache(
+    Config.OCR_CACHE_DB_PATH,
+    max_entries=Config.CACHE_MAX_ENTRIES * 5,
+    ttl_seconds=Config.CACHE_TTL_SECONDS
+)
@@ -1,21 +1,257 @@
-import pdfplumber
+import io
+import os
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from config import Config
+from services.ocr_engine import OCREngine
+from utils.helpers import detect_file_type, compute_file_hash, worker_context
+
+_page_pool = None
+_page_pool_lock = threading.Lock()
+
+def _get_page_pool():
+    """Shared process pool for parallel page extraction"""
+    global _page_pool
+    with _page_pool_lock:
+        if _page_pool is None:
+            _page_pool = ProcessPoolExecutor(max_workers=Config.PDF_PARALLEL_WORKERS, mp_context=worker_context())
+        return _page_pool
+
+def _open_pdf(source):
+    """Open a PDF from a path, raw bytes or a file-like object"""
+    import pdfplumber  # heavy (pdfminer); kept off the app import path
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    return pdfplumber.open(source)
+
+def _extract_page_words(page, page_number):
+    """Word boxes of a page, normalized to 0..1 of the page size"""
+    width = float(page.width) or 1.0
+    height = float(page.height) or 1.0
+    return [
+        {
+            'page': page_number,
+            'text': word['text'],
+            'x0': round(float(word['x0']) / width, 4),
+            'x1': round(float(word['x1']) / width, 4),
+            'top': round(float(word['top']) / height, 4),
+            'bottom': round(float(word['bottom']) / height, 4)
+        }
+        for word in page.extract_words()
+    ]
+
+def _extract_page_range(source, start, end, layout_pages=0):
+    """
+    Extract pages [start, end) in a worker process.
+    Returns a list of (page_number, text, seconds) and the layout words.
+    """
+    pages = []
+    words = []
+    with _open_pdf(source) as pdf:
+        for index in range(start, min(end, len(pdf.pages))):
+            started = time.perf_counter()
+            page = pdf.pages[index]
+            page_text = page.extract_text() or ""
+            if index < layout_pages:
+                words.extend(_extract_page_words(page, index + 1))
+            pages.append((index + 1, page_text, time.perf_counter() - started))
+    return pages, words
 
 class PDFTextExtractor:
-    def __init__(self):
-        pass
-    
-    def extract_text_from_pdf(self, file_path):
+    def __init__(self, max_chars=None, parallel=True):
+        # Stop parsing once this many characters are collected (None = no limit)
+        self.max_chars = max_chars
+        self.parallel = parallel
+
+    def extract_text_from_pdf(self, source):
+        """
+        Extract text from PDF or image file (path, bytes or file-like object)
+        """
+        return self.extract(source)['text']
+
+    def extract(self, source, max_chars=None, layout_pages=0):
         """
-        Extract text from PDF file
+        Extract text with page timings. Parsing stops as soon as the
+        character budget is reached; large documents are split across
+        worker processes. Word boxes of the first layout_pages pages are
+        returned for layout fingerprinting. Images and pages without a
+        text layer go through OCR.
         """
-        text = ""
+        max_chars = max_chars if max_chars is not None else self.max_chars
+        started = time.perf_counter()
+
         try:
-            with pdfplumber.open(file_path) as pdf:
-                for page in pdf.pages:
-                    page_text = page.extract_text()
-                    if page_text:
-                        text += page_text + "\n"
+            # File-like objects are read once so worker processes can reopen them
+            if hasattr(source, 'read'):
+                source.seek(0)
+                source = source.read()
+
+            if detect_file_type(self._read_header(source)) in ('png', 'jpg'):
+                return self._extract_image(source, max_chars, started)
+
+            with _open_pdf(source) as pdf:
+                page_count = len(pdf.pages)
+                use_parallel = (
+                    self.parallel
+                    and Config.PDF_PARALLEL_WORKERS > 1
+                    and page_count >= Config.PDF_PARALLEL_MIN_PAGES
+                )
+                if not use_parallel:
+                    pages, words = self._extract_sequential(pdf, max_chars, layout_pages)
+
+            if use_parallel:
+                if not isinstance(source, (str, os.PathLike)):
+                    source = bytes(source)
+                pages, words = self._extract_parallel(source, page_count, max_chars, layout_pages)
+
+            ocr_pages = self._ocr_scanned_pages(source, pages)
         except Exception as e:
             raise Exception(f"PDF extraction error: {str(e)}")
-        
-        return text
+
+        parts = [page_text + "\n" for _, page_text, _ in pages if page_text]
+        text = "".join(parts)
+        truncated = bool(max_chars) and (
+            len(text) > max_chars or len(pages) < page_count
+        )
+        if max_chars:
+            text = text[:max_chars]
+
+        return {
+            'text': text,
+            'page_count': page_count,
+            'pages_extracted': len(pages),
+            'truncated': truncated,
+            'parallel': use_parallel,
+            'total_seconds': round(time.perf_counter() - started, 4),
+            'pages': [
+                {'page': page_number, 'chars': len(page_text), 'seconds': round(seconds, 4)}
+                for page_number, page_text, seconds in pages
+            ],
+            'words': words,
+            'ocr_pages': ocr_pages
+        }
+
+    def _read_header(self, source):
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, 'rb') as f:
+                return f.read(1024)
+        return bytes(source[:1024])
+
+    def _ocr_scanned_pages(self, source, pages):
+        """
+        OCR extracted pages that have no text layer (scans) in place.
+        Returns the OCR'd page numbers; pages whose OCR fails keep the
+        text layer they have.
+        """
+        if not Config.OCR_ENABLED:
+            return []
+        scanned = [
+            page_number for page_number, page_text, _ in pages
+            if len(page_text.strip()) < Config.OCR_MIN_PAGE_CHARS
+        ][:Config.OCR_MAX_PAGES]
+        if not scanned:
+            return []
+
+        engine = OCREngine(parallel=self.parallel)
+        if not engine.available:
+            print(f"OCR engine '{engine.engine}' is not available; {len(scanned)} scanned pages have no text")
+            return []
+
+        if not isinstance(source, (str, os.PathLike)):
+            source = bytes(source)
+        try:
+            results = engine.ocr_pdf_pages(source, scanned, compute_file_hash(source))
+        except Exception as e:
+            print(f"OCR error, {len(scanned)} scanned pages keep their text layer: {str(e)}")
+            return []
+        for index, (page_number, page_text, seconds) in enumerate(pages):
+            if page_number in results:
+                ocr_text, ocr_seconds = results[page_number]
+                pages[index] = (page_number, ocr_text, seconds + ocr_seconds)
+        return [page_number for page_number in scanned if page_number in results]
+
+    def _extract_image(self, source, max_chars, started):
+        """Extract text from an image upload (photo or scan of an RC) with OCR"""
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, 'rb') as f:
+                source = f.read()
+        source = bytes(source)
+
+        text, seconds = '', 0.0
+        engine = OCREngine(parallel=self.parallel)
+        if not Config.OCR_ENABLED:
+            print("OCR is disabled; image upload has no text")
+        elif not engine.available:
+            print(f"OCR engine '{engine.engine}' is not available; image upload has no text")
+        else:
+            text, seconds = engine.ocr_image(source, compute_file_hash(source))
+
+        truncated = bool(max_chars) and len(text) > max_chars
+        if max_chars:
+            text = text[:max_chars]
+
+        return {
+            'text': text,
+            'page_count': 1,
+            'pages_extracted': 1,
+            'truncated': truncated,
+            'parallel': False,
+            'total_seconds': round(time.perf_counter() - started, 4),
+            'pages': [{'page': 1, 'chars': len(text), 'seconds': round(seconds, 4)}],
+            'words': [],
+            'ocr_pages': [1] if text else []
+        }
+
+    def _extract_sequential(self, pdf, max_chars, layout_pages=0):
+        """Extract pages in order until the character budget is reached"""
+        pages = []
+        words = []
+        collected = 0
+        for index, page in enumerate(pdf.pages):
+            page_started = time.perf_counter()
+            page_text = page.extract_text() or ""
+            if index < layout_pages:
+                words.extend(_extract_page_words(page, index + 1))
+            pages.append((index + 1, page_text, time.perf_counter() - page_started))
+
+            collected += len(page_text) + 1 if page_text else 0
+            if max_chars and collected >= max_chars:
+                break
+        return pages, words
+
+    def _extract_parallel(self, source, page_count, max_chars, layout_pages=0):
+        """
+        Extract page chunks across processes. Chunks are submitted a window at
+        a time and consumed in order, so no new work starts once the budget
+        is met.
+        """
+        pool = _get_page_pool()
+        chunk_size = Config.PDF_PAGES_PER_CHUNK
+        chunks = [(start, start + chunk_size) for start in range(0, page_count, chunk_size)]
+        window = Config.PDF_PARALLEL_WORKERS
+
+        pages = []
+        words = []
+        collected = 0
+        futures = []
+        next_chunk = 0
+
+        while next_chunk < len(chunks) or futures:
+            while next_chunk < len(chunks) and len(futures) < window:
+                start, end = chunks[next_chunk]
+                futures.append(pool.submit(_extract_page_range, source, start, end, layout_pages))
+                next_chunk += 1
+
+            chunk_pages, chunk_words = futures.pop(0).result()
+            pages.extend(chunk_pages)
+            words.extend(chunk_words)
+            collected += sum(len(page_text) + 1 for _, page_text, _ in chunk_pages if page_text)
+
+            if max_chars and collected >= max_chars:
+                for future in futures:
+                    future.cancel()
+                break
+
+        return pages, words
@@ -0,0 +1,307 @@
+import re
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+from config import Config
+
+FIELD_INSTRUCTIONS = """
+        REQUIRED FIELDS:
+        - broker_name: broker name & contact info (phone, email)
+        - carrier_name: carrier name & MC number
+        - load_number: load number
+        - pickup_number: pickup number, PRO number, BOL number, or reference number
+        - rate: total rate (numeric value only)
+        - distance: distance from Pickup to Delivery in miles (numeric value only)
+        - pickup_address: complete pickup address with ZIP code
+        - pickup_time: pickup date, time, and appointment type (FCFS, appointment, etc.)
+        - delivery_address: complete delivery address with ZIP code
+        - delivery_time: delivery date, time, and appointment type
+        - commodity: commodity type and description
+        - weight: weight in lbs (numeric value only)
+        - equipment: equipment type (van, reefer, flatbed, etc.)
+        - notes: special instructions, detention, lumper, requirements
+"""
+
+PROMPT_INSTRUCTIONS = """
+        Analyze this Rate Confirmation document and extract the following information as valid JSON.
+        If any information is not found, use "Not found".
+""" + FIELD_INSTRUCTIONS + """
+        IMPORTANT:
+        - Return ONLY valid JSON format, no other text or explanations
+
+        Rate Confirmation text to analyze:
+        """
+
+# field -> its line in FIELD_INSTRUCTIONS, for prompts that ask for some fields only
+FIELD_DESCRIPTIONS = dict(re.findall(r'^\s*- (\w+): (.+)$', FIELD_INSTRUCTIONS, re.M))
+
+def followup_instructions(fields):
+    """Instructions asking only for the fields an earlier answer left out"""
+    field_lines = ''.join(f"        - {field}: {FIELD_DESCRIPTIONS.get(field, field)}\n" for field in fields)
+    return """
+        Extract ONLY the following fields from this Rate Confirmation document as valid JSON.
+        If any information is not found, use "Not found".
+
+        REQUIRED FIELDS:
+""" + field_lines + """
+        IMPORTANT:
+        - Return ONLY valid JSON format, no other text or explanations
+
+        Rate Confirmation text to analyze:
+        """
+
+OCR_PROMPT_INSTRUCTIONS = """
+        Transcribe all text in this scanned Rate Confirmation page exactly as written.
+        Keep the reading order and put each line on its own line.
+        Return ONLY the transcribed text, no other text or explanations.
+        """
+
+BATCH_PROMPT_INSTRUCTIONS = """
+        Analyze each of the following Rate Confirmation documents separately and extract
+        the following information for every document. If any information is not found, use "Not found".
+""" + FIELD_INSTRUCTIONS + """
+        IMPORTANT:
+        - Return ONLY a valid JSON array with exactly one object per document
+        - Every object must include "document_id" copied from its DOCUMENT header
+        - Never mix information between documents
+        - No other text or explanations
+
+        Rate Confirmation documents to analyze:
+        """
+
+# Keywords that point at the fields we extract, with a weight per hit
+FIELD_KEYWORDS = {
+    'broker': 2, 'carrier': 2, 'mc': 1, 'dot': 1, 'phone': 1, 'email': 1,
+    'load': 2, 'pickup': 3, 'pu': 2, 'pro': 1, 'bol': 2, 'reference': 1, 'ref': 1,
+    'rate': 3, 'total': 2, 'pay': 2, 'linehaul': 2, 'amount': 1, 'usd': 1,
+    'miles': 2, 'mileage': 2, 'distance': 2,
+    'shipper': 3, 'origin': 2, 'consignee': 3, 'delivery': 3, 'destination': 2, 'drop': 1, 'stop': 2,
+    'date': 1, 'time': 1, 'appointment': 2, 'appt': 2, 'fcfs': 2,
+    'commodity': 3, 'weight': 2, 'lbs': 2, 'pallets': 1,
+    'equipment': 3, 'van': 2, 'reefer': 2, 'flatbed': 2, 'trailer': 1,
+    'notes': 2, 'instructions': 2, 'detention': 2, 'lumper': 2, 'tarp': 1, 'temp': 1
+}
+
+# Legal boilerplate that rarely carries field values
+BOILERPLATE_KEYWORDS = {
+    'indemnify', 'indemnification', 'liability', 'liable', 'hereby', 'herein', 'thereof',
+    'agreement', 'shall', 'arbitration', 'jurisdiction', 'warrant', 'warranty', 'terms',
+    'conditions', 'pursuant', 'negligence', 'damages', 'insurance', 'governed'
+}
+
+_WORD_RE = re.compile(r'[a-z]+')
+_SPACES_RE = re.compile(r'[ \t\f\v]+')
+_PAGE_NUMBER_RE = re.compile(r'^\s*page\s+\d+(\s+of\s+\d+)?\s*$', re.IGNORECASE)
+_VALUE_RE = re.compile(r'\$\s?[\d,]+|\b\d{5}(?:-\d{4})?\b|\b\d{1,2}[/-]\d{1,2}(?:[/-]\d{2,4})?\b|\b\d{1,2}:\d{2}\b')
+
+def _count_with_gemini(text):
+    """Tokens in text according to Gemini's countTokens, on any configured key"""
+    # Imported here: the client pool pulls in the key manager and Gemini SDK
+    from services.gemini_pool import gemini_pool
+    from services.key_manager import key_manager
+
+    keys = key_manager.keys
+    if not keys:
+        raise RuntimeError("No API keys")
+    # countTokens has its own quota, so no request is reserved against the key
+    api_key = keys[hash(text) % len(keys)]
+    model = gemini_pool.get_model(api_key, Config.GEMINI_MODEL)
+    return model.count_tokens(text, request_options={'timeout': Config.PROMPT_COUNT_TIMEOUT}).total_tokens
+
+class TokenCounter:
+    """
+    Token estimates calibrated against the token counts Gemini reports.
+    Each measured response updates the chars-per-token ratio, so prompt
+    packing uses real usage rather than a fixed len // 4 guess. count()
+    asks Gemini for the exact number, cached by text.
+    """
+
+    def __init__(self, chars_per_token=4.0, cache_size=1024):
+        self.chars_per_token = chars_per_token
+        self.samples = 0
+        self.lock = threading.Lock()
+        self.cache_size = cache_size
+        self.counted = OrderedDict()  # sha1 of text -> tokens Gemini counted
+        self.count_stats = {'counted': 0, 'cache_hits': 0, 'failures': 0}
+
+    def estimate(self, text):
+        return int(len(text) / self.chars_per_token) + 1
+
+    def observe(self, text, measured_tokens):
+        """Update the ratio from a measured token count"""
+        if not text or not measured_tokens:
+            return
+        ratio = len(text) / measured_tokens
+        with self.lock:
+            # Exponential moving average keeps the estimate stable
+            weight = 1.0 / min(self.samples + 1, 20)
+            self.chars_per_token += (ratio - self.chars_per_token) * weight
+            self.samples += 1
+
+    def count(self, text):
+        """Exact tokens in text from Gemini's countTokens, or the estimate if the call fails"""
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        with self.lock:
+            tokens = self.counted.get(digest)
+            if tokens is not None:
+                self.counted.move_to_end(digest)
+                self.count_stats['cache_hits'] += 1
+                return tokens
+        try:
+            tokens = _count_with_gemini(text)
+        except Exception as e:
+            print(f"Token count failed, using the estimate: {str(e)}")
+            with self.lock:
+                self.count_stats['failures'] += 1
+            return self.estimate(text)
+        self.observe(text, tokens)
+        with self.lock:
+            self.counted[digest] = tokens
+            while len(self.counted) > self.cache_size:
+                self.counted.popitem(last=False)
+            self.count_stats['counted'] += 1
+        return tokens
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.count_stats, chars_per_token=round(self.chars_per_token, 3), samples=self.samples)
+
+class PromptBuilder:
+    """
+    Builds the extraction prompt: strips repeated headers/footers, collapses
+    whitespace, ranks text segments by relevance to the required fields and
+    packs the best ones (in document order) into a token budget.
+    """
+
+    def __init__(self, token_budget=None, counter=None):
+        self.token_budget = token_budget or Config.PROMPT_TOKEN_BUDGET
+        self.counter = counter or token_counter
+
+    def build(self, text, instructions=PROMPT_INSTRUCTIONS):
+        """
+        Return (prompt, stats). With PROMPT_EXACT_TOKENS, a prompt estimated
+        near the budget is counted exactly and re-packed once if it is over.
+        """
+        cleaned = self.clean_text(text)
+        instruction_tokens = self.counter.estimate(instructions)
+        document_budget = self.token_budget - instruction_tokens
+        selected, stats = self.select_segments(cleaned, document_budget)
+        prompt = instructions + selected
+        estimated = self.counter.estimate(prompt)
+        if Config.PROMPT_EXACT_TOKENS and estimated >= self.token_budget * (1 - Config.PROMPT_EXACT_TOKENS_MARGIN):
+            counted = self.counter.count(prompt)
+            stats['counted_tokens'] = counted
+            if counted > self.token_budget:
+                selected, repacked = self.select_segments(cleaned, document_budget - (counted - self.token_budget))
+                stats.update(repacked)
+                prompt = instructions + selected
+                estimated = self.counter.estimate(prompt)
+        stats['original_chars'] = len(text)
+        stats['prompt_chars'] = len(prompt)
+        stats['estimated_tokens'] = estimated
+        return prompt, stats
+
+    def build_batch(self, documents, document_budget=None):
+        """
+        Build one prompt for several documents. documents is a list of
+        (document_id, text); each text is compacted to document_budget tokens.
+        Returns (prompt, stats).
+        """
+        document_budget = document_budget or Config.AI_BATCH_DOC_TOKEN_BUDGET
+        parts = [BATCH_PROMPT_INSTRUCTIONS]
+        for document_id, text in documents:
+            selected, _ = self.select_segments(self.clean_text(text), document_budget)
+            parts.append(f"\n=== DOCUMENT {document_id} ===\n{selected}\n")
+        prompt = ''.join(parts)
+        return prompt, {
+            'documents': len(documents),
+            'prompt_chars': len(prompt),
+            'estimated_tokens': self.counter.estimate(prompt)
+        }
+
+    def estimate_document_tokens(self, text):
+        """Tokens a document's compacted text would take in a prompt"""
+        return self.counter.estimate(self.clean_text(text))
+
+    def clean_text(self, text):
+        """Drop repeated header/footer lines and page numbers, collapse whitespace"""
+        lines = [_SPACES_RE.sub(' ', line).strip() for line in text.splitlines()]
+        lines = [line for line in lines if line and not _PAGE_NUMBER_RE.match(line)]
+
+        # Short lines seen on many pages are headers/footers: keep the first copy
+        counts = Counter(line for line in lines if len(line) <= 120)
+        seen = set()
+        cleaned = []
+        for line in lines:
+            if counts.get(line, 0) >= Config.PROMPT_REPEATED_LINE_MIN:
+                if line in seen:
+                    continue
+                seen.add(line)
+            cleaned.append(line)
+        return '\n'.join(cleaned)
+
+    def split_segments(self, text, max_chars=400):
+        """
+        Group consecutive short lines into segments of up to max_chars.
+        Long lines (usually legal paragraphs) stay on their own so they can
+        be ranked separately from the label/value lines around them.
+        """
+        segments = []
+        current = []
+        size = 0
+        for line in text.split('\n'):
+            long_line = len(line) > max_chars // 2
+            if current and (long_line or size + len(line) > max_chars):
+                segments.append('\n'.join(current))
+                current, size = [], 0
+            if long_line:
+                segments.append(line)
+                continue
+            current.append(line)
+            size += len(line) + 1
+        if current:
+            segments.append('\n'.join(current))
+        return segments
+
+    def score_segment(self, segment, position, total):
+        """Relevance of a segment to the extracted fields"""
+        words = _WORD_RE.findall(segment.lower())
+        if not words:
+            return 0.0
+        keyword_score = sum(FIELD_KEYWORDS.get(word, 0) for word in words)
+        boilerplate = sum(1 for word in words if word in BOILERPLATE_KEYWORDS)
+        values = len(_VALUE_RE.findall(segment))
+        # Field values cluster at the top of an RC; legal terms trail at the end
+        position_bonus = 2.0 * (1 - position / max(total, 1))
+        density = (keyword_score + 2 * values - 3 * boilerplate) / (len(words) ** 0.5)
+        return density + position_bonus
+
+    def select_segments(self, text, token_budget):
+        """Pick the most relevant segments that fit the budget, in document order"""
+        segments = self.split_segments(text)
+        total_tokens = self.counter.estimate(text)
+        if total_tokens <= token_budget:
+            return text, {'segments': len(segments), 'segments_kept': len(segments), 'compacted': False}
+
+        scored = [
+            (self.score_segment(segment, index, len(segments)), index)
+            for index, segment in enumerate(segments)
+        ]
+        # The first segment usually carries the broker header, always keep it
+        keep = {0}
+        used = self.counter.estimate(segments[0])
+        for score, index in sorted(scored, reverse=True):
+            if index in keep:
+                continue
+            cost = self.counter.estimate(segments[index])
+            if used + cost > token_budget:
+                continue
+            keep.add(index)
+            used += cost
+
+        selected = '\n'.join(segments[index] for index in sorted(keep))
+        max_chars = int(token_budget * self.counter.chars_per_token)
+        return selected[:max_chars], {'segments': len(segments), 'segments_kept': len(keep), 'compacted': True}
+
+# Global instance
+token_counter = TokenCounter()
@@ -0,0 +1,265 @@
+import re
+import json
+import threading
+from utils.helpers import EXTRACTED_FIELDS
+
+NOT_FOUND = 'Not found'
+NUMERIC_FIELDS = ('rate', 'distance', 'weight')
+
+_NUMBER_RE = re.compile(r'-?\d[\d,]*(?:\.\d+)?|-?\.\d+')
+_EMPTY_VALUES = {'', 'not found', 'n/a', 'na', 'none', 'null', 'unknown', '-'}
+_KEY_RE = re.compile(r'[^a-z0-9]+')
+
+def _normalize_key(key):
+    """'Broker Name' / 'broker-name' -> 'broker_name'"""
+    return _KEY_RE.sub('_', str(key).lower()).strip('_')
+
+def _coerce_number(value):
+    """'$2,450.00' -> 2450.0, '38,000 lbs' -> 38000.0; 'Not found' when there is no number"""
+    if isinstance(value, bool):
+        return NOT_FOUND
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        match = _NUMBER_RE.search(value)
+        if match:
+            return float(match.group().replace(',', ''))
+    return NOT_FOUND
+
+def _coerce_text(value):
+    """Strings stay as they are; nested values are flattened and blanks become 'Not found'"""
+    if isinstance(value, dict):
+        value = ', '.join(str(item) for item in value.values() if item not in (None, ''))
+    elif isinstance(value, list):
+        value = ', '.join(str(item) for item in value if item not in (None, ''))
+    elif value is None:
+        return NOT_FOUND
+    value = str(value).strip()
+    return NOT_FOUND if value.lower() in _EMPTY_VALUES else value
+
+def _schema_property(field):
+    if field in NUMERIC_FIELDS:
+        return {'type': 'number', 'nullable': True}
+    return {'type': 'string'}
+
+def _scan(text, start):
+    """
+    Walk a JSON value from text[start], dropping trailing commas. Returns
+    (cleaned text, open brackets, inside a string, cut points) where cut
+    points are the lengths right before each top-level comma, i.e. after a
+    complete member, for truncated answers.
+    """
+    output = []
+    stack = []
+    cuts = []
+    in_string = False
+    escape = False
+    for char in text[start:]:
+        if in_string:
+            output.append(char)
+            if escape:
+                escape = False
+            elif char == '\\':
+                escape = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+        elif char in '}]':
+            # Trailing comma before a closing bracket
+            while output and output[-1].isspace():
+                output.pop()
+            if output and output[-1] == ',':
+                output.pop()
+            if not stack:
+                break
+            stack.pop()
+            output.append(char)
+            if not stack:
+                break
+            continue
+        elif char == ',' and len(stack) == 1:
+            cuts.append(len(output))
+        output.append(char)
+    return ''.join(output), stack, in_string, cuts
+
+def _close(text, stack):
+    return text.rstrip().rstrip(',:') + ''.join(reversed(stack))
+
+def repair_json(text, opening='{'):
+    """
+    Parse the first JSON object (or array, with opening='[') in a model
+    answer. Code fences and prose around it, trailing commas and raw
+    newlines in strings are tolerated, and an answer cut off mid-way keeps
+    every member that was complete. Returns (value, repairs), repairs being
+    a list of what was fixed; raises ValueError when there is no JSON.
+    """
+    start = text.find(opening)
+    if start < 0:
+        raise ValueError("No JSON found in AI response")
+    closing = '}' if opening == '{' else ']'
+    end = text.rfind(closing)
+
+    # Well-formed answers (the usual case in JSON mode) take one json.loads
+    if end > start:
+        try:
+            value = json.loads(text[start:end + 1], strict=False)
+            return value, (['extra_text'] if text[:start].strip() or text[end + 1:].strip() else [])
+        except ValueError:
+            pass
+
+    cleaned, stack, in_string, cuts = _scan(text, start)
+    repairs = []
+    if not stack and not in_string:
+        repairs.append('syntax')
+        candidates = [cleaned]
+    else:
+        repairs.append('truncated')
+        # A value cut off mid-string or mid-number is dropped rather than kept
+        # half-written, so the field counts as missing and is asked for again
+        candidates = []
+        if not in_string and cleaned.rstrip()[-1:] in ('"', '}', ']'):
+            candidates.append(_close(cleaned, stack))
+        candidates.extend(_close(cleaned[:length], stack[:1]) for length in reversed(cuts[-2:]))
+    for candidate in candidates:
+        try:
+            return json.loads(candidate, strict=False), repairs
+        except ValueError:
+            continue
+    raise ValueError("Could not repair JSON in AI response")
+
+class ResponseSchema:
+    """
+    The extraction fields with a coercer compiled per field: rate, distance
+    and weight become numbers, everything else a string, and empty values
+    'Not found'. A field is only missing when the answer has no key for it,
+    so it can be asked for again on its own.
+    """
+
+    def __init__(self, fields=EXTRACTED_FIELDS, numeric_fields=NUMERIC_FIELDS):
+        self.fields = tuple(fields)
+        self.coercers = {
+            field: _coerce_number if field in numeric_fields else _coerce_text
+            for field in self.fields
+        }
+        self.lock = threading.Lock()
+        self.stats = {
+            'parsed': 0, 'repaired': 0, 'coerced': 0, 'incomplete': 0, 'unparseable': 0,
+            'followups': 0, 'followup_fields': 0, 'followup_recovered': 0
+        }
+
+    def gemini_schema(self, fields=None):
+        """OpenAPI-style schema for Gemini's JSON response mode"""
+        fields = fields or self.fields
+        return {
+            'type': 'object',
+            'properties': {field: _schema_property(field) for field in fields},
+            'required': list(fields)
+        }
+
+    def gemini_batch_schema(self):
+        """Schema for a batch answer: one object per document, tagged with document_id"""
+        item = self.gemini_schema()
+        item['properties']['document_id'] = {'type': 'string'}
+        item['required'] = ['document_id'] + item['required']
+        return {'type': 'array', 'items': item}
+
+    def validate(self, data, fields=None):
+        """Coerce the schema fields found in data; returns (values, missing fields)"""
+        fields = fields or self.fields
+        if not isinstance(data, dict):
+            return {}, list(fields)
+        if any(field not in data for field in fields):
+            # Tolerate "Broker Name" style keys before calling a field missing
+            data = dict({_normalize_key(key): value for key, value in data.items()}, **data)
+
+        values = {}
+        missing = []
+        coerced = 0
+        for field in fields:
+            if field not in data:
+                missing.append(field)
+                continue
+            value = self.coercers[field](data[field])
+            coerced += value != data[field]
+            values[field] = value
+        self._count('coerced', coerced)
+        if missing:
+            self._count('incomplete')
+        return values, missing
+
+    def coerce(self, field, value):
+        """Coerce one field value (e.g. as it streams in); unknown fields pass through"""
+        coercer = self.coercers.get(field)
+        return coercer(value) if coercer else value
+
+    def parse(self, response_text, fields=None):
+        """
+        repair_json + validate for one extraction answer. Returns the
+        coerced values with '_missing' listing fields the answer did not
+        have; raises ValueError when nothing could be parsed.
+        """
+        try:
+            data, repairs = repair_json(response_text)
+        except ValueError:
+            self._count('unparseable')
+            raise
+        self._count('parsed')
+        if repairs:
+            self._count('repaired')
+            print(f"Repaired AI response: {', '.join(repairs)}")
+        values, missing = self.validate(data, fields)
+        if missing:
+            values['_missing'] = missing
+        return values
+
+    def parse_batch(self, response_text):
+        """
+        parse for a batch answer (a JSON array of objects tagged with
+        document_id). Returns {document_id: values}; documents cut off at
+        the end of a truncated answer are simply absent.
+        """
+        try:
+            items, repairs = repair_json(response_text, opening='[')
+        except ValueError:
+            self._count('unparseable')
+            raise
+        if not isinstance(items, list):
+            self._count('unparseable')
+            raise ValueError("Batch response is not a JSON array")
+        self._count('parsed')
+        if repairs:
+            self._count('repaired')
+            print(f"Repaired AI batch response: {', '.join(repairs)}")
+
+        documents = {}
+        for item in items:
+            if isinstance(item, dict) and item.get('document_id') is not None:
+                document_id = str(item.pop('document_id')).strip()
+                values, missing = self.validate(item)
+                if missing:
+                    values['_missing'] = missing
+                documents[document_id] = values
+        return documents
+
+    def record_followup(self, requested, recovered):
+        """Count a follow-up request for requested fields, recovered of which came back"""
+        with self.lock:
+            self.stats['followups'] += 1
+            self.stats['followup_fields'] += requested
+            self.stats['followup_recovered'] += recovered
+
+    def _count(self, name, amount=1):
+        if amount:
+            with self.lock:
+                self.stats[name] += amount
+
+    def get_stats(self):
+        with self.lock:
+            return self.stats.copy()
+
+# Global instance
+rc_response_schema = ResponseSchema()
@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from config import Config
+
+class ResultCache:
+    """
+    Persistent LRU/TTL cache for raw AI extractions, keyed on the SHA-256
+    of the uploaded file. Deadhead-derived fields are never stored here;
+    they are recomputed per request from the cached extraction.
+    """
+
+    def __init__(self, db_path, max_entries=1000, ttl_seconds=7 * 24 * 3600):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self._conn = None
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+            'expirations': 0
+        }
+
+    def _get_conn(self):
+        """Open the SQLite file lazily so importing the module stays cheap"""
+        if self._conn is None:
+            folder = os.path.dirname(self.db_path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'key TEXT PRIMARY KEY, data TEXT NOT NULL, '
+                'created_at REAL NOT NULL, last_access REAL NOT NULL)'
+            )
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_results_last_access ON results (last_access)'
+            )
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key):
+        """Return the cached extraction for key, or None on miss/expiry"""
+        with self.lock:
+            conn = self._get_conn()
+            row = conn.execute(
+                'SELECT data, created_at FROM results WHERE key = ?', (key,)
+            ).fetchone()
+            now = time.time()
+
+            if row is None:
+                self.stats['misses'] += 1
+                return None
+
+            if self.ttl_seconds and now - row[1] > self.ttl_seconds:
+                conn.execute('DELETE FROM results WHERE key = ?', (key,))
+                conn.commit()
+                self.stats['expirations'] += 1
+                self.stats['misses'] += 1
+                return None
+
+            conn.execute('UPDATE results SET last_access = ? WHERE key = ?', (now, key))
+            conn.commit()
+            self.stats['hits'] += 1
+            return json.loads(row[0])
+
+    def set(self, key, data):
+        """Store an extraction and evict least recently used entries over the limit"""
+        with self.lock:
+            conn = self._get_conn()
+            now = time.time()
+            conn.execute(
+                'INSERT OR REPLACE INTO results (key, data, created_at, last_access) '
+                'VALUES (?, ?, ?, ?)',
+                (key, json.dumps(data), now, now)
+            )
+            self.stats['stores'] += 1
+
+            count = conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            overflow = count - self.max_entries
+            if overflow > 0:
+                conn.execute(
+                    'DELETE FROM results WHERE key IN ('
+                    'SELECT key FROM results ORDER BY last_access ASC LIMIT ?)',
+                    (overflow,)
+                )
+                self.stats['evictions'] += overflow
+            conn.commit()
+
+    def clear(self):
+        """Remove all cached entries"""
+        with self.lock:
+            conn = self._get_conn()
+            conn.execute('DELETE FROM results')
+            conn.commit()
+
+    def get_stats(self):
+        """Get cache counters and current size"""
+        with self.lock:
+            conn = self._get_conn()
+            size = conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            stats = self.stats.copy()
+            lookups = stats['hits'] + stats['misses']
+            stats['size'] = size
+            stats['max_entries'] = self.max_entries
+            stats['ttl_seconds'] = self.ttl_seconds
+            stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0
+            return stats
+
+# Global instance
+result_cache = ResultCache(
+    Config.CACHE_DB_PATH,
+    max_entries=Config.CACHE_MAX_ENTRIES,
+    ttl_seconds=Config.CACHE_TTL_SECONDS
+)
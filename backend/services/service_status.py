@@ -0,0 +1,34 @@
+import os
+from config import Config
+from services.key_manager import key_manager
+from services.gemini_pool import gemini_pool
+from services.ai_batcher import ai_batcher
+from services.response_schema import rc_response_schema
+from services.model_router import model_router
+from services.admission import admission_controller
+from services.startup_checks import startup_checker
+
+def health_status():
+    """Payload of /api/health (shared by the Flask and ASGI apps)"""
+    has_google_key = bool(os.environ.get('GOOGLE_AI_KEY_1') or os.environ.get('GOOGLE_AI_KEY'))
+    return {
+        'status': 'healthy',
+        'message': 'SMART RC API is running',
+        'ai_service': 'google_gemini',
+        'google_ai_configured': has_google_key,
+        'available_keys': len([k for k in Config.GOOGLE_AI_KEYS if k.strip()]),
+        'startup_checks': startup_checker.get_status()
+    }
+
+def keys_status():
+    """Payload of /api/keys/status (shared by the Flask and ASGI apps)"""
+    return {
+        'keys_status': key_manager.get_status(),
+        'total_keys': len(Config.GOOGLE_AI_KEYS),
+        'active_keys': sum(1 for key in Config.GOOGLE_AI_KEYS if key.strip()),
+        'ai_batching': ai_batcher.get_stats(),
+        'ai_responses': rc_response_schema.get_stats(),
+        'model_router': model_router.get_stats(),
+        'admission': admission_controller.get_stats(),
+        'client_pool': gemini_pool.get_stats()
+    }
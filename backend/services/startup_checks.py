@@ -0,0 +1,96 @@
+import time
+import threading
+from config import Config
+
+class StartupChecker:
+    """
+    Model and key checks that used to block app import. They run once per
+    worker on a background thread, after the first request, and the
+    results are reported by /api/health. The thread also imports the heavy
+    modules so the first real upload doesn't pay for them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.status = {'state': 'pending', 'started_at': None, 'finished_at': None, 'keys': {}, 'warmup': {}}
+
+    def start(self, model_name=None):
+        """Start the checks in the background (once)"""
+        with self.lock:
+            if self.thread is not None or not Config.STARTUP_CHECKS_ENABLED:
+                return
+            self.status['state'] = 'running'
+            self.status['started_at'] = time.time()
+            self.thread = threading.Thread(target=self._run, args=(model_name or Config.GEMINI_MODEL,), daemon=True)
+            self.thread.start()
+
+    def _run(self, model_name):
+        try:
+            self._warm_up()
+            keys = [key for key in Config.GOOGLE_AI_KEYS if key.strip()]
+            if not keys:
+                print("No Google AI API key found")
+            for index, api_key in enumerate(keys, start=1):
+                result = self._check_key(api_key, model_name)
+                with self.lock:
+                    self.status['keys'][f'key_{index}'] = result
+            state = 'ok' if keys and all(result['ok'] for result in self.status['keys'].values()) else 'degraded'
+        except Exception as e:
+            print(f"Startup checks failed: {str(e)}")
+            state = 'failed'
+        with self.lock:
+            self.status['state'] = state
+            self.status['finished_at'] = time.time()
+        print(f"Startup checks finished: {state}")
+
+    def _warm_up(self):
+        """Import the modules that were taken off the startup path"""
+        for module in ('google.generativeai', 'pdfplumber'):
+            started = time.perf_counter()
+            try:
+                __import__(module)
+                result = round(time.perf_counter() - started, 3)
+            except ImportError as e:
+                result = f'unavailable: {e}'
+            with self.lock:
+                self.status['warmup'][module] = result
+
+    def _check_key(self, api_key, model_name):
+        """List models with one key and confirm the configured model can generate content"""
+        from google.ai import generativelanguage as glm
+        from google.api_core import exceptions
+        from google.api_core.client_options import ClientOptions
+
+        started = time.perf_counter()
+        result = {'ok': False, 'model_available': False, 'error': None}
+        try:
+            client = glm.ModelServiceClient(
+                client_options=ClientOptions(api_key=api_key, api_endpoint=Config.GEMINI_API_ENDPOINT or None),
+                transport=Config.GEMINI_TRANSPORT
+            )
+            # No retries: a missing network should fail fast, not hold the thread for a minute
+            models = client.list_models(request={'page_size': 100}, retry=None, timeout=Config.STARTUP_CHECK_TIMEOUT)
+            for model in models:
+                if model.name == model_name and 'generateContent' in model.supported_generation_methods:
+                    result['model_available'] = True
+                    break
+            result['ok'] = result['model_available']
+            if not result['ok']:
+                result['error'] = f"{model_name} is not available for this key"
+        except exceptions.PermissionDenied as e:
+            result['error'] = f"Permission denied: {e.message}"
+        except Exception as e:
+            result['error'] = str(e)
+        result['seconds'] = round(time.perf_counter() - started, 3)
+        return result
+
+    def get_status(self):
+        with self.lock:
+            status = dict(self.status)
+            status['keys'] = dict(self.status['keys'])
+            status['warmup'] = dict(self.status['warmup'])
+            return status
+
+# Global instance
+startup_checker = StartupChecker()
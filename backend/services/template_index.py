@@ -0,0 +1,456 @@
+import os
+import re
+import json
+import time
+import uuid
+import random
+import sqlite3
+import hashlib
+import threading
+from config import Config
+from utils.helpers import EXTRACTED_FIELDS
+
+_TOKEN_RE = re.compile(r'[^a-z0-9.]+')
+_NUMERIC_FIELDS = {'rate', 'distance', 'weight'}
+
+def _normalize_token(text):
+    return _TOKEN_RE.sub('', text.lower()).strip('.')
+
+def _value_tokens(value):
+    return [token for token in (_normalize_token(part) for part in str(value).split()) if token]
+
+def _to_number(value):
+    try:
+        return float(str(value).replace(',', '').replace('$', '').strip())
+    except ValueError:
+        return None
+
+def _values_match(field, left, right):
+    """Compare two field values ignoring punctuation, case and number formatting"""
+    if field in _NUMERIC_FIELDS:
+        left_number, right_number = _to_number(left), _to_number(right)
+        if left_number is not None and right_number is not None:
+            return abs(left_number - right_number) < 0.01
+    return _value_tokens(left) == _value_tokens(right)
+
+def _reading_order(words):
+    return sorted(words, key=lambda w: (w['page'], round(w['top'], 2), w['x0']))
+
+def _is_label(word):
+    return word['text'].endswith(':')
+
+class TemplateIndex:
+    """
+    Index of known RC layouts. A layout is fingerprinted from the static
+    label words on the first page and their quantized positions. Templates
+    are learned from successful AI extractions: each field's value is located
+    in the word boxes and its bounding box is stored. A field is trusted once
+    the box has reproduced the AI value TEMPLATE_MIN_AGREEMENTS times; a
+    template whose trusted fields mostly disagree with a later AI
+    extraction is evicted. Values read from a template are only
+    candidates: the fast path validates them like regex matches.
+
+    Templates live in SQLite, one row each, so workers share what they
+    learn: a learned template is merged into the current row inside a
+    write transaction, and each process re-reads changed rows every
+    sync_seconds. Matching runs on the in-memory copy.
+    """
+
+    def __init__(self, db_path, max_templates=500, min_similarity=0.7, min_agreements=2, sync_seconds=5):
+        self.db_path = db_path
+        self.max_templates = max_templates
+        self.min_similarity = min_similarity
+        self.min_agreements = min_agreements
+        self.sync_seconds = sync_seconds
+        self.lock = threading.Lock()
+        self._conn = None
+        self.templates = None
+        self.buckets = {}
+        self.versions = {}  # template id -> updated_at of the copy in memory
+        self.used = {}  # template id -> last_used not written yet
+        self.synced_at = 0.0
+        self.stats = {'lookups': 0, 'matches': 0, 'learned': 0, 'updated': 0, 'audits': 0, 'evicted': 0}
+
+    def _get_conn(self):
+        """Open the SQLite file lazily so importing the module stays cheap"""
+        if self._conn is None:
+            folder = os.path.dirname(self.db_path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            # Autocommit; learn() opens its own write transactions
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS templates ('
+                'id TEXT PRIMARY KEY, bucket TEXT NOT NULL, data TEXT NOT NULL, '
+                'last_used REAL NOT NULL, updated_at REAL NOT NULL)'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_templates_bucket ON templates (bucket)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_templates_last_used ON templates (last_used)')
+        return self._conn
+
+    def _load(self):
+        """Load the index from disk on first use, then keep it in sync with other workers"""
+        if self.templates is not None:
+            self._sync()
+            return
+        self.templates = {}
+        self._sync(force=True)
+        print(f"Loaded {len(self.templates)} layout templates")
+
+    def _sync(self, force=False):
+        """Write pending last-used times and re-read rows other workers changed (lock held)"""
+        now = time.time()
+        if not force and now - self.synced_at < self.sync_seconds:
+            return
+        self.synced_at = now
+        conn = self._get_conn()
+        self._write_used(conn)
+        current = dict(conn.execute('SELECT id, updated_at FROM templates').fetchall())
+        for template_id in [template_id for template_id in self.templates if template_id not in current]:
+            self._remove(template_id)
+        changed = [
+            template_id for template_id, updated_at in current.items() if self.versions.get(template_id) != updated_at
+        ]
+        for start in range(0, len(changed), 500):
+            chunk = changed[start:start + 500]
+            rows = conn.execute(
+                f"SELECT id, data, updated_at FROM templates WHERE id IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall()
+            for row in rows:
+                self._keep(*row)
+
+    def _sync_bucket(self, conn, bucket):
+        """Re-read one bucket's rows (inside learn's transaction)"""
+        rows = conn.execute('SELECT id, data, updated_at FROM templates WHERE bucket = ?', (bucket,)).fetchall()
+        stored = {row[0] for row in rows}
+        for template_id in [template_id for template_id in self.buckets.get(bucket, []) if template_id not in stored]:
+            self._remove(template_id)
+        for template_id, data, updated_at in rows:
+            if self.versions.get(template_id) != updated_at:
+                self._keep(template_id, data, updated_at)
+
+    def _keep(self, template_id, data, updated_at):
+        """Replace the in-memory copy of a template with a row read from the database"""
+        template = json.loads(data)
+        template['signature'] = set(template['signature'])
+        if template_id in self.templates:
+            self._remove(template_id)
+        self._add(template)
+        self.versions[template_id] = updated_at
+
+    def _write(self, conn, template):
+        entry = dict(template)
+        entry['signature'] = sorted(template['signature'])
+        updated_at = time.time()
+        conn.execute(
+            'INSERT OR REPLACE INTO templates (id, bucket, data, last_used, updated_at) VALUES (?, ?, ?, ?, ?)',
+            (template['id'], template['bucket'], json.dumps(entry), template['last_used'], updated_at)
+        )
+        self.versions[template['id']] = updated_at
+        self.used.pop(template['id'], None)
+
+    def _write_used(self, conn):
+        """Persist last-used times from matches (only eviction reads them, so they are written lazily)"""
+        if self.used:
+            conn.executemany(
+                'UPDATE templates SET last_used = MAX(last_used, ?) WHERE id = ?',
+                [(last_used, template_id) for template_id, last_used in self.used.items()]
+            )
+            self.used = {}
+
+    def _add(self, template):
+        self.templates[template['id']] = template
+        self.buckets.setdefault(template['bucket'], []).append(template['id'])
+
+    def _remove(self, template_id):
+        template = self.templates.pop(template_id)
+        self.versions.pop(template_id, None)
+        self.used.pop(template_id, None)
+        bucket = self.buckets.get(template['bucket'], [])
+        if template_id in bucket:
+            bucket.remove(template_id)
+
+    def fingerprint(self, words):
+        """
+        Return (bucket, signature) for a document. The bucket is a hash of the
+        header words, so lookups only compare against layouts with the same
+        header; the signature is the set of label words with coarse positions.
+        """
+        header_tokens = set()
+        signature = set()
+        for word in words:
+            if word['page'] != 1:
+                continue
+            token = _normalize_token(word['text'])
+            # Only alphabetic words are used, numbers are almost always values
+            if len(token) < 2 or not token.isalpha():
+                continue
+            signature.add(f"{token}@{int(word['x0'] * 40)},{int(word['top'] * 60)}")
+            if word['top'] < Config.TEMPLATE_HEADER_HEIGHT:
+                header_tokens.add(token)
+        bucket = hashlib.sha1(' '.join(sorted(header_tokens)).encode()).hexdigest()[:16]
+        return bucket, signature
+
+    def _similarity(self, left, right):
+        if not left or not right:
+            return 0.0
+        return len(left & right) / len(left | right)
+
+    def _find(self, bucket, signature):
+        best, best_score = None, 0.0
+        for template_id in self.buckets.get(bucket, []):
+            template = self.templates[template_id]
+            score = self._similarity(signature, template['signature'])
+            if score > best_score:
+                best, best_score = template, score
+        if best and best_score >= self.min_similarity:
+            return best
+        return None
+
+    def match(self, words):
+        """
+        Return trusted field values for a document whose layout is known,
+        or an empty dict. Fields the layout usually lacks are left out, so
+        regex or the AI can still find them.
+        """
+        if not words:
+            return {}
+
+        with self.lock:
+            self._load()
+            self.stats['lookups'] += 1
+            bucket, signature = self.fingerprint(words)
+            template = self._find(bucket, signature)
+            if template is None:
+                return {}
+
+            fields = {}
+            for field, spec in template['fields'].items():
+                if spec['agreements'] < self.min_agreements or spec.get('absent'):
+                    continue
+                value = self._read_field(field, spec, words)
+                if value is not None:
+                    fields[field] = value
+
+            if fields:
+                self.stats['matches'] += 1
+                template['last_used'] = time.time()
+                self.used[template['id']] = template['last_used']
+            return fields
+
+    def sample_audit(self):
+        """Whether to send a document the templates answered to the AI anyway, so learn() re-checks the template"""
+        if random.random() >= Config.TEMPLATE_AUDIT_RATE:
+            return False
+        with self.lock:
+            self.stats['audits'] += 1
+        return True
+
+    def learn(self, words, extracted_data):
+        """
+        Update or create the template for this layout from a successful
+        AI extraction. Trusted fields the AI disagrees with lose their
+        trust; when most of them disagree the template is evicted.
+        """
+        if not words:
+            return
+
+        with self.lock:
+            self._load()
+            bucket, signature = self.fingerprint(words)
+            if not signature:
+                return
+
+            conn = self._get_conn()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Start from the stored rows, so agreements other workers counted are kept
+                self._sync_bucket(conn, bucket)
+                template = self._find(bucket, signature)
+                if template is None:
+                    template = {
+                        'id': uuid.uuid4().hex,
+                        'bucket': bucket,
+                        'signature': signature,
+                        'fields': {},
+                        'samples': 0,
+                        'created_at': time.time(),
+                        'last_used': time.time()
+                    }
+                    self._evict_if_full(conn)
+                    self._add(template)
+                    self.stats['learned'] += 1
+                else:
+                    self.stats['updated'] += 1
+
+                # The fields match() answers with
+                trusted = [
+                    field for field, spec in template['fields'].items()
+                    if spec['agreements'] >= self.min_agreements and not spec.get('absent')
+                ]
+                template['samples'] += 1
+                disagreed = [
+                    field for field in EXTRACTED_FIELDS
+                    if not self._learn_field(template, field, extracted_data.get(field, 'Not found'), words)
+                    and field in trusted
+                ]
+
+                if trusted and len(disagreed) * 2 > len(trusted):
+                    print(f"Evicting layout template {template['id'][:8]}: AI disagrees on {', '.join(disagreed)}")
+                    conn.execute('DELETE FROM templates WHERE id = ?', (template['id'],))
+                    self._remove(template['id'])
+                    self.stats['evicted'] += 1
+                else:
+                    self._write(conn, template)
+                conn.execute('COMMIT')
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                # The in-memory copy may hold the unsaved change; read everything again next time
+                self.versions = {}
+                self.synced_at = 0.0
+                raise
+
+    def _learn_field(self, template, field, value, words):
+        """Count an agreement for the field's box (True), or learn it again from this value (False)"""
+        spec = template['fields'].get(field)
+
+        if spec is not None:
+            current = self._read_field(field, spec, words)
+            if current is not None and _values_match(field, current, value):
+                spec['agreements'] += 1
+                return True
+
+        if value in (None, '', 'Not found'):
+            template['fields'][field] = {'absent': True, 'agreements': 1}
+            return False
+
+        box = self._locate_value(field, value, words)
+        if box is None:
+            template['fields'].pop(field, None)
+        else:
+            box['agreements'] = 1
+            template['fields'][field] = box
+        return False
+
+    def _locate_value(self, field, value, words):
+        """Find the bounding box of the words that spell out value"""
+        ordered = _reading_order(words)
+
+        if field in _NUMERIC_FIELDS:
+            number = _to_number(value)
+            if number is None:
+                return None
+            for word in ordered:
+                if _to_number(word['text']) == number:
+                    return self._union_box([word])
+            return None
+
+        tokens = _value_tokens(value)
+        if not tokens:
+            return None
+
+        # Tokens must appear in order; a few unrelated words in between are
+        # tolerated so values wrapped onto the next line are still found
+        max_gap = 8
+        for start, word in enumerate(ordered):
+            if _normalize_token(word['text']) != tokens[0]:
+                continue
+            matched = [word]
+            position = start + 1
+            for token in tokens[1:]:
+                found = None
+                for candidate in range(position, min(position + max_gap + 1, len(ordered))):
+                    if ordered[candidate]['page'] != word['page']:
+                        break
+                    if _normalize_token(ordered[candidate]['text']) == token:
+                        found = candidate
+                        break
+                if found is None:
+                    break
+                matched.append(ordered[found])
+                position = found + 1
+            if len(matched) == len(tokens):
+                return self._union_box(matched)
+        return None
+
+    def _union_box(self, words):
+        return {
+            'page': words[0]['page'],
+            'x0': min(w['x0'] for w in words),
+            'x1': max(w['x1'] for w in words),
+            'top': min(w['top'] for w in words),
+            'bottom': max(w['bottom'] for w in words)
+        }
+
+    def _read_field(self, field, spec, words):
+        """
+        Read a field value from the words inside its stored box. Text
+        values run on past the box to the end of the line, stopping at the
+        next label or column gap, since they vary in length.
+        """
+        if spec.get('absent'):
+            return 'Not found'
+
+        tolerance = Config.TEMPLATE_BOX_TOLERANCE
+        lines = {}
+        for word in _reading_order(words):
+            if (word['page'] == spec['page']
+                    and spec['top'] - tolerance <= (word['top'] + word['bottom']) / 2 <= spec['bottom'] + tolerance
+                    and word['x0'] >= spec['x0'] - tolerance):
+                lines.setdefault(round(word['top'], 2), []).append(word)
+
+        selected = []
+        for line in lines.values():
+            previous = None
+            for word in line:
+                if word['x0'] > spec['x1'] + tolerance and (
+                    previous is None or field in _NUMERIC_FIELDS or _is_label(word)
+                    or word['x0'] - previous['x1'] > Config.TEMPLATE_COLUMN_GAP
+                ):
+                    break
+                selected.append(word)
+                previous = word
+        if not selected:
+            return None
+
+        text = ' '.join(word['text'] for word in selected)
+        if field in _NUMERIC_FIELDS:
+            return _to_number(text)
+        return text
+
+    def _evict_if_full(self, conn):
+        """Drop the least recently used templates to make room for one more (inside learn's transaction)"""
+        self._write_used(conn)
+        overflow = conn.execute('SELECT COUNT(*) FROM templates').fetchone()[0] - self.max_templates + 1
+        if overflow <= 0:
+            return
+        for (template_id,) in conn.execute(
+            'SELECT id FROM templates ORDER BY last_used ASC LIMIT ?', (overflow,)
+        ).fetchall():
+            conn.execute('DELETE FROM templates WHERE id = ?', (template_id,))
+            if template_id in self.templates:
+                self._remove(template_id)
+
+    def get_stats(self):
+        with self.lock:
+            self._load()
+            stats = self.stats.copy()
+            stats['templates'] = len(self.templates)
+            stats['trusted_templates'] = sum(
+                1 for template in self.templates.values()
+                if template['fields'] and all(
+                    spec['agreements'] >= self.min_agreements
+                    for spec in template['fields'].values()
+                )
+            )
+            return stats
+
+# Global instance
+template_index = TemplateIndex(
+    Config.TEMPLATE_INDEX_PATH,
+    max_templates=Config.TEMPLATE_MAX_TEMPLATES,
+    min_similarity=Config.TEMPLATE_MIN_SIMILARITY,
+    min_agreements=Config.TEMPLATE_MIN_AGREEMENTS,
+    sync_seconds=Config.TEMPLATE_SYNC_SECONDS
+)
@@ -1,7 +1,77 @@
 import os
+import re
 import uuid
+import hashlib
+import shutil
+import zipfile
+import tempfile
+import multiprocessing
 from werkzeug.utils import secure_filename
 
+# Fields extracted from the document itself (by the AI or local parsers)
+EXTRACTED_FIELDS = [
+    'broker_name', 'carrier_name', 'load_number', 'pickup_number',
+    'rate', 'distance', 'pickup_address', 'pickup_time',
+    'delivery_address', 'delivery_time', 'commodity', 'weight',
+    'equipment', 'notes'
+]
+
+# Fields computed from the extraction and the requested deadhead
+CALCULATED_FIELDS = ['total_distance', 'rate_per_mile']
+
+# Leading bytes of the document types we accept, and the extension they map to
+FILE_SIGNATURES = [
+    (b'%PDF-', 'pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpg')
+]
+
+def worker_context():
+    """
+    Start method for worker process pools: forkserver where the platform
+    has it, since forking copies the app's threads, locks and gRPC channels
+    """
+    return multiprocessing.get_context(
+        'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else None
+    )
+
+def detect_file_type(header):
+    """
+    Return the document type ('pdf', 'png', 'jpg') from the file's first
+    bytes, or None if it is not a supported document
+    """
+    # Some PDF writers put junk before the header; readers accept it within the first 1 KB
+    if b'%PDF-' in header[:1024]:
+        return 'pdf'
+    for signature, file_type in FILE_SIGNATURES:
+        if header.startswith(signature):
+            return file_type
+    return None
+
+US_STATE_CODES = {
+    'AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'DC', 'FL', 'GA', 'HI', 'ID', 'IL', 'IN',
+    'IA', 'KS', 'KY', 'LA', 'ME', 'MD', 'MA', 'MI', 'MN', 'MS', 'MO', 'MT', 'NE', 'NV', 'NH',
+    'NJ', 'NM', 'NY', 'NC', 'ND', 'OH', 'OK', 'OR', 'PA', 'RI', 'SC', 'SD', 'TN', 'TX', 'UT',
+    'VT', 'VA', 'WA', 'WV', 'WI', 'WY'
+}
+
+# "Dallas, TX 75201" / "Dallas TX" - the state is the last two-letter word before an optional ZIP
+STATE_PATTERN = re.compile(r'(,\s*)?\b([A-Za-z]{2})\b\.?(\s+\d{5}(?:-\d{4})?)?')
+
+def extract_state(address):
+    """
+    Return the two-letter US state of an address, or None
+    """
+    if not isinstance(address, str):
+        return None
+    last_part = address.rstrip(' .')
+    for comma, state, zip_code in reversed(STATE_PATTERN.findall(address)):
+        # Lowercase words ("or", "in") only count as states before a ZIP or as the last part ("Laredo, Tx")
+        is_last_part = bool(comma) and last_part.endswith(state)
+        if state.upper() in US_STATE_CODES and (state.isupper() or zip_code or is_last_part):
+            return state.upper()
+    return None
+
 def allowed_file(filename, allowed_extensions):
     """
     Check if the file has an allowed extension
@@ -11,28 +81,170 @@ def allowed_file(filename, allowed_extensions):
 
 def save_uploaded_file(file, upload_folder):
     """
-    Save uploaded file with a unique filename
+    Save uploaded file with a unique filename (for background jobs that
+    need a path). The type is checked from the content, not the extension.
     """
-    if file and allowed_file(file.filename, {'pdf', 'png', 'jpg', 'jpeg'}):
-        filename = secure_filename(file.filename)
-        # Generate unique filename to avoid collisions
-        unique_filename = f"{uuid.uuid4().hex}_{filename}"
-        file_path = os.path.join(upload_folder, unique_filename)
-        file.save(file_path)
-        return file_path
-    return None
+    if not file:
+        return None
+    header = file.stream.read(1024)
+    file.stream.seek(0)
+    if detect_file_type(header) is None:
+        return None
+    filename = secure_filename(file.filename)
+    # Generate unique filename to avoid collisions
+    unique_filename = f"{uuid.uuid4().hex}_{filename}"
+    file_path = os.path.join(upload_folder, unique_filename)
+    file.save(file_path)
+    return file_path
+
+class UploadedDocument:
+    """
+    An upload read straight from the request stream. Small documents stay
+    in memory as bytes; larger ones spill to a temp file. Use as a context
+    manager so the temp file is removed on every path.
+    """
+
+    def __init__(self, filename, source, size, file_type, file_hash, temp_path=None):
+        self.filename = filename
+        self.source = source  # bytes, or the temp file path
+        self.size = size
+        self.file_type = file_type
+        self.file_hash = file_hash
+        self.temp_path = temp_path
+
+    @property
+    def in_memory(self):
+        return self.temp_path is None
+
+    def cleanup(self):
+        if self.temp_path:
+            try:
+                os.remove(self.temp_path)
+            except OSError:
+                pass
+            self.temp_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+
+def read_uploaded_file(file, spill_threshold, chunk_size=65536):
+    """
+    Read an upload into an UploadedDocument, hashing it on the way.
+    Returns None if the content is not a supported document type.
+    """
+    if not file:
+        return None
+
+    digest = hashlib.sha256()
+    buffer = bytearray()
+    spill = None
+    size = 0
+    file_type = None
+    try:
+        for chunk in iter(lambda: file.stream.read(chunk_size), b''):
+            if size == 0:
+                file_type = detect_file_type(chunk)
+                if file_type is None:
+                    return None
+            digest.update(chunk)
+            size += len(chunk)
+            if spill is None and size > spill_threshold:
+                spill = tempfile.NamedTemporaryFile(prefix='smartrc_', suffix=f'.{file_type}', delete=False)
+                spill.write(buffer)
+                buffer = None
+            if spill is not None:
+                spill.write(chunk)
+            else:
+                buffer.extend(chunk)
+    except Exception:
+        if spill is not None:
+            spill.close()
+            os.remove(spill.name)
+        raise
+
+    if size == 0:
+        return None
+    if spill is not None:
+        spill.close()
+        return UploadedDocument(file.filename, spill.name, size, file_type, digest.hexdigest(), temp_path=spill.name)
+    return UploadedDocument(file.filename, bytes(buffer), size, file_type, digest.hexdigest())
+
+def is_zip_upload(file):
+    """Check the upload's content (not its name) for a zip archive"""
+    is_zip = zipfile.is_zipfile(file.stream)
+    file.stream.seek(0)
+    return is_zip
+
+def extract_zip_uploads(file, upload_folder, max_files=500, max_member_size=16 * 1024 * 1024):
+    """
+    Unpack allowed documents from an uploaded zip archive.
+    Returns a list of (original_filename, saved_path) tuples.
+    """
+    saved_files = []
+    with zipfile.ZipFile(file.stream) as archive:
+        for member in archive.infolist():
+            if member.is_dir() or len(saved_files) >= max_files:
+                continue
+            
+            original_name = os.path.basename(member.filename)
+            # Skip oversized members instead of trusting the archive
+            if member.file_size > max_member_size:
+                continue
+            
+            with archive.open(member) as source:
+                header = source.read(1024)
+                if detect_file_type(header) is None:
+                    continue
+                unique_filename = f"{uuid.uuid4().hex}_{secure_filename(original_name)}"
+                file_path = os.path.join(upload_folder, unique_filename)
+                with open(file_path, 'wb') as target:
+                    target.write(header)
+                    shutil.copyfileobj(source, target)
+            saved_files.append((original_name, file_path))
+    
+    return saved_files
+
+def compute_file_hash(source, chunk_size=65536):
+    """
+    Compute SHA-256 of a file's bytes (path or raw bytes) for content-addressed caching
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(source).hexdigest()
+    digest = hashlib.sha256()
+    with open(source, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def add_calculated_fields(extracted_data, deadhead=0):
+    """
+    Add deadhead-derived fields (total_distance, rate_per_mile) to a raw extraction
+    """
+    result = dict(extracted_data)
+    try:
+        rate = float(result.get('rate', 0))
+        distance = float(result.get('distance', 0))
+        total_distance = distance + deadhead
+        rate_per_mile = round(rate / total_distance, 2) if total_distance > 0 else 0
+        
+        result['total_distance'] = total_distance
+        result['rate_per_mile'] = rate_per_mile
+        result['deadhead'] = deadhead
+    except (ValueError, TypeError):
+        result['total_distance'] = 'n/a'
+        result['rate_per_mile'] = 'n/a'
+    
+    return result
 
 def format_response_data(processed_data):
     """
     Format the processed data for API response
     """
     # Ensure all required fields are present
-    required_fields = [
-        'broker_name', 'carrier_name', 'load_number', 'pickup_number',
-        'rate', 'distance', 'pickup_address', 'pickup_time',
-        'delivery_address', 'delivery_time', 'commodity', 'weight',
-        'equipment', 'notes', 'total_distance', 'rate_per_mile'
-    ]
+    required_fields = EXTRACTED_FIELDS + CALCULATED_FIELDS
     
     response = {}
     for field in required_fields: